@@ -11,6 +11,9 @@ import matplotlib.pyplot as plt
 #import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
 
 def epa_to_modis_file_name(date_string, station_id):
     
@@ -70,17 +73,7 @@ def plot_blue_green(modis_df):
 #gathers all the 2016 csv files into one dataframe
 #returns dataframe
 def get_epa(epa_directory, year = '2016'):
-    files = os.listdir(epa_directory)
-    first_file = True
-    for file in files:
-        if file[-8:]== year + ".csv":
-            new_df = pandas.read_csv(epa_directory + file)
-            if not first_file:
-                df = df.append(new_df,ignore_index=True)
-            else:
-                df = new_df
-                first_file = False
-    return df
+    return utils.get_epa(epa_directory, year)
 
 def get_modis_means(modis_means_filename, modis_means_directory):
     modis_df = pandas.read_csv(modis_means_directory + modis_means_filename)
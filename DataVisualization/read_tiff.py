@@ -8,17 +8,28 @@ except ModuleNotFoundError:
     from osgeo import gdal
 
 import numpy as np
+import pandas as pd
 #import rasterio
 #from rasterio.plot import show
 import matplotlib.pyplot as plt
 from os import listdir
 from os.path import isfile, join, exists
 import collections
+from concurrent.futures import ProcessPoolExecutor
 
 HOME_FOLDER = os.path.expanduser("~")
 REPO_NAME = "cs325b-airquality" #"es262-airquality"
 BUCKET_FOLDER = os.path.join(HOME_FOLDER, REPO_NAME)
 NUM_BANDS_SENTINEL = 13
+# Modis pixels below this value are missing
+MODIS_MISSING_VALUE = -50000
+MODIS_SUB_DIRS = ["2016_processed_100x100/", "2017_processed_100x100/"]
+# Centered crop sizes of the Sentinel band statistics, and header of their .csv files
+SENTINEL_STATS_CROP_SIZES = [200, 32]
+SENTINEL_STATS_HEADER = (["Filename", "Index", "B1 (with zeros)"] + ["B{}".format(b) for b in range(2, 14)] +
+                         ["B1 (without zeros)"] + ["B{}".format(b) for b in range(2, 14)] +
+                         ["Missing B{}".format(b) for b in range(1, 14)])
+MODIS_STATS_COLUMNS = ["Blue mean", "Green mean", "Num Missing Blue", "Num Missing Green"]
 
 def normalize(arr):
     if np.max(arr) == np.min(arr):
@@ -259,199 +270,205 @@ def save_all_s2_imgs(directory):
         display_sentinel_gdal(directory, fname)
 
 
-def save_all_modis_to_csv(csv_filename, modis_directory):
+def modis_pixel_columns(k):
     '''
-    Saves the blue and green channel values of the 4 center pixel values
-    of every modis image (in all year directories) to the given csv named csv_filename.
+    Returns the names of the blue and green columns of the k x k center pixels of a modis image.
     '''
-    
-    with open(csv_filename, 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Filename", "Blue [0,0]", "Blue [0,1]", "Blue [1,0]", "Blue [1,1]",
-                         "Green [0,0]", "Green [0,1]", "Green [1,0]", "Green [1,1]"])
-        
-        base_dir = modis_directory
-        sub_dirs = ["2016_processed_100x100/", "2017_processed_100x100/"] 
-        for sub_dir in sub_dirs:
-
-            full_dir = join(base_dir, sub_dir)
-            print("Saving 2x2 cropped modis images from directory: {} of size {} \n".format(full_dir, len(listdir(full_dir))))
-            
-            for idx, fname in enumerate(listdir(full_dir)):
-                if idx % 100 == 0:
-                    print("File {} name: {}".format(idx, fname))
-
-                img = read_middle(full_dir, fname, 2, 2)
+    return (["Blue [{},{}]".format(i, j) for i in range(k) for j in range(k)] +
+            ["Green [{},{}]".format(i, j) for i in range(k) for j in range(k)])
 
-                blues = img[:,:,1]
-                greens = img[:,:,0]
 
-                # Mask missing values with small negative sentinel 
-                blues[blues<-50000] = -1
-                greens[greens<-50000] = -1
-                num_pixels = greens.shape[0] * greens.shape[1]
-                writer.writerow([fname, blues[0,0], blues[0,1], 
-                                 blues[1,0], blues[1,1], greens[0,0],
-                                 greens[0,1],greens[1,0], greens[1,1]])
-
-    csvfile.close()
+def scan_modis_file(args):
+    '''
+    Reads the k x k center of one modis image once, and returns its row of the modis table:
+    [filename, blue pixels, green pixels, blue mean, green mean, # missing blue, # missing green].
+    Missing pixels (values < MODIS_MISSING_VALUE) are set to -1 and left out of the means.
+    args is the tuple (dir_path, fname, k) so the function can be mapped over a process pool.
+    '''
+    dir_path, fname, k = args
+    img = read_middle(dir_path, fname, k, k).astype(np.float64)
+    greens = img[:,:,0]
+    blues = img[:,:,1]
+
+    row = [fname]
+    stats = []
+    for band in [blues, greens]:
+        missing = band < MODIS_MISSING_VALUE
+        num_valid = missing.size - missing.sum()
+        # avoid divide by 0 if the full center is missing
+        mean = band[~missing].sum() / num_valid if num_valid != 0 else 0.0
+        row.extend(np.where(missing, -1, band).ravel())
+        stats.append((mean, int(missing.sum())))
+    return row + [stats[0][0], stats[1][0], stats[0][1], stats[1][1]]
+
+
+def scan_modis(modis_directory, save_path=None, k=2, sub_dirs=MODIS_SUB_DIRS, num_processes=None, filenames=None):
+    '''
+    Scans every modis image (in all year directories) in parallel, reading each image only once,
+    and returns a table keyed by (Date, Site ID) with the blue and green values of the k x k center
+    pixels plus their masked means and number of missing values. The table is saved as parquet
+    to save_path if given. If filenames is given, only the images with those names are scanned.
+    '''
+    if filenames is not None:
+        filenames = set(filenames)
+    tasks = []
+    for sub_dir in sub_dirs:
+        full_dir = join(modis_directory, sub_dir)
+        fnames = sorted(fname for fname in listdir(full_dir)
+                        if fname.endswith(".tif") and (filenames is None or fname in filenames))
+        print("Scanning {}x{} center of modis images from directory: {} of size {}".format(k, k, full_dir, len(fnames)))
+        tasks.extend((full_dir, fname, k) for fname in fnames)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for idx, row in enumerate(executor.map(scan_modis_file, tasks, chunksize=64)):
+            if idx % 1000 == 0:
+                print("File {} name: {}".format(idx, row[0]))
+            rows.append(row)
+
+    pixel_columns = modis_pixel_columns(k)
+    df = pd.DataFrame(rows, columns=["Filename"] + pixel_columns + MODIS_STATS_COLUMNS)
+    df[pixel_columns + MODIS_STATS_COLUMNS[:2]] = df[pixel_columns + MODIS_STATS_COLUMNS[:2]].astype(np.float32)
+    df[MODIS_STATS_COLUMNS[2:]] = df[MODIS_STATS_COLUMNS[2:]].astype(np.int32)
+
+    # Filenames are <year>_<day of year>_<site id>.tif, images with other names are left out
+    parts = df["Filename"].str[:-len(".tif")].str.split("_", n=2, expand=True).reindex(columns=range(3))
+    dates = pd.to_datetime(parts[0] + parts[1], format="%Y%j", errors="coerce")
+    site_ids = pd.to_numeric(parts[2], errors="coerce")
+    valid = (dates.notnull() & site_ids.notnull()).values
+    if not valid.all():
+        print("Skipping {} modis images with unexpected filenames".format((~valid).sum()))
+    df = df[valid]
+    df.insert(1, "Date", dates[valid])
+    df.insert(2, "Site ID", site_ids[valid].astype(np.int64))
+    df = df.sort_values(["Date", "Site ID"], kind="stable").reset_index(drop=True)
+
+    if save_path is not None:
+        df.to_parquet(save_path, index=False)
+    return df
+
+
+def save_all_modis_to_csv(csv_filename, modis_directory, k=2):
+    '''
+    Saves the blue and green channel values of the k x k center pixel values
+    of every modis image (in all year directories), with their means and number of
+    missing values. The table is stored as parquet next to csv_filename (see utils.table_path),
+    which is where utils.read_table(csv_filename) looks for it.
+    '''
+    save_path = os.path.splitext(csv_filename)[0] + ".parquet"
+    scan_modis(modis_directory, save_path, k=k)
 
-        
 
 def compute_means_all_files_modis(directory):
     '''
     Computes the mean value on the MODIS green and blue bands for all files in the directory given.
     '''
-    #base_dir = "/home/sarahciresi/gcloud/cs325b-airquality/cs325b/data/modis/"
-    #sub_dirs = ["2016_processed_100x100/", "2017_processed_100x100/", "2018_processed_100x100/", "2019_processed_100x100/"]
-    #for sub_dir in sub_dirs:
-        
-    #    full_dir = base_dir+sub_dir   
-    #    print("Computing modis means for directory: {} of size {} \n".format(full_dir, len(listdir(full_dir))))
-
-    means = []  # [filename, blue_mean, green_mean, # missing blue values, # missing green values]   
-    for idx, fname in enumerate(listdir(directory)):
-        if idx % 1000 == 0:
-            print("File {} name: {}".format(idx, fname))
-
-        img = read_middle(directory, fname, 2, 2)
-
-        greens = img[:,:,0]
-        blues = img[:,:,1]
-
-        num_pixels = greens.shape[0] * greens.shape[1]
+    df = scan_modis(directory, k=2, sub_dirs=[""])
+    # Save to .csv file for later use
+    df[["Filename"] + MODIS_STATS_COLUMNS].to_csv("modis_channel_means_revised.csv", index=False)
 
-        # get the number of missing values in green and blue channels for whole image
-        num_missing_g = np.where(greens.flatten() < - 50000)[0].shape[0]
-        num_missing_b = np.where(blues.flatten() < - 50000)[0].shape[0]
+    
+def sentinel_band_stats(img):
+    '''
+    Computes the statistics of every band of every measurement of a (H x W x 13M) Sentinel image
+    with reductions over its (H, W, M, 13) reshape. Returns a (M x 39) array whose rows are
+    [13 band means with zeros, 13 band means without zeros, 13 numbers of zero (missing) values].
+    '''
+    h, w = img.shape[:2]
+    num_measurements = img.shape[2] // NUM_BANDS_SENTINEL
+    bands = img[:,:,:num_measurements * NUM_BANDS_SENTINEL].reshape(h, w, num_measurements, NUM_BANDS_SENTINEL)
+    num_pixels = h * w
+    sums = bands.sum(axis=(0, 1), dtype=np.float64)
+    num_zeros = (bands == 0).sum(axis=(0, 1))
+    num_nonzero = num_pixels - num_zeros
+    means_with_zeros = sums / num_pixels
+    # avoid divide by 0 if a band is all zeros, its sum (0) is kept as the mean
+    means_without_zeros = np.where(num_nonzero != 0, sums / np.maximum(num_nonzero, 1), sums)
+    return np.hstack([means_with_zeros, means_without_zeros, num_zeros])
+
+
+def scan_sentinel_file(args):
+    '''
+    Reads the largest of the centered crops given by crop_sizes from one Sentinel .tif, only once,
+    and computes the band statistics (see sentinel_band_stats) of every crop size from it.
+    Returns a dict crop size -> (M x 39) array, or None if the image is missing or smaller than a crop.
+    args is the tuple (dir_path, fname, crop_sizes) so the function can be mapped over a process pool.
+    '''
+    dir_path, fname, crop_sizes = args
+    file_path = join(dir_path, fname)
+    if not exists(file_path):
+        return None
+    gdal_dataset = gdal.Open(file_path)
+    if gdal_dataset == None:
+        print("Unable to open sentinel file {} at path {}".format(fname, dir_path))
+        return None
 
-        num_valid_g = num_pixels - num_missing_g
-        num_valid_b = num_pixels - num_missing_b
-        
-        # compute the mean, not including missing pixels.. zero them out for the sum computation
-        blues[blues < -50000] = 0
-        greens[greens < -50000] = 0
-        
-        # avoid divide by 0 if full image is missing
-        bm = np.sum(blues)
-        gm = np.sum(greens)
+    WW, HH = gdal_dataset.RasterXSize, gdal_dataset.RasterYSize
+    largest = max(crop_sizes)
+    if largest > WW or largest > HH:
+        return None
 
-        if (num_valid_b != 0):
-            bm /= num_valid_b
-        if (num_valid_g != 0):
-            gm /= num_valid_g
+    # Same top left corners as read_middle for each crop size, relative to the largest crop
+    x0, y0 = (WW - largest)//2, (HH - largest)//2
+    img = gdal_dataset.ReadAsArray(x0, y0, largest, largest)
+    if len(img.shape) == 2:
+        img = np.reshape(img, [1] + list(img.shape))
+    img = np.transpose(img, (1, 2, 0))
 
-        means.append([fname, bm, gm, num_missing_b, num_missing_g])
+    stats = {}
+    for size in crop_sizes:
+        x, y = (WW - size)//2 - x0, (HH - size)//2 - y0
+        stats[size] = sentinel_band_stats(img[y:y + size, x:x + size])
+    return stats
 
-    # Save to .csv file for later use
-    with open("modis_channel_means_revised.csv", 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Filename", "Blue mean", "Green mean", "Num Missing Blue", "Num Missing Green"])
-        writer.writerows(means)
-    csvfile.close()
 
-    
-def compute_means_all_files_sentinel(directory):
+def scan_sentinel(directory, crop_sizes=SENTINEL_STATS_CROP_SIZES, num_processes=None):
+    '''
+    Computes the band statistics of each measurement of every Sentinel .tif in the directory, for every
+    centered crop size, across a process pool. Each .tif is read once. Returns a dict crop size -> 
+    DataFrame with the SENTINEL_STATS_HEADER columns (one row per file and measurement).
+    Images smaller than the largest crop are left out.
+    '''
+    fnames = sorted(listdir(directory))
+    print("Computing sentinel means for directory: {} of size {} \n".format(directory, len(fnames)))
+
+    tasks = [(directory, fname, list(crop_sizes)) for fname in fnames]
+    stats = {size: [] for size in crop_sizes}
+    names, indices = [], []
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for idx, (fname, file_stats) in enumerate(zip(fnames, executor.map(scan_sentinel_file, tasks, chunksize=16))):
+            if idx % 100 == 0:
+                print("File {} name: {}".format(idx, fname))
+            if file_stats is None:
+                continue
+            num_measurements = file_stats[crop_sizes[0]].shape[0]
+            names.extend([fname] * num_measurements)
+            indices.extend(range(num_measurements))
+            for size in crop_sizes:
+                stats[size].append(file_stats[size])
+
+    dfs = {}
+    for size in crop_sizes:
+        values = np.vstack(stats[size]) if stats[size] else np.zeros((0, 3 * NUM_BANDS_SENTINEL))
+        df = pd.DataFrame(values)
+        df.insert(0, "Index", indices)
+        df.insert(0, "Filename", names)
+        df.columns = SENTINEL_STATS_HEADER
+        df[SENTINEL_STATS_HEADER[-NUM_BANDS_SENTINEL:]] = values[:, -NUM_BANDS_SENTINEL:].astype(np.int64)
+        dfs[size] = df
+    return dfs
+
+
+def compute_means_all_files_sentinel(directory, crop_sizes=SENTINEL_STATS_CROP_SIZES, num_processes=None):
     ''' 
     Computes the mean band value for each of the 13 Sentinel bands for each individual measurement in
-    each .tif file in the directory. 
+    each .tif file in the directory, and saves them to sentinel_channel_means_<crop size>.csv for every
+    crop size.
     '''
-    print("Computing sentinel means for directory: {} of size {} \n".format(directory, len(listdir(directory))))
+    for size, df in scan_sentinel(directory, crop_sizes, num_processes).items():
+        save_to_file = "sentinel_channel_means_" + str(size) + ".csv"
+        df.to_csv(save_to_file, index=False)
 
-    means = [] # [filename, measurement, b1_mean_with_zeros, b2_mean, ... b13_mean,
-               #  b1_m_without_zeros ... missing b1 values, ... # missing b13 values]
-    means2= []
-    
-    for idx, fname in enumerate(listdir(directory)):
-        if idx % 100 == 0:
-            print("File {} name: {}".format(idx, fname))
-
-        #img = read(directory, fname)
-        im_size = 200
-        im_size2 = 32
-        img = read_middle(directory, fname, im_size, im_size)
-        img32 = read_middle(directory, fname, im_size2, im_size2)
-
-        # if the image was smaller than the requested size, a dummy img with sentinel values of -1
-        # will be returned, and we won't include this image
-        if np.array_equal(img, (np.ones((im_size, im_size, 2))*-1)):
-            continue
-        if np.array_equal(img32, (np.ones((im_size2, im_size2, 2))*-1)):
-            continue
-                    
-        num_measurements = img.shape[2]//NUM_BANDS_SENTINEL
-        num_pixels = img.shape[0] * img.shape[1]
-        num_pixels2 = img32.shape[0] * img32.shape[1]
-        
-        # for each measurement, look at each of 1-13 bands, and compute the mean for that day
-        for m in range(0, num_measurements):
-
-            band_means_with_zeros = []
-            band_means_without_zeros = []
-            band_zero_val_counts = []
-
-            ###
-            band_means_with_zeros2 = []
-            band_means_without_zeros2 = []
-            band_zero_val_counts2 = []
-            ###
-            
-            for band in range(0, NUM_BANDS_SENTINEL):
-                band_n = img[:,:, band + m * NUM_BANDS_SENTINEL]
-                num_zeros = np.where(band_n.flatten() == 0)[0].shape[0]  # changed from 500
-                num_nonzero = num_pixels - num_zeros
-                
-                # compute the mean with zeros and without 
-                band_mean_with_zeros = np.mean(band_n)
-                band_mean_without_zeros = np.sum(band_n)  #np.mean(band_n)
-                if (num_nonzero  != 0):
-                    band_mean_without_zeros /= num_nonzero
-                    
-                band_means_with_zeros.append(band_mean_with_zeros)
-                band_means_without_zeros.append(band_mean_without_zeros)
-                band_zero_val_counts.append(num_zeros)
-
-                ### do the same for smaller image size
-                band_n2 = img32[:,:, band + m * NUM_BANDS_SENTINEL]
-                num_zeros2 = np.where(band_n2.flatten() == 0)[0].shape[0]  # changed from 500
-                num_nonzero2 = num_pixels2 - num_zeros2
-                band_mean_with_zeros2 = np.mean(band_n2)
-                band_mean_without_zeros2 = np.sum(band_n2)
-                if (num_nonzero2  != 0):
-                    band_mean_without_zeros2 /= num_nonzero2
-                band_means_with_zeros2.append(band_mean_with_zeros2)
-                band_means_without_zeros2.append(band_mean_without_zeros2)
-                band_zero_val_counts2.append(num_zeros2)
-                
-            row = [fname, m, band_means_with_zeros, band_means_without_zeros, band_zero_val_counts]
-            flattened_row = flatten(row)
-            means.append(flattened_row)
-
-            row2 = [fname, m, band_means_with_zeros2, band_means_without_zeros2, band_zero_val_counts2]
-            flattened_row2 = flatten(row2)
-            means2.append(flattened_row2)
-            
-    save_to_file = "sentinel_channel_means_" + str(im_size) + ".csv"
-    with open(save_to_file, 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Filename", "Index", "B1 (with zeros)", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10", 
-                         "B11", "B12", "B13", "B1 (without zeros)", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10",
-                         "B11", "B12", "B13", "Missing B1", "Missing B2", "Missing B3", "Missing B4",
-                         "Missing B5", "Missing B6", "Missing B7", "Missing B8", "Missing B9", "Missing B10",
-                         "Missing B11", "Missing B12", "Missing B13"])
-        writer.writerows(means)
-    csvfile.close()
-
-    save_to_file = "sentinel_channel_means_" + str(im_size2) + ".csv"
-    with open(save_to_file, 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Filename", "Index", "B1 (with zeros)", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10",
-                         "B11", "B12", "B13", "B1 (without zeros)", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10",
-                         "B11", "B12", "B13", "Missing B1", "Missing B2", "Missing B3", "Missing B4",
-                         "Missing B5", "Missing B6", "Missing B7", "Missing B8", "Missing B9", "Missing B10",
-                         "Missing B11", "Missing B12", "Missing B13"])
-        writer.writerows(means2)
-    csvfile.close()
 
 if __name__ == "__main__":
      
@@ -2,6 +2,7 @@ import datetime
 import os
 import pandas
 import numpy as np
+import utils
 
 #assumes date has already been converted to_datetime and is in that default format
 def epa_to_file_name(date_string, station_id):
@@ -19,39 +20,39 @@ def epa_to_file_name(date_string, station_id):
 
 #stacks all epa csv files into master csv file
 def make_master_epa():
-    files = os.listdir()
-    first_file = True
-    #reads in all relevant csvs
-    for file in files:
-        if file[-4:]==".csv" and file[:3] =="epa":
-            new_df = pandas.read_csv(file)
-            print(file)
-            if not first_file:
-                df = df.append(new_df,ignore_index=True)
-            else:
-                df = new_df
-                first_file = False
+    #reads in all relevant csvs concurrently and concatenates them once
+    files = [file for file in sorted(os.listdir()) if file[-4:]==".csv" and file[:3] =="epa"]
+    print("Reading {} epa files".format(len(files)))
+    df = utils.read_csv_files(files, dtype=utils.EPA_CSV_DTYPES)
     df['Date'] = pandas.to_datetime(df['Date'])
     df.to_csv("master_epa.csv",index=False)
 
 
+#vectorized epa_to_file_name over whole columns of dates and station ids
+#returns a Series of modis filenames aligned with the dates
+def epa_to_file_names(dates, station_ids):
+    dates = pandas.to_datetime(pandas.Series(dates))
+    station_ids = pandas.Series(station_ids, index=dates.index).astype(str)
+    day_of_year = dates.dt.dayofyear.astype(str).str.zfill(3)
+    return dates.dt.year.astype(str) + "_" + day_of_year + "_" + station_ids + ".tif"
+
 #assumes other file is from modis and has modis filenames
-#merges columns into master epa file
+#merges columns into master epa file with a single hash join on the modis filename
+#rows without a matching modis file (or with missing columns) get the -1 missing
+#marker of modis pixels, and are reported in aggregate
+#other_file is the path of the modis table, or the table itself (see read_tiff.scan_modis)
 def add_columns_to_master_modis(epa, other_file, columns):
     #epa = pandas.read_csv("master_epa.csv")
+    other = other_file if isinstance(other_file, pandas.DataFrame) else utils.read_table(other_file)
+    # first row wins for duplicated filenames, as in the old row-by-row lookup
+    other = other.drop_duplicates(subset="Filename").set_index("Filename")[columns]
+    modis_files = epa_to_file_names(epa['Date'].values, epa['Site ID'].values)
+    matched = other.reindex(modis_files.values)
+    num_missing = matched[columns].isnull().any(axis=1).sum()
+    epa = epa.drop(columns=[column for column in columns if column in epa.columns])
     for column in columns:
-        epa[column]=np.nan
-    other = pandas.read_csv(other_file)
-    for row in epa.index:
-        date = pandas.to_datetime(epa['Date'][row])
-        date = "{}-{}-{}".format(date.year, date.month, date.day)
-        site = epa['Site ID'][row]
-        modis_file = epa_to_file_name(date,site)
-        print(modis_file)
-        other_row = other[other['Filename']==modis_file]
-        print(other_row)
-        for column in columns:
-            epa.loc[row,column] = other_row[column][other_row.index[0]]
+        epa[column] = matched[column].fillna(-1).values
+    print("Matched {} of {} rows to modis files, {} missing set to -1".format(len(epa) - num_missing, len(epa), num_missing))
     return epa
     #epa.to_csv("master_epa.csv",index=False)
     
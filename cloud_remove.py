@@ -6,13 +6,20 @@ import utils
 import sys
 import matplotlib.pyplot as plt
 from pandarallel import pandarallel
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
 
 YEAR = '2016'
+CLOUDY_PIXEL_THRESHOLD = 30000
+STATS_COLUMNS = utils.SENTINEL_STATS_COLUMNS
+CLOUD_FRACTION_COLUMN = 'Cloud Fraction'
 
 def resave_master_csv_single_year(master_csv):
     
-    df = pd.read_csv(master_csv) # train_csv / val_csv / test_csv
-    df = df.drop(columns=['Unnamed: 0', 'Unnamed: 0.1'])
+    df = utils.read_table(master_csv) # train_csv / val_csv / test_csv
+    df = df.drop(columns=['Unnamed: 0', 'Unnamed: 0.1'], errors='ignore')
     dates = pd.to_datetime(df['Date'])
     df['year'] = pd.DatetimeIndex(df['Date']).year
     df_2016 = df[df['year']==2016]
@@ -26,10 +33,10 @@ def resave_master_csv_single_year(master_csv):
 
 def resave_mini(master_csv, save_to, num_examples):
 
-    df = pd.read_csv(master_csv) 
-    df = df.drop(columns=['Unnamed: 0'])#, 'Unnamed: 0.1'])
+    df = utils.read_table(master_csv) 
+    df = df.drop(columns=['Unnamed: 0'], errors='ignore')#, 'Unnamed: 0.1'])
     df = df.sample(n=num_examples)
-    df.to_csv(save_to)
+    utils.save_table(df, save_to)
 
 def get_means_row(row):
     npy_filename = str(row["SENTINEL_FILENAME"])
@@ -68,6 +75,23 @@ def get_stdvs_row(row):
     stdvs = np.std(image, axis = (0,1))
     return stdvs
 
+def get_stats_row(row, include_cloud_fraction=False):
+    '''
+    Loads the row's Sentinel image once and returns all per-band statistics 
+    together as a float32 array of the 13 means, mins, maxes and stdvs (in
+    the order of STATS_COLUMNS), followed by the fraction of cloudy pixels if
+    include_cloud_fraction is True.
+    '''
+    npy_filename = str(row["SENTINEL_FILENAME"])
+    npy_fullpath = os.path.join(utils.SENTINEL_FOLDER, YEAR, npy_filename)
+    image = np.load(npy_fullpath).astype(np.int16)
+    stats = [np.mean(image, axis = (0,1)), np.min(image, axis = (0,1)),
+             np.max(image, axis = (0,1)), np.std(image, axis = (0,1))]
+    if include_cloud_fraction:
+        num_pixels = image.shape[0] * image.shape[1]
+        stats.append([count_cloudy_pixels(image) / num_pixels])
+    return np.concatenate(stats).astype(np.float32)
+
 def check_is_cloudy_row(row, threshold=4000):
 
     npy_filename = str(row["SENTINEL_FILENAME"])
@@ -94,13 +118,13 @@ def remove_sent_over_threshold(master_csv_year, to_threshold_csv, threshold=3000
     '''
     pandarallel.initialize(progress_bar=True)
     
-    df = pd.read_csv(master_csv_year, index_col=0)
+    df = utils.read_table(master_csv_year, index_col=0)
     initial_len = len(df)
     is_cloudy = df.parallel_apply(check_is_cloudy_row, threshold=threshold, axis=1)
     df['Is cloudy'] = is_cloudy
     cloudy_df = df[df['Is cloudy'] == True]
     clear_df = df[df['Is cloudy'] == False]
-    clear_df.to_csv(to_threshold_csv)
+    utils.save_table(clear_df, to_threshold_csv)
     clear_df_len = len(clear_df)
     
     print("Thresholded {} file at {} + used Decision Tree. \nInitial df was {} rows. Thresholded df is {} rows.".format(
@@ -116,7 +140,7 @@ def normalize(arr):
 def display_sample_images(thresholded_csv):
     
     # Get random sample of 5 images from csv
-    df = pd.read_csv(thresholded_csv)#, index_col=0)
+    df = utils.read_table(thresholded_csv)#, index_col=0)
     df = df.sample(n=100)
 
     # Get corresponding .npy files
@@ -180,7 +204,7 @@ def save_stats(original_csv, csv_with_stats):
     Resaves df with stats over bands
     '''
     pandarallel.initialize(progress_bar=True)
-    df = pd.read_csv(original_csv, index_col=0)
+    df = utils.read_table(original_csv, index_col=0)
     means = df.parallel_apply(get_means_row, axis=1) 
     mins = df.parallel_apply(get_mins_row, axis=1)  
     maxes = df.parallel_apply(get_maxes_row, axis=1) 
@@ -193,6 +217,32 @@ def save_stats(original_csv, csv_with_stats):
     df.to_csv(csv_with_stats)
     
     
+def save_stats_columns(original_csv, csv_with_stats, include_cloud_fraction=False, stats_npz=None):
+    '''
+    Single-pass version of save_stats. Loads each image once, computes all
+    per-band stats together and resaves the df with them as 52 numeric 
+    float32 columns (STATS_COLUMNS), plus a 'Cloud Fraction' column if 
+    include_cloud_fraction is True.
+    
+    If stats_npz is given, the stats array is also saved there together with
+    the df index under the keys 'stats' and 'index'. It has shape (N, 52), or
+    (N, 53) with 'Cloud Fraction' as the last column if include_cloud_fraction
+    is True.
+    '''
+    pandarallel.initialize(progress_bar=True)
+    df = utils.read_table(original_csv, index_col=0)
+    stats = df.parallel_apply(get_stats_row, include_cloud_fraction=include_cloud_fraction, axis=1)
+    stats = np.stack(stats.values).astype(np.float32)
+    
+    columns = STATS_COLUMNS + ([CLOUD_FRACTION_COLUMN] if include_cloud_fraction else [])
+    stats_df = pd.DataFrame(stats, index=df.index, columns=columns)
+    df = pd.concat([df.drop(columns=columns, errors='ignore'), stats_df], axis=1)
+    utils.save_table(df, csv_with_stats)
+    
+    if stats_npz is not None:
+        np.savez(stats_npz, index=df.index.values, stats=stats)
+    
+    
 
 def DecisionTree(image, filename):
     '''
@@ -204,20 +254,11 @@ def DecisionTree(image, filename):
     '''
     # 0    1      7    8   9    10   11   12
     # B1, B2, ... B8, B8A, B9, B10, B11, B12
-    is_cloudy = False
-    image = image/1000.
-    im_w = image.shape[0]
-    num_cloudy_pixels = 0
-    
-    for i in range(0, im_w):
-        for j in range(0, im_w):
-            is_cloudy_pixel = classify_pixel(image[i,j])
-            if is_cloudy_pixel:
-                num_cloudy_pixels += 1
+    num_cloudy_pixels = count_cloudy_pixels(image)
 
     ## print("Number of cloudy pixels in image {}: {}/40000".format(filename, num_cloudy_pixels))
 
-    is_cloudy = True if num_cloudy_pixels > 30000 else False
+    is_cloudy = True if num_cloudy_pixels > CLOUDY_PIXEL_THRESHOLD else False
     return is_cloudy
     
     
@@ -254,18 +295,74 @@ def classify_pixel(pixel):
     return is_cloudy
 
 
+def classify_pixels(image):
+    '''
+    Vectorized version of classify_pixel. Evaluates the decision tree as boolean
+    masks over an image (H x W x 13) or a batch of images (N x H x W x 13) of raw
+    Sentinel values, and returns a boolean mask of cloudy pixels with the 
+    band axis removed. Gives exactly the same result as calling classify_pixel 
+    on every pixel of image/1000.
+    '''
+    # Scale only the bands the tree looks at, same float64 division as before
+    b3, b4, b7, b9, b11, b12 = np.moveaxis(image[..., [2, 3, 6, 8, 10, 11]] / 1000., -1, 0)
+    
+    # Each "else" branch is written as not(<) rather than >= so NaNs follow the same path
+    cirrus_low = ~(b9 < 0.166) & ~(b11 < 0.011)
+    cloud_high = np.where(b12 < 0.267, b4 < 0.674, b7 < 1.544)
+    return np.where(b3 < 0.325, cirrus_low, cloud_high)
+
+
+if numba is not None:
+    @numba.njit(parallel=True)
+    def _count_cloudy_pixels_numba(images):
+        '''
+        Compiled kernel for count_cloudy_pixels on a batch (N x H x W x 13).
+        '''
+        counts = np.zeros(images.shape[0], dtype=np.int64)
+        for n in numba.prange(images.shape[0]):
+            count = 0
+            for i in range(images.shape[1]):
+                for j in range(images.shape[2]):
+                    pixel = images[n, i, j]
+                    if pixel[2] / 1000. < 0.325:
+                        if not pixel[8] / 1000. < 0.166 and not pixel[10] / 1000. < 0.011:
+                            count += 1
+                    elif pixel[11] / 1000. < 0.267:
+                        if pixel[3] / 1000. < 0.674:
+                            count += 1
+                    elif pixel[6] / 1000. < 1.544:
+                        count += 1
+            counts[n] = count
+        return counts
+
+
+def count_cloudy_pixels(images, use_numba=False):
+    '''
+    Counts the cloudy pixels (see classify_pixel) of an image (H x W x 13), 
+    returning an int, or of a batch of images (N x H x W x 13), returning an
+    array of N counts. If use_numba is True and numba is installed, a batch
+    is counted with a compiled kernel instead of NumPy masks.
+    '''
+    images = np.asarray(images)
+    if images.ndim == 3:
+        return int(count_cloudy_pixels(images[np.newaxis], use_numba)[0])
+    if use_numba and numba is not None:
+        return _count_cloudy_pixels_numba(np.ascontiguousarray(images))
+    return classify_pixels(images).sum(axis=(1, 2))
+
+
 def split(data_csv):
     '''
     Splits a given dataframe from data_csv into two.
     '''
-    df = pd.read_csv(t, index_col=0)
+    df = utils.read_table(data_csv, index_col=0)
     df = df.sample(frac=1)
     dflen = len(df)
     df1 = df.head(dflen//2)
     df2 = df.tail(dflen//2)
     base_fp = data_csv[:-4] 
-    df1.to_csv(base_fp + "_split1.csv")
-    df2.to_csv(base_fp + "_split2.csv")
+    utils.save_table(df1, base_fp + "_split1.csv")
+    utils.save_table(df2, base_fp + "_split2.csv")
     
 
 if __name__ == "__main__":
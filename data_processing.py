@@ -2,12 +2,16 @@ import os
 import numpy as np
 import pandas as pd
 import ast
+import csv
+import time
 import utils
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import sys
-from pandarallel import pandarallel
-from add_column import add_columns_to_master_modis
-from dataloader import split_data_by_site
+from add_column import add_columns_to_master_modis, epa_to_file_names
+from dataloader import split_data_by_site, append_to_site_splits, site_split_path, SITE_SPLITS
+import epa_to_ghcnd_weather
+from sentinel_store import pack_all_sentinel_years
+from pipeline import Stage, Pipeline
 
 try:
     import read_tiff
@@ -17,6 +21,18 @@ except ModuleNotFoundError:
 SENTINEL_CROP_SIZE = 200
 NUM_FOLDER_THREADS = 2
 NUM_SAVING_THREADS = 10
+NPY_MANIFEST_FILENAME = "npy_manifest.csv"
+NPY_MANIFEST_COLUMNS = ["Filename", "Size", "Mtime", "Num Measurements"]
+SENTINEL_METADATA_INDEX_FILENAME = "sentinel_metadata_index.parquet"
+SENTINEL_METADATA_INDEX_COLUMNS = ["File Base", "Year", "Month", "Site ID", "Dates",
+                                   "Num Bands", "Num npy", "Metadata Mtime"]
+EPA_SENTINEL_FILENAME = "epa_sentinel.csv"
+WEATHER_FILENAME = "master_csv_2016_2017.csv"
+MODIS_FILENAME = "modis.csv"
+PRISM_FILENAME = "prism_{}.csv"
+# Width of the center of the MODIS images kept in the MODIS table (see utils.MODIS_COLUMNS)
+MODIS_CENTER_SIZE = 2
+PIPELINE_STATE_FILENAME = "pipeline_state.json"
 EXCLUDED_YEARS = [2018, 2019]
 
 def save_sentinel_tif_to_npy(tif_file_path):
@@ -29,6 +45,11 @@ def save_sentinel_tif_to_npy(tif_file_path):
     ----------
     tif_file_path : str
         Absolute path to the .tif file to read in and save to .npy files.
+
+    Returns
+    -------
+    num_measurements : int
+        Number of .npy images saved from the .tif file.
     """
     dir_path = os.path.dirname(tif_file_path)
     filename = os.path.basename(tif_file_path)
@@ -43,6 +64,7 @@ def save_sentinel_tif_to_npy(tif_file_path):
         save_name = os.path.splitext(filename)[0] +  "_{}.npy".format(measurement)
         save_path = os.path.join(dir_path, save_name)
         np.save(save_path, image)
+    return num_measurements
 
 def save_sentinel_npy(folder_path, num_threads=1):
     """
@@ -87,6 +109,147 @@ def save_all_sentinel_npy(sentinel_folder_path, num_folder_threads=1,
                 continue
             executor.submit(save_sentinel_npy, directory, num_saving_threads)
 
+def load_npy_manifest(folder_path):
+    """
+    Loads the manifest of .tif files in a Sentinel folder that have already
+    been converted to .npy files by save_sentinel_npy_parallel.
+
+    Parameters
+    ----------
+    folder_path : str
+        Absolute path to the folder storing .tif files.
+
+    Returns
+    -------
+    manifest : dict
+        dict mapping .tif filename -> (size, mtime, number of .npy images).
+        Later entries for the same file override earlier ones.
+    """
+    manifest = {}
+    manifest_path = os.path.join(folder_path, NPY_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as manifest_file:
+        for row in csv.DictReader(manifest_file):
+            manifest[row["Filename"]] = (int(row["Size"]), float(row["Mtime"]), 
+                                         int(row["Num Measurements"]))
+    return manifest
+
+def is_converted(tif_file_path, manifest, npy_filenames):
+    """
+    Checks whether a .tif file is recorded in the manifest with its current
+    size and modification time, and all of its .npy images exist.
+
+    Parameters
+    ----------
+    tif_file_path : str
+        Absolute path to the .tif file.
+    manifest : dict
+        Manifest loaded by load_npy_manifest.
+    npy_filenames : set[str]
+        Filenames of the .npy files present in the folder.
+    """
+    filename = os.path.basename(tif_file_path)
+    if filename not in manifest:
+        return False
+    size, mtime, num_measurements = manifest[filename]
+    stat = os.stat(tif_file_path)
+    if stat.st_size != size or stat.st_mtime != mtime:
+        return False
+    file_base = os.path.splitext(filename)[0]
+    return all("{}_{}.npy".format(file_base, measurement) in npy_filenames 
+               for measurement in range(num_measurements))
+
+def save_sentinel_npy_parallel(folder_path, executor):
+    """
+    Converts all .tif files in the specified Sentinel folder to .npy arrays
+    using a process pool, skipping files the folder's manifest records as
+    already converted. Each converted file is appended to the manifest as soon
+    as it finishes, so an interrupted run resumes where it stopped. Failures
+    are reported instead of being dropped.
+
+    Parameters
+    ----------
+    folder_path : str
+        Absolute path to the folder storing .tif files.
+    executor : concurrent.futures.ProcessPoolExecutor
+        Pool used to run save_sentinel_tif_to_npy.
+
+    Returns
+    -------
+    failures : dict
+        dict mapping .tif filename -> error message for failed conversions.
+    """
+    start = time.time()
+    manifest = load_npy_manifest(folder_path)
+    filenames = os.listdir(folder_path)
+    npy_filenames = set(f for f in filenames if f.endswith(".npy"))
+    tif_file_paths = [os.path.join(folder_path, f) for f in filenames
+                      if f.startswith("s2") and os.path.splitext(f)[1] == ".tif"]
+    to_convert = [path for path in tif_file_paths if not is_converted(path, manifest, npy_filenames)]
+    num_skipped = len(tif_file_paths) - len(to_convert)
+    print("{}: converting {} .tif files, skipping {} already converted".format(folder_path, len(to_convert), 
+                                                                               num_skipped))
+    
+    manifest_path = os.path.join(folder_path, NPY_MANIFEST_FILENAME)
+    write_header = not os.path.exists(manifest_path)
+    num_converted, num_images = 0, 0
+    failures = {}
+    with open(manifest_path, 'a') as manifest_file:
+        writer = csv.writer(manifest_file)
+        if write_header:
+            writer.writerow(NPY_MANIFEST_COLUMNS)
+        futures = {executor.submit(save_sentinel_tif_to_npy, path) : path for path in to_convert}
+        for future in as_completed(futures):
+            tif_file_path = futures[future]
+            filename = os.path.basename(tif_file_path)
+            try:
+                num_measurements = future.result()
+            except Exception as exc:
+                failures[filename] = repr(exc)
+                print("Failed to convert {}: {!r}".format(tif_file_path, exc))
+                continue
+            stat = os.stat(tif_file_path)
+            writer.writerow([filename, stat.st_size, stat.st_mtime, num_measurements])
+            manifest_file.flush()
+            num_converted += 1
+            num_images += num_measurements
+            
+    elapsed = time.time() - start
+    print("{}: converted {} files ({} images) in {:.1f}s ({:.2f} files/s, {:.2f} images/s), "
+          "skipped {}, failed {}".format(folder_path, num_converted, num_images, elapsed, 
+                                         num_converted / max(elapsed, 1e-6), 
+                                         num_images / max(elapsed, 1e-6), num_skipped, len(failures)))
+    for filename, error in failures.items():
+        print("  {}: {}".format(filename, error))
+    return failures
+
+def save_all_sentinel_npy_parallel(sentinel_folder_path, num_processes=None):
+    """
+    Process-pool, resumable version of save_all_sentinel_npy. Loops through
+    all the directories in the Sentinel data folder and converts the .tif
+    files in each to .npy arrays with save_sentinel_npy_parallel.
+    
+    Parameters
+    ----------
+    sentinel_folder_path : str
+        Absolute path to the Sentinel data folder
+    num_processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    failures : dict
+        dict mapping directory -> {.tif filename -> error message}.
+    """
+    failures = {}
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for directory in utils.get_directory_paths(sentinel_folder_path):
+            if directory.endswith("2018") or directory.endswith("Metadata"):
+                continue
+            failures[directory] = save_sentinel_npy_parallel(directory, executor)
+    return failures
+
 def rename_sentinel_files(folder_path):
     """
     Loads all Sentinel 2 files (.tif or .txt files starting with "s2") in
@@ -179,22 +342,107 @@ def get_sentinel_dates(metadata_file_path):
     dates : list[numpy.datetime64]
         List of dates stored in the metadata file.
     """
-    metadata_file = open(metadata_file_path)
-    dates = []
-    band_no = 1 # Keep track of band number, should be blocks of 13 bands
-    for channel in ast.literal_eval(metadata_file.readline()):
-        date = pd.to_datetime(channel.split("_")[1], yearfirst=True)
-        seen_dates = set()
-        # Only save date if first band
-        if band_no == 14:
-            band_no = 1
-        if band_no == 1:
-            dates.append(date)
-            seen_dates.add(date)
-        band_no += 1
-            
-    metadata_file.close()
-    return dates
+    dates, _ = read_sentinel_metadata(metadata_file_path)
+    return list(dates)
+
+def read_sentinel_metadata(metadata_file_path):
+    """
+    Reads a Sentinel metadata file, which lists the channels of the image as
+    blocks of 13 bands (one block per acquisition).
+
+    Parameters
+    ----------
+    metadata_file_path : str
+        Path to the Sentinel metadata file storing image information.
+
+    Returns
+    -------
+    dates : pandas.DatetimeIndex
+        Date of each acquisition, taken from the first band of each block.
+    num_bands : int
+        Total number of channels listed by the metadata file.
+    """
+    with open(metadata_file_path) as metadata_file:
+        channels = ast.literal_eval(metadata_file.readline())
+    dates = pd.to_datetime([channel.split("_")[1] for channel in channels[::utils.NUM_SENTINEL_BANDS]],
+                           yearfirst=True)
+    return dates, len(channels)
+
+def build_sentinel_metadata_index(metadata_folder_path, sentinel_folder_path, index_path):
+    """
+    Builds the Sentinel metadata index, with one row per metadata file
+    storing its file base, year, month, site, acquisition dates, number of
+    bands and number of matching .npy images, and saves it as a Parquet file.
+
+    The index is rebuilt incrementally: only metadata files that are new or
+    whose modification time changed since the saved index are parsed again,
+    and rows of deleted metadata files are dropped. The .npy counts are always
+    refreshed from a single listing of the Sentinel folders.
+
+    Parameters
+    ----------
+    metadata_folder_path : str
+        Path to the Sentinel metadata folder from which to read metadata files.
+    sentinel_folder_path : str
+        Full path to the folder storing Sentinel .npy files for each year.
+    index_path : str
+        Path of the Parquet file storing the index.
+
+    Returns
+    -------
+    index_df : pandas.DataFrame
+        The metadata index, with columns SENTINEL_METADATA_INDEX_COLUMNS.
+    """
+    cached = {}
+    if os.path.exists(index_path):
+        cached_df = pd.read_parquet(index_path)
+        cached = {row["File Base"]: row for row in cached_df.to_dict("records")}
+
+    npy_counts = {}
+    for filenames in list_sentinel_npy_files(sentinel_folder_path).values():
+        for filename in filenames:
+            filename_base = filename.rsplit("_", 1)[0]
+            npy_counts[filename_base] = npy_counts.get(filename_base, 0) + 1
+
+    rows = []
+    num_parsed = 0
+    for filename in sorted(os.listdir(metadata_folder_path)):
+        file_base, file_extension = os.path.splitext(filename)
+        if not filename.startswith("s2") or file_extension != ".txt":
+            continue
+        mtime = os.path.getmtime(os.path.join(metadata_folder_path, filename))
+        cached_row = cached.get(file_base)
+        if cached_row is not None and cached_row["Metadata Mtime"] == mtime:
+            dates, num_bands = cached_row["Dates"], cached_row["Num Bands"]
+        else:
+            dates, num_bands = read_sentinel_metadata(os.path.join(metadata_folder_path, filename))
+            dates = dates.values
+            num_parsed += 1
+        _, year, month, site_id = file_base.split("_", 3)
+        rows.append((file_base, int(year), int(month), site_id, dates, num_bands,
+                     npy_counts.get(file_base, 0), mtime))
+
+    index_df = pd.DataFrame(rows, columns=SENTINEL_METADATA_INDEX_COLUMNS)
+    print("Parsed {} new or modified metadata files, reused {}".format(num_parsed, len(rows) - num_parsed))
+    index_dir = os.path.dirname(index_path)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    index_df.to_parquet(index_path, index=False)
+    return index_df
+
+def load_sentinel_metadata_index(metadata_folder_path, sentinel_folder_path,
+                                 index_path=None):
+    """
+    Updates (see build_sentinel_metadata_index) and loads the Sentinel
+    metadata index, and returns the dictionary mapping from the metadata file
+    name to the dates of the images in that file, as load_sentinel_dates does.
+    By default the index is stored in the processed data folder.
+    """
+    if index_path is None:
+        index_path = os.path.join(utils.PROCESSED_DATA_FOLDER, SENTINEL_METADATA_INDEX_FILENAME)
+    index_df = build_sentinel_metadata_index(metadata_folder_path, sentinel_folder_path, index_path)
+    return {file_base: list(pd.to_datetime(dates))
+            for file_base, dates in zip(index_df["File Base"], index_df["Dates"])}
 
 def find_closest_sentinel_index(epa_date, sentinel_dates):
     """
@@ -233,56 +481,63 @@ def find_closest_sentinel_index(epa_date, sentinel_dates):
     return closest_index, days_diff
 
 
-def get_num_npy_images_for_file(sent_folder_path, filename_base):
+def list_sentinel_npy_files(sentinel_folder_path):
     """
-    Scans directory of sentinel .npy images
-    and counts up number .npy images for the given filename.
+    Lists the Sentinel .npy images of every year folder once.
 
-    e.g. for the filename: s2_2016_10_60031001 -> if have images
-          s2_2016_10_60031001_0.npy, ..., s2_2016_10_60031001_7.npy, 
-          returns 8 
+    Parameters
+    ----------
+    sentinel_folder_path : str
+        Full path to the folder storing Sentinel .npy files for each year.
+
+    Returns
+    -------
+    npy_files : dict
+        dict mapping year (str) -> set of .npy filenames in that year's folder.
     """
-    num_images = 0
-    files = [f for f in os.listdir(sent_folder_path)]
-    for file in files:
-        if filename_base in file:
-            num_images += 1
-    return num_images
+    npy_files = {}
+    for year in os.listdir(sentinel_folder_path):
+        year_folder = os.path.join(sentinel_folder_path, year)
+        if not os.path.isdir(year_folder):
+            continue
+        npy_files[year] = set(f for f in os.listdir(year_folder)
+                              if f.startswith("s2") and f.endswith(".npy"))
+    return npy_files
 
 
-def compare_npy_size_to_num_metadata_readings(dates, sentinel_folder_path, filename_base, year):
+def closest_sentinel_images(sentinel_dates, epa_dates):
     """
-    Compares the channel dimension of the converted image 
-    to the number of metadata readings for that file.
-    These should match. 
-    Use to determine if should throw out a datapoint or not.
-    Returns True if the dimensions match as expected, False otherwise.
-    
+    Finds the closest Sentinel image (by date) to each EPA measurement date
+    with a binary search over the sorted image dates. Ties go to the earlier
+    image in the file, as in find_closest_sentinel_index.
+
     Parameters
     ----------
-    dates: list
-        a list of dates corresponding to the Metadata file that dates 
-        each measurement. One date for each set of 13 band measurements.
-        i.e.  len(dates) = # measurements
-    sentinel_folder_path : str
-        Full path to the folder storing Sentinel .npy files for each year.
-    filename_base : str
-        The base filename of the .npy sentinel image, e.g. s2_2016_10_60031001
-    year : str
-        Year (2016 or 2017)
+    sentinel_dates : list[numpy.datetime64]
+        Dates of the images of a Sentinel file, in file order (not empty).
+    epa_dates : numpy.ndarray
+        datetime64[ns] dates of the EPA measurements.
+
+    Returns
+    -------
+    closest_indices : numpy.ndarray
+        Index of the closest image within the Sentinel file, for every date.
+    days_diffs : numpy.ndarray
+        Number of days between every date and its closest image.
     """
-    
-    sentinel_folder_path_year = os.path.join(sentinel_folder_path, year)
-    
-    num_image_measurements = get_num_npy_images_for_file(sentinel_folder_path_year, filename_base)
-    num_metadata_measurements = len(dates)
+    # Sorted unique dates, keeping the index of the first image taken on each date
+    unique_dates, first_indices = np.unique(np.array(sentinel_dates, dtype="datetime64[ns]"), return_index=True)
+    right = np.clip(np.searchsorted(unique_dates, epa_dates), 0, len(unique_dates) - 1)
+    left = np.clip(right - 1, 0, len(unique_dates) - 1)
+    left_diff = np.abs(epa_dates - unique_dates[left])
+    right_diff = np.abs(unique_dates[right] - epa_dates)
+    use_right = (right_diff < left_diff) | ((right_diff == left_diff) &
+                                           (first_indices[right] < first_indices[left]))
+    closest_indices = first_indices[np.where(use_right, right, left)]
+    min_diffs = np.where(use_right, right_diff, left_diff)
+    return closest_indices, min_diffs // np.timedelta64(1, "D")
 
-    if num_metadata_measurements != num_image_measurements:
-        return False, num_image_measurements, num_metadata_measurements
-    else:
-        return True, num_image_measurements, num_metadata_measurements
 
-              
 def add_sentinel_info(row, metadata_folder_path, sentinel_folder_path,
                       sentinel_dates, year='2016'):
     """
@@ -292,65 +547,125 @@ def add_sentinel_info(row, metadata_folder_path, sentinel_folder_path,
     Sentinel file. If a Sentinel file does not exist for the (station ID, date)
     combination stored in the row, nothing is changed.
 
+    Per-row version of add_sentinel_info_batch (e.g. for DataFrame.apply),
+    which should be preferred for whole DataFrames as it lists the .npy
+    images only once.
+
     Parameters
     ----------
     row : pandas.Series
         Row from a DataFrame storing EPA measurements.
     metadata_folder_path : str
         Full path to the Sentinel metadata folder
+    sentinel_folder_path : str
+        Full path to the folder storing Sentinel .npy files for each year.
     sentinel_dates : dict
         Dictionary mapping from Sentinel metadata filename to the dates of the
         images stored in that file.
-    sentinel_folder_path : str
-        Full path to the folder storing Sentinel .npy files for each year.
     year : str 
         Year for given data (2016 or 2017)
+
     Returns
     -------
     row : pandas.Series
         The row with SENTINEL_FILENAME and SENTINEL_INDEX potentially modified.
     """
-    
     sentinel_filename = epa_row_to_sentinel_filename(row)
-    metadata_filename = sentinel_filename + ".txt"
-    metadata_file_path = os.path.join(metadata_folder_path, metadata_filename)
-    if not os.path.exists(metadata_file_path):
-        #print("Couldn't find metadata file {}".format(metadata_file_path))
-        return row
-        
-    if sentinel_filename not in sentinel_dates:
+    metadata_file_path = os.path.join(metadata_folder_path, sentinel_filename + ".txt")
+    if not os.path.exists(metadata_file_path) or sentinel_filename not in sentinel_dates:
         return row
     
-    epa_date = pd.to_datetime(row.Date)        
+    # Make sure # of measurements from metadata file match the # of .npy images
     dates = sentinel_dates[sentinel_filename]
-          
-    # Make sure # of measurements from metadata file match the # in the original .tif file
-    same_num, num_im, num_meta = compare_npy_size_to_num_metadata_readings(dates, sentinel_folder_path, sentinel_filename, year)
-    
-    if same_num == False:
-        #print("Num measurement mismatch for file {} : {} metadata measurements, {} .tif measurements"
-        #      .format(sentinel_filename, num_meta, num_im))
-        return row
-    
-    closest_index, days_diff = find_closest_sentinel_index(epa_date, dates)
-    if closest_index == None or days_diff == None:
+    num_images = sum(1 for f in os.listdir(os.path.join(sentinel_folder_path, year))
+                     if f.startswith(sentinel_filename + "_") and f.endswith(".npy"))
+    if len(dates) == 0 or num_images != len(dates):
         return row
     
+    epa_date = pd.to_datetime(row.Date)
+    closest_indices, days_diffs = closest_sentinel_images(dates, np.array([epa_date], dtype="datetime64[ns]"))
+    closest_index = int(closest_indices[0])
     sentinel_filename += "_{}.npy".format(closest_index)
-    year = epa_date.year
-    sentinel_file_path = os.path.join(sentinel_folder_path, str(year), sentinel_filename)
-  
-    if not os.path.exists(sentinel_file_path):
-        #print("Couldn't find sentinel .npy file {}".format(sentinel_file_path))
+    if not os.path.exists(os.path.join(sentinel_folder_path, str(epa_date.year), sentinel_filename)):
         return row
     
-    print("Update successful for image {}".format(sentinel_filename))
-    row['PM Reading/Image day difference'] = days_diff
+    row['PM Reading/Image day difference'] = days_diffs[0]
     row.SENTINEL_FILENAME = sentinel_filename
     row.SENTINEL_INDEX = closest_index
-    #print(row)
     return row
 
+
+def add_sentinel_info_batch(epa_df, sentinel_folder_path, sentinel_dates):
+    """
+    For every EPA measurement, finds the closest Sentinel image (by date) of
+    the Sentinel file matching its station ID and month, and adds its
+    filename, its index within the Sentinel file and the number of days
+    between the measurement and the image. Measurements are matched per
+    Sentinel file with a binary search over its sorted dates.
+
+    A measurement is left unmatched (empty filename, index -1) if there is
+    no metadata for its Sentinel file, if the number of .npy images of the
+    file does not match the number of metadata dates, or if the closest
+    .npy image does not exist.
+
+    Parameters
+    ----------
+    epa_df : pandas.DataFrame
+        DataFrame storing EPA measurements.
+    sentinel_folder_path : str
+        Full path to the folder storing Sentinel .npy files for each year.
+    sentinel_dates : dict
+        Dictionary mapping from Sentinel metadata filename to the dates of the
+        images stored in that file (see load_sentinel_dates).
+
+    Returns
+    -------
+    epa_df : pandas.DataFrame
+        Copy of epa_df with the SENTINEL_FILENAME, SENTINEL_INDEX and
+        'PM Reading/Image day difference' columns set.
+    """
+    epa_df = epa_df.copy()
+    epa_dates = pd.to_datetime(epa_df["Date"])
+    years = epa_dates.dt.year.astype(str)
+    filename_bases = ("s2_" + years + "_" + epa_dates.dt.month.astype(str) + "_" +
+                      epa_df["Site ID"].astype(str)).values
+    epa_dates = epa_dates.values.astype("datetime64[ns]")
+    years = years.values
+
+    npy_files = list_sentinel_npy_files(sentinel_folder_path)
+    npy_counts = {}
+    for year, filenames in npy_files.items():
+        for filename in filenames:
+            filename_base = filename.rsplit("_", 1)[0]
+            npy_counts[filename_base] = npy_counts.get(filename_base, 0) + 1
+
+    sentinel_filenames = np.full(len(epa_df), "", dtype=object)
+    sentinel_indices = np.full(len(epa_df), -1, dtype=np.int64)
+    days_diffs = np.full(len(epa_df), np.nan)
+    for filename_base, rows in pd.Series(filename_bases).groupby(filename_bases).indices.items():
+        if filename_base not in sentinel_dates:
+            continue
+        dates = sentinel_dates[filename_base]
+        # Make sure # of measurements from metadata file match the # of .npy images
+        if len(dates) == 0 or npy_counts.get(filename_base, 0) != len(dates):
+            continue
+
+        closest_indices, row_days_diffs = closest_sentinel_images(dates, epa_dates[rows])
+        year_npy_files = npy_files.get(years[rows[0]], set())
+        for row, closest_index, days_diff in zip(rows, closest_indices, row_days_diffs):
+            sentinel_filename = "{}_{}.npy".format(filename_base, closest_index)
+            if sentinel_filename not in year_npy_files:
+                continue
+            sentinel_filenames[row] = sentinel_filename
+            sentinel_indices[row] = closest_index
+            days_diffs[row] = days_diff
+
+    epa_df["SENTINEL_FILENAME"] = sentinel_filenames
+    epa_df["SENTINEL_INDEX"] = sentinel_indices
+    epa_df["PM Reading/Image day difference"] = days_diffs
+    print("Matched {}/{} measurements to Sentinel images".format((sentinel_indices >= 0).sum(), len(epa_df)))
+    return epa_df
+
 def load_sentinel_dates(metadata_folder_path):
     """
     Loads all Sentinel metadata files from the specified folder and creates a
@@ -379,118 +694,278 @@ def load_sentinel_dates(metadata_folder_path):
         file_to_dates_map[file_base] = dates
     return file_to_dates_map
 
-def prism_column_to_date(column_name):
+def prism_columns_to_dates(column_names):
     """
-    Takes a PRISM column name which represents a daily measurement and extracts
-    the date in Month/Day/Year format.
+    Takes the PRISM column names which represent daily measurements and extracts
+    their dates, all at once.
     
     Parameters
     ----------
-    column_name : str
-        Name of the PRISM column.
+    column_names : list[str]
+        Names of the PRISM columns, e.g. PRISM_ppt_stable_4kmD2_20160101_bil.
         
     Returns
     -------
-    date : str
-        Date extracted from the column name in Month/Day/Year format.
+    dates : pandas.DatetimeIndex
+        Dates extracted from the column names.
     """
-    name_parts = column_name.split("_")
-    date = pd.to_datetime(name_parts[4])
-    return "/".join(map(str, (date.month, date.day, date.year)))
+    return pd.to_datetime(pd.Index(column_names).str.split("_").str[4])
 
-def add_prism_df(prism_file_path, df_by_year, year, element):
+def read_prism_file(prism_file_path, element):
     """
-    Reads in the specified .csv file into a pandas.DataFrame, transposes the
-    DataFrame so that there is a daily measurement for each row, and then
-    joins the DataFrame to the aggregated yearly one.
+    Reads in the specified .csv file and flattens it to one row per daily
+    measurement of a station.
     
     Parameters
     ----------
     prism_file_path : str
         Absolute path to the PRISM .csv file.
-    df_by_year : dict from str -> pandas.DataFrame
-        Stores a DataFrame of measurements for each year.
-    year : str
-        Year of the file.
     element : str
         Type of measurement this file stores (ppt, tdmean, tmean)
+        
+    Returns
+    -------
+    melted : pandas.DataFrame
+        The measurements, with columns Site ID, Date, Element and Value.
     """
     df = pd.read_csv(prism_file_path)
     day_columns = df.columns[4:-2] # each column is a daily measurement
-    rename_map = { day : prism_column_to_date(day) for day in day_columns }
-    df.rename(columns = rename_map, inplace=True) # rename columns to dates
-    df.rename(columns = {"station_id" : "Site ID"}, inplace=True)
-    melted = df.melt(id_vars = ["Site ID"], value_vars = rename_map.values(),
-                     var_name = "Date", value_name = element) # transpose
-    melted["Date"] = pd.to_datetime(melted["Date"])
-    if year not in df_by_year:
-        merged = melted # first DataFrame we've seen for this year
-    else:
-        yearly_df = df_by_year[year]
-        merged = yearly_df.merge(melted, on = ["Site ID", "Date"], how = "outer")
-    df_by_year[year] = merged
-
-def gather_prism_data(prism_folder_path):
-    """
-    Aggregates the .csv files in the folder into a pandas.DataFrame that stores
-    the daily measurements (dew point, measurement, and precipitation) for each
-    station.
+    dates = prism_columns_to_dates(day_columns)
+    return pd.DataFrame({"Site ID": np.repeat(df["station_id"].values, len(day_columns)),
+                         "Date": np.tile(dates.values, len(df)),
+                         "Element": element,
+                         "Value": df[day_columns].to_numpy().ravel()})
+
+def gather_prism_data(prism_folder_path, save_folder = None):
+    """
+    Aggregates the .csv files in the folder into a pandas.DataFrame per year that 
+    stores the daily measurements (dew point, measurement, and precipitation) for 
+    each station. All files are flattened and concatenated once, then pivoted to
+    one column per element.
     
     Parameters
     ----------
     prism_folder_path : str
         Absolute path to the folder storing PRISM .csv files.
+    save_folder : str
+        If given, each yearly DataFrame is saved there as a Parquet table 
+        (see PRISM_FILENAME and utils.save_table).
         
     Returns
     -------
-    prism_df : pandas.DataFrame
-        The aggregated DataFrame.
+    df_by_year : dict from str -> pandas.DataFrame
+        The aggregated DataFrame of each year, with columns Site ID, Date and
+        one column per element.
     """
-    df_by_year = {}
-    for filename in os.listdir(prism_folder_path):
+    melted_dfs = []
+    for filename in sorted(os.listdir(prism_folder_path)):
         if not filename.endswith(".csv"):
             continue
         file_base = os.path.splitext(filename)[0]
         file_parts = file_base.split("_")
         element = file_parts[1] # tdmean, ppt, or tmean
         year = file_parts[-1]
-        file_path = os.path.join(prism_folder_path, filename)
-        add_prism_df(file_path, df_by_year, year, element)
+        melted = read_prism_file(os.path.join(prism_folder_path, filename), element)
+        melted["Year"] = year
+        melted_dfs.append(melted)
+    if not melted_dfs:
+        return {}
+    
+    # Keep the first measurement of a (Site ID, Date, element) found in several files
+    keys = ["Year", "Site ID", "Date", "Element"]
+    prism_df = pd.concat(melted_dfs, ignore_index = True).drop_duplicates(subset = keys)
+    prism_df = prism_df.set_index(keys)["Value"].unstack("Element").reset_index()
+    prism_df.columns.name = None
+    
+    df_by_year = {}
+    for year, year_df in prism_df.groupby("Year", sort = True):
+        year_df = year_df.drop(columns = "Year").reset_index(drop = True)
+        if save_folder is not None:
+            utils.save_table(year_df, os.path.join(save_folder, PRISM_FILENAME.format(year)), index = False)
+        df_by_year[year] = year_df
     return df_by_year   
     
-def main(argv):
-    print("Will look for EPA data in ", utils.EPA_FOLDER)
-    print("Will look for Sentinel data in ", utils.SENTINEL_FOLDER)
-    print("Renaming Sentinel files...")
-    rename_all_sentinel_files(utils.SENTINEL_FOLDER)
-    if "--tif_to_npy" in argv:
-        print("Saving all .tifs to .npy")
-        save_all_sentinel_npy(utils.SENTINEL_FOLDER, NUM_FOLDER_THREADS, NUM_SAVING_THREADS)
-    if "--sentinel_only":
-        return
+def add_sentinel_stage():
+    """
+    Matches every EPA measurement to its closest Sentinel image and saves the
+    result as the epa_sentinel table.
+    """
     print("Loading dataframes...")
-    epa_df = utils.get_epa(utils.EPA_FOLDER, year = "any")
+    epa_df = utils.get_epa(utils.EPA_FOLDER, year = "any", cache_folder = utils.PROCESSED_DATA_FOLDER)
     print("Loading Sentinel dates...")
-    dates = load_sentinel_dates(utils.SENTINEL_METADATA_FOLDER)
-    new_df = epa_df.assign(SENTINEL_FILENAME = "", SENTINEL_INDEX = -1)
-    del epa_df
+    dates = load_sentinel_metadata_index(utils.SENTINEL_METADATA_FOLDER, utils.SENTINEL_FOLDER)
     print("Adding Sentinel info...")
-    pandarallel.initialize()
-    new_df = new_df.parallel_apply(add_sentinel_info, axis=1, 
-                                   metadata_folder_path=utils.SENTINEL_METADATA_FOLDER,
-                                   sentinel_folder_path=utils.SENTINEL_FOLDER,
-                                   sentinel_dates = dates)
-    del dates
-    new_df.to_csv(os.path.join(utils.PROCESSED_DATA_FOLDER, "epa_sentinel") + ".csv")
-    weather_df = pd.read_csv(os.path.join(utils.PROCESSED_DATA_FOLDER, "master_csv_2016_2017.csv"))
+    new_df = add_sentinel_info_batch(epa_df, utils.SENTINEL_FOLDER, dates)
+    del epa_df, dates
+    utils.save_table(new_df, os.path.join(utils.PROCESSED_DATA_FOLDER, EPA_SENTINEL_FILENAME), index=False)
+
+def master_split_stage():
+    """
+    Joins the epa_sentinel table with the weather and MODIS data and splits
+    the result into train/val/test sites.
+    """
+    new_df = utils.read_table(os.path.join(utils.PROCESSED_DATA_FOLDER, EPA_SENTINEL_FILENAME))
+    weather_df = utils.read_table(os.path.join(utils.PROCESSED_DATA_FOLDER, WEATHER_FILENAME))
     weather_df = weather_df.rename(columns = {"EPA Station ID" : "Site ID"})
+    weather_df = utils.apply_table_schema(weather_df)
     new_df = new_df.merge(weather_df, on = ['Site ID', 'Date'])
     
-    modis_column_names = ["Blue [0,0]","Blue [0,1]","Blue [1,0]","Blue [1,1]","Green [0,0]","Green [0,1]","Green [1,0]","Green [1,1]"]
-    modis_file_path = os.path.join(utils.PROCESSED_DATA_FOLDER, "modis.csv")
-    read_tiff.save_all_modis_to_csv(modis_file_path, utils.MODIS_FOLDER)
+    modis_column_names = utils.MODIS_COLUMNS
+    modis_file_path = os.path.join(utils.PROCESSED_DATA_FOLDER, MODIS_FILENAME)
     epa = add_columns_to_master_modis(new_df, modis_file_path, modis_column_names)
     split_data_by_site(epa)
+
+def stored_reading_keys(paths):
+    """
+    Returns the (Site ID, Date) pairs of the readings in the processed tables
+    at paths (those that exist), reading only these two columns.
+    """
+    site_ids, dates = [], []
+    for path in paths:
+        if os.path.exists(path) or os.path.exists(utils.table_path(path)):
+            df = utils.read_table(path, columns = ["Site ID", "Date"])
+            site_ids.append(np.asarray(df["Site ID"]))
+            dates.append(df["Date"].values)
+    if not site_ids:
+        return pd.MultiIndex.from_arrays([[], []])
+    return pd.MultiIndex.from_arrays([np.concatenate(site_ids), np.concatenate(dates)])
+
+def append_new_epa_rows(epa_csv_paths, num_processes = None):
+    """
+    Delta ingestion of new EPA readings. Only the (Site ID, Date) readings
+    of the given EPA csvs that are not already in the train/val/test site
+    tables are matched to their Sentinel images, to the weather data parsed
+    from the current .dly files and to the MODIS images scanned for their
+    dates, and appended to the epa_sentinel and weather tables and to the
+    site tables, keeping every known site in its split.
+    
+    Nothing is saved until every join succeeded. Readings dropped while
+    cleaning (see utils.clean_df), e.g. without weather or Sentinel data yet,
+    are reported and retried on the next append.
+
+    Parameters
+    ----------
+    epa_csv_paths : list[str]
+        Paths to EPA daily PM2.5 csvs with the new readings.
+    num_processes : int
+        Number of processes parsing weather files and scanning MODIS images.
+
+    Returns
+    -------
+    num_new : int
+        Number of new EPA readings appended to the site tables.
+    """
+    processed = lambda filename: os.path.join(utils.PROCESSED_DATA_FOLDER, filename)
+    epa_df = utils.read_csv_files(epa_csv_paths, dtype=utils.EPA_CSV_DTYPES)
+    
+    # Keep only the readings of (Site ID, Date) pairs that are not in the site tables yet
+    split_paths = [site_split_path(split) for split in SITE_SPLITS]
+    keys = pd.MultiIndex.from_arrays([epa_df["Site ID"].values, pd.to_datetime(epa_df["Date"]).values])
+    epa_df = epa_df[~keys.isin(stored_reading_keys(split_paths))].reset_index(drop=True)
+    print("Found {} new EPA readings".format(len(epa_df)))
+    if len(epa_df) == 0:
+        return 0
+    
+    print("Adding Sentinel info...")
+    dates = load_sentinel_metadata_index(utils.SENTINEL_METADATA_FOLDER, utils.SENTINEL_FOLDER)
+    new_df = utils.apply_table_schema(add_sentinel_info_batch(epa_df, utils.SENTINEL_FOLDER, dates))
+    
+    print("Adding weather info...")
+    station_map = epa_to_ghcnd_weather.get_weather_station_map(epa_df)
+    min_year = pd.to_datetime(epa_df["Date"]).dt.year.min()
+    weather_table = epa_to_ghcnd_weather.read_weather_table(utils.GHCND_DATA_FOLDER,
+                                                            station_map["Weather Station ID"].unique(),
+                                                            min_year, num_processes)
+    weather_df = epa_to_ghcnd_weather.join_weather_data(epa_df, weather_table, station_map)
+    weather_df = utils.apply_table_schema(weather_df)
+    
+    print("Adding MODIS info...")
+    modis_files = epa_to_file_names(epa_df["Date"].values, epa_df["Site ID"].values).unique()
+    modis_df = read_tiff.scan_modis(utils.MODIS_FOLDER, k = MODIS_CENTER_SIZE, num_processes = num_processes,
+                                    filenames = modis_files)
+    master_df = new_df.merge(weather_df.rename(columns = {"EPA Station ID" : "Site ID"}), on = ['Site ID', 'Date'])
+    master_df = add_columns_to_master_modis(master_df, modis_df, utils.MODIS_COLUMNS)
+    
+    # Readings retried from a previous append are already in the epa_sentinel and weather tables
+    stored_keys = stored_reading_keys([processed(EPA_SENTINEL_FILENAME)])
+    is_new = lambda df, site_column: ~pd.MultiIndex.from_arrays([np.asarray(df[site_column]),
+                                                                 df["Date"].values]).isin(stored_keys)
+    utils.append_to_table(processed(EPA_SENTINEL_FILENAME), new_df[is_new(new_df, "Site ID")])
+    utils.append_to_table(processed(WEATHER_FILENAME), weather_df[is_new(weather_df, "EPA Station ID")])
+    num_new = append_to_site_splits(master_df)
+    print("Appended {} of {} new EPA readings, dropped {} without weather or Sentinel data".format(
+        num_new, len(epa_df), len(epa_df) - num_new))
+    return num_new
+
+def get_append_paths(argv):
+    """
+    Returns the paths listed after --append in argv, up to the next flag.
+    """
+    paths = []
+    for arg in argv[argv.index("--append") + 1:]:
+        if arg.startswith("--"):
+            break
+        paths.append(arg)
+    return paths
+
+def build_pipeline(argv):
+    """
+    Declares the data processing stages, with their inputs, outputs and
+    parameters, as a pipeline.Pipeline. Sentinel conversion and packing are
+    only included when requested by --tif_to_npy and --pack_sentinel, and
+    --sentinel_only stops after the Sentinel stages.
+    """
+    sentinel_txts = os.path.join(utils.SENTINEL_FOLDER, "*", "s2*.txt")
+    sentinel_tifs = os.path.join(utils.SENTINEL_FOLDER, "*", "s2*.tif")
+    sentinel_npys = os.path.join(utils.SENTINEL_FOLDER, "*", "s2*.npy")
+    processed = lambda filename: os.path.join(utils.PROCESSED_DATA_FOLDER, filename)
+    # Stages reading the .npy files also wait for their conversion, if it is part of the run
+    sentinel_deps = ["rename_sentinel"] + (["tif_to_npy"] if "--tif_to_npy" in argv else [])
+    
+    stages = [Stage("rename_sentinel", lambda: rename_all_sentinel_files(utils.SENTINEL_FOLDER),
+                    inputs=[sentinel_tifs, sentinel_txts])]
+    if "--tif_to_npy" in argv:
+        use_threads = "--use_threads" in argv
+        if use_threads:
+            tif_to_npy = lambda: save_all_sentinel_npy(utils.SENTINEL_FOLDER, NUM_FOLDER_THREADS, NUM_SAVING_THREADS)
+        else:
+            tif_to_npy = lambda: save_all_sentinel_npy_parallel(utils.SENTINEL_FOLDER)
+        stages.append(Stage("tif_to_npy", tif_to_npy, inputs=[sentinel_tifs], outputs=[sentinel_npys],
+                            params={"crop_size": SENTINEL_CROP_SIZE}, deps=["rename_sentinel"]))
+    if "--pack_sentinel" in argv:
+        stages.append(Stage("pack_sentinel",
+                            lambda: pack_all_sentinel_years(utils.SENTINEL_FOLDER, utils.SENTINEL_PACKED_FOLDER),
+                            inputs=[sentinel_npys], outputs=[os.path.join(utils.SENTINEL_PACKED_FOLDER, "*_index.csv")],
+                            deps=sentinel_deps))
+    if "--sentinel_only" not in argv:
+        stages += [
+            Stage("epa_sentinel", add_sentinel_stage,
+                  inputs=[os.path.join(utils.EPA_FOLDER, "*.csv"),
+                          os.path.join(utils.SENTINEL_METADATA_FOLDER, "s2*.txt"), sentinel_npys],
+                  outputs=[utils.table_path(processed(EPA_SENTINEL_FILENAME))],
+                  deps=sentinel_deps),
+            Stage("modis_csv", lambda: read_tiff.scan_modis(utils.MODIS_FOLDER, utils.table_path(processed(MODIS_FILENAME)),
+                                                            k=MODIS_CENTER_SIZE),
+                  inputs=[os.path.join(utils.MODIS_FOLDER, "*_processed_100x100", "*")],
+                  outputs=[utils.table_path(processed(MODIS_FILENAME))],
+                  params={"k": MODIS_CENTER_SIZE}),
+            Stage("master_split", master_split_stage,
+                  inputs=[utils.table_path(processed(EPA_SENTINEL_FILENAME)), utils.table_path(processed(MODIS_FILENAME)),
+                          processed(WEATHER_FILENAME), utils.table_path(processed(WEATHER_FILENAME))],
+                  outputs=[utils.table_path(processed("{}_sites_master_csv_2016_2017.csv".format(split)))
+                           for split in ["train", "val", "test"]],
+                  deps=["epa_sentinel", "modis_csv"]),
+        ]
+    return Pipeline(stages, processed(PIPELINE_STATE_FILENAME))
+
+def main(argv):
+    print("Will look for EPA data in ", utils.EPA_FOLDER)
+    print("Will look for Sentinel data in ", utils.SENTINEL_FOLDER)
+    if "--append" in argv:
+        append_new_epa_rows(get_append_paths(argv))
+        return
+    ran = build_pipeline(argv).run(force="--force" in argv)
+    print("Ran stages: {}".format(", ".join(ran) if ran else "none"))
     
 
 if __name__ == "__main__":
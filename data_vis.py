@@ -139,7 +139,7 @@ def plot_PM_vs_AOD(master_csv):
     '''
     pandarallel.initialize()
 
-    df = pd.read_csv(master_csv)
+    df = utils.read_table(master_csv)
     df = utils.remove_partial_missing_modis(df)
     df['all AOD'] = df.parallel_apply(get_MODIS_vals, axis=1)
     df['green mean'] = df.parallel_apply(get_MODIS_green_mean, axis=1)
@@ -184,7 +184,7 @@ def plot_PM_vs_sent_all_sites(master_csv):
     '''
     pandarallel.initialize()
 
-    df = pd.read_csv(master_csv)
+    df = utils.read_table(master_csv)
     subdir = "visuals/repaired/allsites/"
     
     for band in [0]: #range(0,13):
@@ -218,7 +218,7 @@ def plot_PM_vs_sent_per_site(master_csv):
     '''
     pandarallel.initialize()
 
-    df = pd.read_csv(master_csv)
+    df = utils.read_table(master_csv)
    
     epa_stations = df['Site ID'].unique()
     av_pearsons = {'b1 mean':0, 'b2 mean':0, 'b3 mean':0, 'b4 mean':0, 'b5 mean':0, 
@@ -9,37 +9,24 @@ import matplotlib.pyplot as plt
 import sys
 import utils
 import random
+from sentinel_store import SentinelStore
 
 BATCH_SIZE = 32
 MIN_PM_VALUE = -9.7
 MAX_PM_VALUE = 20.5
 NUM_SENTINEL_BANDS = 13
+SITE_SPLITS = ["train", "val", "test"]
 
-class ToTensor(object):
-    """Convert ndarrays in sample to Tensors."""
+# Normalization constants for Sentinel bands and the 16 Non-Sentinel features
+IMG_MEANS = [3144.0764, 2940.7810, 2733.0339, 2820.7695, 2963.3057, 3402.0249,
+             3641.9360, 3506.4553, 3780.6147, 1732.4203,  313.6926, 2383.2466, 1815.5107]
+IMG_STDVS = [2496.1377, 2527.8665, 2389.6580, 2587.3665, 2536.4597, 2420.5823,
+             2437.2566, 2353.8274, 2421.9773, 1651.2279,  693.4088, 1381.2958, 1147.4915]
+FT_MEANS = np.array([38.7123,-96.0561,6.8902,-0.4955,-0.4929,-0.4907,-0.4956,-0.4731,
+                     -0.4710,-0.4700,-0.4747,26.2292,0.7070,6.7583,207.3810,86.5185])
+FT_STDVS = np.array([5.4067,17.2314,3.3965,0.5544,0.5546,0.5550,0.5543,0.5781,0.5783,
+                     0.5787,0.5778,83.8406,11.0480,70.6240,104.9007,95.1414])
 
-    def __call__(self, sample):
-        tensors = {"index": sample["index"], "month": sample["month"], "site": sample["site"], "state": sample["state"],
-                   "non_image" : torch.from_numpy(np.asarray(sample["non_image"])).to(dtype=torch.float),
-                   "label" : torch.from_numpy(np.asarray(sample["label"])).to(dtype=torch.float)}
-        
-        if "image" in sample:
-            
-            # Swap channel axis from H x W x C  to  C x H x W
-            image = sample["image"].transpose((2, 0, 1))
-            
-            # Remove bands should take place here 
-            tensors["image"] = torch.from_numpy(np.asarray(image)).to(dtype=torch.float)
-
-        if "non_image" in sample:
-            tensors["non_image"] = torch.from_numpy(np.asarray(sample["non_image"])).to(dtype=torch.float)
-        
-        if "image_stats" in sample:
-            tensors["image_stats"] = torch.from_numpy(np.asarray(sample["image_stats"])).to(dtype=torch.float)
-
-        return tensors
-
-    
 class CombinedDataset(Dataset):
     """
     Class encapsulating the dataset of EPA/Weather data and Sentimel images.
@@ -47,7 +34,7 @@ class CombinedDataset(Dataset):
     def __init__(self, master_csv_file, image_dir = None, threshold=None, 
                  classify=False, sample_balanced=False, 
                  predict_monthly=False, num_sent_bands=13,
-                 stats_in_csv = False):
+                 stats_in_csv = False, packed_dir = None):
         """
         Parameters
         ----------
@@ -69,18 +56,26 @@ class CombinedDataset(Dataset):
         stats_in_csv : bool
             Whether sentinel statistics (means, mins, maxes, stdvs) are in the 
             passed in data csv. Default is False.
+        packed_dir : str
+            Path to the folder of packed per-year Sentinel arrays (see
+            sentinel_store.pack_sentinel_year). If given, images are read from
+            the memory-mapped arrays, falling back to the .npy files in
+            image_dir for images that were not packed. Default is None.
         Returns
         -------
         An instance of a CombinedDataset.
         """
-        self.epa_df = pd.read_csv(master_csv_file)
+        self.epa_df = utils.read_table(master_csv_file)
         self.image_dir = image_dir
-        self.transform = transforms.Compose([ToTensor(), Normalize()])
+        self.image_norm = transforms.Normalize(mean=IMG_MEANS, std=IMG_STDVS)
         self.classify = classify
         self.predict_monthly = predict_monthly
         self.num_sent_bands = num_sent_bands
         self.stats_in_csv = stats_in_csv
         
+        if self.stats_in_csv:
+            self.epa_df = add_image_stats_columns(self.epa_df, master_csv_file)
+        
         self.epa_df = utils.clean_df(self.epa_df)
 
         if threshold != None:
@@ -107,6 +102,52 @@ class CombinedDataset(Dataset):
             print("After sampling, {} has {} examples below 12 and {} examples above 12.".format(master_csv_file, 
                                                                                  len(below_12_df), 
                                                                                  len(above_12_df)))
+        
+        self._precompute_arrays(packed_dir)
+            
+    def _precompute_arrays(self, packed_dir):
+        '''
+        Materializes everything __getitem__ needs as contiguous arrays aligned
+        with the rows of epa_df, with normalization already applied, so that
+        per-sample access is pure array indexing.
+        '''
+        self.indices = self.epa_df.index.values
+        self.months = pd.to_datetime(self.epa_df['Date']).dt.month.values.astype(np.int64)
+        self.sites = np.asarray(self.epa_df['Site ID'])
+        self.states = np.asarray(self.epa_df['STATE'])
+        
+        # Normalized once in float32 rather than per sample
+        features, _ = utils.get_epa_features_matrix(self.epa_df)
+        self.non_image = np.ascontiguousarray((features.astype(np.float32) - FT_MEANS.astype(np.float32)) 
+                                              / FT_STDVS.astype(np.float32))
+        
+        # Label based on task type
+        if self.classify == True:
+            label_column = "above_12"
+        elif self.predict_monthly == True:
+            label_column = "Month Average"
+        else:
+            label_column = "Daily Mean PM2.5 Concentration"
+        self.labels = self.epa_df[label_column].values.astype(np.float32)
+        
+        # (N, 52) normalized float32 Sentinel stats
+        if self.stats_in_csv:
+            image_stats = self.epa_df[utils.SENTINEL_STATS_COLUMNS].values.astype(np.float32)
+            self.image_stats = np.ascontiguousarray((image_stats - np.asarray(IMG_MEANS*4, dtype=np.float32)) 
+                                                    / np.asarray(IMG_STDVS*4, dtype=np.float32))
+        
+        if self.image_dir:
+            self.npy_years, self.npy_filenames = get_sentinel_npy_filenames(self.epa_df)
+        
+        # Resolve each example's row in the packed Sentinel arrays once, -1 if not packed
+        self.sentinel_store = None
+        if self.image_dir and packed_dir:
+            self.sentinel_store = SentinelStore(packed_dir)
+            self.store_rows = np.array([self.sentinel_store.lookup(year, npy_filename) for year, npy_filename 
+                                        in zip(self.npy_years, self.npy_filenames)], dtype=np.int64)
+            print("{} of {} images found in packed Sentinel arrays.".format((self.store_rows >= 0).sum(), 
+                                                                            len(self.store_rows)))
+            
     def __len__(self):
         return len(self.epa_df)
 
@@ -114,45 +155,24 @@ class CombinedDataset(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        sample = {}
-        epa_row = self.epa_df.iloc[idx]
-        sample["index"] = self.epa_df.index[idx]
-        date = pd.to_datetime(epa_row['Date'])
-        sample["month"] = date.month
-        sample["site"] = epa_row['Site ID']
-        sample["state"] = epa_row['STATE']
-        sample["non_image"], _ = utils.get_epa_features(epa_row) 
-
-        # Label based on task type
-        if self.classify == True:
-            sample["label"] = epa_row["above_12"]
-        elif self.predict_monthly == True:
-            sample["label"] = epa_row["Month Average"]
-        else:
-            sample["label"] = epa_row["Daily Mean PM2.5 Concentration"]
-
+        # Non-image features, labels and stats are already normalized
+        sample = {"index": self.indices[idx], "month": self.months[idx], 
+                  "site": self.sites[idx], "state": self.states[idx],
+                  "non_image": torch.from_numpy(self.non_image[idx]),
+                  "label": torch.tensor(self.labels[idx])}
         
         # If data csv has sentinel image stats, add these to the sample 
         if self.stats_in_csv:
-            means_str = epa_row['means'] 
-            means = [float(ss) for ss in means_str[1:-1].split()] 
-            mins_str = epa_row['mins'] 
-            mins = [float(ss) for ss in mins_str[1:-1].split()] 
-            maxes_str = epa_row['maxes']
-            maxes = [float(ss) for ss in maxes_str[1:-1].split()] 
-            stdvs_str = epa_row['stdv']
-            stdvs = [float(ss) for ss in stdvs_str[1:-1].split()]
-            sample["image_stats"] = np.concatenate((np.asarray(means), np.asarray(mins), 
-                                                    np.asarray(maxes), np.asarray(stdvs)), axis=None)
+            sample["image_stats"] = torch.from_numpy(self.image_stats[idx])
         
         # If image directory is given, add the sentinel image to the sample
-        if self.image_dir:
-            year = str(date.year)
-            npy_filename = str(epa_row["SENTINEL_FILENAME"])
-            tif_index =  int(epa_row["SENTINEL_INDEX"])
-            if year == "2016" and npy_filename[-4:] == ".tif":
-                npy_filename = npy_filename[:-4] + "_" + str(tif_index) + ".npy"
-            npy_fullpath = os.path.join(self.image_dir, year, npy_filename)
+        if self.image_dir and self.sentinel_store is not None and self.store_rows[idx] >= 0:
+            # Already C x H x W in the memory map
+            image = self.sentinel_store.get_image(self.npy_years[idx], self.store_rows[idx])
+            image = np.asarray(image).astype(np.int16)
+            
+        elif self.image_dir:
+            npy_fullpath = os.path.join(self.image_dir, self.npy_years[idx], self.npy_filenames[idx])
         
             try:
                 image = np.load(npy_fullpath).astype(np.int16)
@@ -161,12 +181,13 @@ class CombinedDataset(Dataset):
                 image = np.zeros((200,200, 13))
                 print("File {} not found.".format(npy_fullpath))
           
-            sample['image'] = image 
+            # Swap channel axis from H x W x C  to  C x H x W
+            image = image.transpose((2, 0, 1))
            
-        # Perform normalization and toTensor transforms
-        sample = self.transform(sample)
+        if self.image_dir:
+            sample['image'] = self.image_norm(torch.from_numpy(np.asarray(image)).to(dtype=torch.float))
         
-        # Select 8 chosen bands - Should move into ToTensor, here for now because post-normalization
+        # Select 8 chosen bands, after normalization
         if self.image_dir and self.num_sent_bands < NUM_SENTINEL_BANDS:
             image = sample['image']
             first_4_bands = image[:4] 
@@ -194,49 +215,92 @@ class CombinedDataset(Dataset):
         return (array - maxs)*(255/diffs)
     
 
-class Normalize(object):
-    """Normalize image Tensors."""
+def parse_image_stats(df):
+    """
+    Parses the stringified per-band Sentinel stats columns ('means', 'mins',
+    'maxes', 'stdv') written by cloud_remove.save_stats.
 
-    def __call__(self, sample):
-        index, label, non_image = sample['index'], sample['label'], sample['non_image']
-        month, site, state = sample['month'], sample['site'], sample['state']
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame with the stringified stats columns.
 
-        normalized = {}
-        
-        img_means = [3144.0764, 2940.7810, 2733.0339, 2820.7695, 2963.3057, 3402.0249,
-                     3641.9360, 3506.4553, 3780.6147, 1732.4203,  313.6926, 2383.2466, 1815.5107]
-        
-        img_stdvs = [2496.1377, 2527.8665, 2389.6580, 2587.3665, 2536.4597, 2420.5823,
-                     2437.2566, 2353.8274, 2421.9773, 1651.2279,  693.4088, 1381.2958, 1147.4915]
-        
-        img_norm = transforms.Normalize(mean=img_means, std=img_stdvs)
-        
-        ft_means = np.array([38.7123,-96.0561,6.8902,-0.4955,-0.4929,-0.4907,-0.4956,-0.4731,
-                             -0.4710,-0.4700,-0.4747,26.2292,0.7070,6.7583,207.3810,86.5185])
-        
-        ft_stdvs = np.array([5.4067,17.2314,3.3965,0.5544,0.5546,0.5550,0.5543,0.5781,0.5783,
-                             0.5787,0.5778,83.8406,11.0480,70.6240,104.9007,95.1414])
-        
-        non_image = (non_image-torch.from_numpy(ft_means).to(dtype=torch.float)) \
-        / torch.from_numpy(ft_stdvs).to(dtype=torch.float)
-        
-        normalized = {'index':index, 'non_image':non_image, 'month':month, 
-                      'site':site, 'state':state, 'label':label}
-        
-        if 'image_stats' in sample:
-            im_stats = sample['image_stats']
-            im_stats = (im_stats - torch.from_numpy(np.asarray(img_means*4)).to(dtype=torch.float)) \
-            / torch.from_numpy(np.asarray(img_stdvs*4)).to(dtype=torch.float)
-            normalized['image_stats'] = im_stats
-            
-        if "image" in sample:    
-            image = img_norm(sample['image']) 
-            normalized['image'] = image
-        
-        return normalized
+    Returns
+    -------
+    image_stats : numpy.ndarray
+        (N, 52) float32 array of means, mins, maxes and stdvs for each row.
+    """
+    parsed = [np.array([cell[1:-1].split() for cell in df[column]], dtype=np.float64)
+              for column in utils.SENTINEL_STATS_STR_COLUMNS]
+    return np.concatenate(parsed, axis=1).astype(np.float32)
+
+
+def add_image_stats_columns(df, master_csv_file):
+    """
+    Adds the Sentinel stats of every row as the 52 numeric columns of
+    utils.SENTINEL_STATS_COLUMNS. Csvs written by cloud_remove.save_stats_columns
+    already have them; otherwise the stringified columns are parsed once and 
+    cached next to the csv as <csv name>_image_stats.npy, which is reused as
+    long as it is newer than the csv.
 
-   
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame freshly read from master_csv_file.
+    master_csv_file : str
+        Path to the csv file df was read from.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        df with the numeric stats columns.
+    """
+    if all(column in df.columns for column in utils.SENTINEL_STATS_COLUMNS):
+        return df
     
+    cache_path = os.path.splitext(master_csv_file)[0] + "_image_stats.npy"
+    if not os.path.exists(master_csv_file):
+        master_csv_file = utils.table_path(master_csv_file)
+    image_stats = None
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(master_csv_file):
+        image_stats = np.load(cache_path)
+        if image_stats.shape != (len(df), len(utils.SENTINEL_STATS_COLUMNS)):
+            image_stats = None
+    if image_stats is None:
+        print("Parsing Sentinel stats from {}".format(master_csv_file))
+        image_stats = parse_image_stats(df)
+        np.save(cache_path, image_stats)
+    
+    stats_df = pd.DataFrame(image_stats, index=df.index, columns=utils.SENTINEL_STATS_COLUMNS)
+    return pd.concat([df, stats_df], axis=1)
+
+
+def get_sentinel_npy_filenames(df):
+    """
+    Computes the year and Sentinel .npy filename of every row of a master
+    DataFrame, following the same naming rules as CombinedDataset.__getitem__
+    (2016 rows may still store the original .tif filename and index).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Master DataFrame with Date, SENTINEL_FILENAME and SENTINEL_INDEX.
+
+    Returns
+    -------
+    years : list[str]
+        Year of each row.
+    npy_filenames : list[str]
+        .npy filename of each row.
+    """
+    years = pd.to_datetime(df['Date']).dt.year.astype(str)
+    npy_filenames = df['SENTINEL_FILENAME'].astype(str)
+    tif_indices = df['SENTINEL_INDEX'].astype(int).astype(str)
+    from_tif = (years == "2016") & npy_filenames.str.endswith(".tif")
+    npy_filenames = npy_filenames.where(~from_tif, npy_filenames.str[:-4] + "_" + tif_indices + ".npy")
+    return years.tolist(), npy_filenames.tolist()
+
+
 def get_sampler(dataset_size, train_end, proportion):
     split_length = int(np.floor(proportion * dataset_size))
     sampler_end = train_end
@@ -246,7 +310,7 @@ def get_sampler(dataset_size, train_end, proportion):
 
 def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0, 
               sample_balanced=False, predict_monthly=False, num_sent_bands=13,
-              stats_in_csv = False, **kwargs):
+              stats_in_csv = False, packed_dir = None, **kwargs):
     """
     Reads in training, val, and test data as specified by the provided dict. 
     Returns a dictionary of torch.util.data.DataLoaders for train and
@@ -302,6 +366,11 @@ def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0,
         * stats_in_csv : bool
             Whether sentinel statistics (means, mins, maxes, stdvs) are in the 
             passed in data csv. Default is False.
+            
+        * packed_dir : str
+            Path to the folder of packed per-year Sentinel arrays. If given,
+            images are read from these memory-mapped arrays instead of one
+            .npy file per sample. Default is None.
     Returns
     -------
     dataloaders : dict
@@ -316,7 +385,8 @@ def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0,
                                     threshold=20.5, sample_balanced=sample_balanced,
                                     predict_monthly=predict_monthly, 
                                     num_sent_bands=num_sent_bands,
-                                    stats_in_csv=stats_in_csv)
+                                    stats_in_csv=stats_in_csv,
+                                    packed_dir=packed_dir)
     train_end = len(train_dataset)
     if kwargs.get("test_nonimage_csv"):
         test_dataset = CombinedDataset(kwargs["test_nonimage_csv"], 
@@ -324,7 +394,8 @@ def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0,
                                        threshold=20.5, sample_balanced=sample_balanced,
                                        predict_monthly=predict_monthly, 
                                        num_sent_bands=num_sent_bands,
-                                       stats_in_csv=stats_in_csv)
+                                       stats_in_csv=stats_in_csv,
+                                       packed_dir=packed_dir)
         print("{} entries in test set".format(len(test_dataset)))
         test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True,
                                     num_workers = num_workers)
@@ -342,7 +413,8 @@ def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0,
                                       threshold=20.5, sample_balanced=sample_balanced, 
                                       predict_monthly=predict_monthly,
                                       num_sent_bands=num_sent_bands,
-                                      stats_in_csv=stats_in_csv)
+                                      stats_in_csv=stats_in_csv,
+                                      packed_dir=packed_dir)
         print("{} entries in validation set".format(len(val_dataset)))
         val_dataloader = DataLoader(val_dataset, batch_size=batch_size, 
                                     num_workers = num_workers, shuffle=True)
@@ -374,6 +446,61 @@ def load_data_new(train_nonimage_csv, batch_size = BATCH_SIZE, num_workers = 0,
 
 
 
+def site_split_path(split):
+    '''
+    Returns the path of the master table of the given split ("train", "val" or "test").
+    '''
+    return os.path.join(utils.PROCESSED_DATA_FOLDER, "{}_sites_master_csv_2016_2017.csv".format(split))
+
+
+def load_site_splits():
+    '''
+    Returns a dict mapping each site of the saved train/val/test master tables to
+    its split, or an empty dict if no split has been saved yet.
+    '''
+    site_splits = {}
+    for split in SITE_SPLITS:
+        path = site_split_path(split)
+        if os.path.exists(path) or os.path.exists(utils.table_path(path)):
+            for site in utils.read_table(path, columns=['Site ID'])['Site ID'].unique():
+                site_splits[site] = split
+    return site_splits
+
+
+def assign_site_splits(sites, site_splits):
+    '''
+    Keeps the sites already in site_splits in their split, and randomly splits the
+    new sites 60/20/20 into train, val, and test. Returns the updated mapping.
+    '''
+    site_splits = dict(site_splits)
+    new_sites = [site for site in pd.unique(np.asarray(sites)).tolist() if site not in site_splits]
+    num_sites = len(new_sites)  # used to compute indices for 60/20/20 split 
+    
+    random.shuffle(new_sites)
+    train_end = int(num_sites * 0.6)
+    val_end = train_end + int(num_sites * 0.2)
+    for i, site in enumerate(new_sites):
+        site_splits[site] = "train" if i < train_end else ("val" if i < val_end else "test")
+    return site_splits
+
+
+def append_to_site_splits(master_df):
+    '''
+    Cleans new master rows (see utils.clean_df) and appends them to the saved 
+    train/val/test master tables, keeping every known site in its split. New sites
+    are split as in assign_site_splits. Returns the number of rows appended.
+    '''
+    new_data = utils.clean_df(master_df)
+    site_splits = assign_site_splits(new_data['Site ID'], load_site_splits())
+    splits = np.array([site_splits[site] for site in np.asarray(new_data['Site ID'])])
+    for split in SITE_SPLITS:
+        split_data = new_data[splits == split]
+        print("Appending {} rows to the {} sites".format(len(split_data), split))
+        if len(split_data) > 0:
+            utils.append_to_table(site_split_path(split), split_data)
+    return len(new_data)
+
+
 def split_data_by_site(master_csv):
     '''
     Original function to split the 2016 data by site.
@@ -382,21 +509,17 @@ def split_data_by_site(master_csv):
     Saves that years data into train_site_data, val_site_data, and test_site_data
     master csv files.
     
-    For future years data, will use same site split - so need to edit as appropriate.
+    Sites of previously saved splits keep their split (see load_site_splits), so 
+    rerunning on more data does not reshuffle sites. Delete the saved splits for a 
+    fresh split.
 
     '''
     #all_data = pd.read_csv(master_csv)
     all_data = utils.clean_df(master_csv)
-    epa_stations = all_data['Site ID'].unique()
-    epa_stations = epa_stations.tolist()
-    num_sites = len(epa_stations)  # used to compute indices for 60/20/20 split 
-    
-    random.shuffle(epa_stations)
-    train_end = int(num_sites * 0.6)
-    val_end = train_end + int(num_sites * 0.2)
-    train_sites = epa_stations[:train_end]
-    val_sites = epa_stations[train_end:val_end]
-    test_sites = epa_stations[val_end:]
+    site_splits = assign_site_splits(all_data['Site ID'], load_site_splits())
+    train_sites = [site for site, split in site_splits.items() if split == "train"]
+    val_sites = [site for site, split in site_splits.items() if split == "val"]
+    test_sites = [site for site, split in site_splits.items() if split == "test"]
     
     ## in future, instead of above, change to split 
     ##based on .unique 'Site ID' rows from train_site_2016, etc.
@@ -410,13 +533,13 @@ def split_data_by_site(master_csv):
     val_data = all_data[all_data['Site ID'].isin(val_sites)]
     test_data = all_data[all_data['Site ID'].isin(test_sites)]
     
-    train_path = os.path.join(utils.PROCESSED_DATA_FOLDER, "train_sites_master_csv_2016_2017.csv")
-    val_path = os.path.join(utils.PROCESSED_DATA_FOLDER, "val_sites_master_csv_2016_2017.csv")
-    test_path = os.path.join(utils.PROCESSED_DATA_FOLDER, "test_sites_master_csv_2016_2017.csv")
+    train_path = site_split_path("train")
+    val_path = site_split_path("val")
+    test_path = site_split_path("test")
     
-    train_data.to_csv(train_path)
-    val_data.to_csv(val_path)
-    test_data.to_csv(test_path)
+    utils.save_table(train_data, train_path)
+    utils.save_table(val_data, val_path)
+    utils.save_table(test_data, test_path)
     
 
 class EmbeddingDataset(Dataset):
@@ -5,9 +5,6 @@
 import datetime
 import os
 import pandas as pd
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
 import csv
@@ -15,6 +12,8 @@ from os import listdir
 from os.path import isfile, join
 import collections
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.neighbors import BallTree
 import utils
 
 
@@ -74,6 +73,23 @@ data_col_dtypes = [{
 data_header_dtypes.update({k: v for d in data_col_dtypes for k, v in d.items()})
 
 
+WEATHER_ELEMENTS = ['PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN']
+WEATHER_TABLE_FILENAME = "relevant_ghcnd_weather.npz"
+RELEVANT_WEATHER_FOLDER = os.path.join(utils.GHCND_BASE_FOLDER, "relevant_ghc")
+GHCND_STATIONS_FILENAME = "ghcnd-stations.txt"
+EARTH_RADIUS_KM = 6371.0
+
+# Number of candidate weather stations per EPA site, and the elements a station must have
+# recorded on a day to be used for it
+NUM_NEAREST_STATIONS = 5
+REQUIRED_WEATHER_ELEMENTS = ['TMAX', 'TMIN', 'PRCP']
+
+# Fixed-width layout of a .dly record: 21 header bytes followed by 31 8-byte
+# (VALUE, MFLAG, QFLAG, SFLAG) groups, 269 bytes in total
+DLY_RECORD_LENGTH = 269
+DLY_NUM_DAYS = 31
+DLY_MISSING_VALUE = -9999
+
 weather_st_to_years_data = {}    # dict storing the years of available data for each weather station
 epa_to_weather_station = {}      # dictionary that maps (epa_station_id, year) -> (weather_station_id, distance) 
 closest_weather_stations = set() # set of the relevant weather station ids
@@ -179,93 +195,341 @@ def read_ghcn_data_file(directory, filename, save_dir, elements=None, include_fl
     df.index = df.index.strftime('%m/%d/%Y')
     
     csv_filename =  filename[:11] + ".csv"
-    df.to_csv(save_dir + csv_filename,  encoding='utf-8')
+    df.to_csv(os.path.join(save_dir, csv_filename),  encoding='utf-8')
 
     return df
         
 
 
-def save_relevant_weather_data(data_dir, save_dir):
+def _parse_digits(chars):
     '''
-    Loops through all the relevant weather stations, which are stored in closest_weather_stations,
-    and saves the reformated .csv versions of the original data in a new directory that will be
-    used going forward.
+    Parses the right-justified, optionally negative integers stored in the last axis
+    of a uint8 array of ASCII characters (spaces are ignored).
+    '''
+    values = np.zeros(chars.shape[:-1], dtype=np.int32)
+    for i in range(chars.shape[-1]):
+        digit = chars[..., i].astype(np.int32) - ord('0')
+        is_digit = (digit >= 0) & (digit <= 9)
+        values = np.where(is_digit, values * 10 + digit, values)
+    negative = (chars == ord('-')).any(axis=-1)
+    return np.where(negative, -values, values)
+
 
-    Used once to create this new directory of relevant files, and should not have to be used again as is.
+def parse_ghcn_dly(path, elements=WEATHER_ELEMENTS, min_year=2016, max_year=None):
+    '''
+    Fast, vectorized reader of a GHCN .dly file. The whole file is decoded as one
+    (records, 269) byte array and sliced at the fixed column offsets, keeping only the
+    records of the given elements within [min_year, max_year].
+
+    Returns a (dates, values) tuple, where dates is a sorted datetime64[D] array of the
+    days with at least one of the elements recorded, and values is a float32 array of
+    shape (len(dates), len(elements)) with NaN for missing measurements (same values as
+    the VALUE columns of read_ghcn_data_file).
     '''
-    for idx, weather_st_id in enumerate(closest_weather_stations):
-        if idx % 100 == 0:
-            print("File {}\{}".format(idx, len(closest_weather_stations)))
-        filename = weather_st_id + ".dly"
-        w_id_df = read_ghcn_data_file(data_dir, filename, save_dir, elements=None, include_flags=False, dropna='all')
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines()
+    empty = (np.array([], dtype='datetime64[D]'), np.zeros((0, len(elements)), dtype=np.float32))
+    if len(lines) == 0:
+        return empty
+    records = np.array(lines, dtype='S{}'.format(DLY_RECORD_LENGTH))
+    records = records.view(np.uint8).reshape(len(records), DLY_RECORD_LENGTH)
+
+    element_codes = np.ascontiguousarray(records[:, 17:21]).view('S4').ravel()
+    years = _parse_digits(records[:, 11:15])
+    keep = np.isin(element_codes, np.array(elements, dtype='S4')) & (years >= min_year)
+    if max_year is not None:
+        keep &= years <= max_year
+    records, element_codes, years = records[keep], element_codes[keep], years[keep]
+    if len(records) == 0:
+        return empty
+    months = _parse_digits(records[:, 15:17])
+
+    value_chars = records[:, 21:].reshape(len(records), DLY_NUM_DAYS, 8)[:, :, :5]
+    day_values = _parse_digits(value_chars)
+
+    # Each record is one month: drop padding days past the end of the month and missing values
+    month_start = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    dates = month_start.astype('datetime64[D]')[:, None] + np.arange(DLY_NUM_DAYS)
+    valid = (dates.astype('datetime64[M]') == month_start[:, None]) & (day_values != DLY_MISSING_VALUE)
+    element_idx = np.zeros(len(records), dtype=np.int64)
+    for i, element in enumerate(elements):
+        element_idx[element_codes == element.encode()] = i
+    element_idx = np.broadcast_to(element_idx[:, None], dates.shape)
+
+    dates, element_idx, day_values = dates[valid], element_idx[valid], day_values[valid]
+    unique_dates, date_idx = np.unique(dates, return_inverse=True)
+    values = np.full((len(unique_dates), len(elements)), np.nan, dtype=np.float32)
+    values[date_idx.ravel(), element_idx] = day_values
+    return unique_dates, values
+
+
+def _parse_station(args):
+    data_dir, weather_st_id, elements, min_year = args
+    return weather_st_id, parse_ghcn_dly(os.path.join(data_dir, weather_st_id + ".dly"), elements, min_year)
+
+
+def parse_weather_stations(data_dir, weather_stations, elements=WEATHER_ELEMENTS, min_year=2016, num_processes=None):
+    '''
+    Parses the .dly files of the given weather stations in a process pool (see parse_ghcn_dly).
+    Returns the (station, date, values) arrays of every (station, day) row, with values of
+    shape (rows, len(elements)).
+    '''
+    tasks = [(data_dir, weather_st_id, elements, min_year) for weather_st_id in weather_stations]
+    station_ids, dates, values = [], [], []
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for idx, (weather_st_id, (st_dates, st_values)) in enumerate(executor.map(_parse_station, tasks, chunksize=16)):
+            if idx % 100 == 0:
+                print("File {}/{}".format(idx, len(weather_stations)))
+            station_ids.append(np.full(len(st_dates), weather_st_id, dtype='S11'))
+            dates.append(st_dates)
+            values.append(st_values)
+
+    return (np.concatenate(station_ids) if station_ids else np.array([], dtype='S11'),
+            np.concatenate(dates) if dates else np.array([], dtype='datetime64[D]'),
+            np.concatenate(values) if values else np.zeros((0, len(elements)), dtype=np.float32))
+
+
+def save_relevant_weather_data(data_dir, save_dir, elements=WEATHER_ELEMENTS, min_year=2016, num_processes=None,
+                               weather_stations=None):
+    '''
+    Parses the .dly files of all the relevant weather stations, by default those stored in 
+    closest_weather_stations, in a process pool and saves the given elements from min_year
+    onwards into a single table (WEATHER_TABLE_FILENAME) in save_dir, with one row per
+    (station, day). The table is what load_weather_table reads going forward.
+    '''
+    if weather_stations is None:
+        weather_stations = closest_weather_stations
+    weather_stations = sorted(weather_stations)
+    station_ids, dates, values = parse_weather_stations(data_dir, weather_stations, elements, min_year, num_processes)
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    table_path = os.path.join(save_dir, WEATHER_TABLE_FILENAME)
+    np.savez_compressed(table_path, station=station_ids, date=dates, values=values, elements=np.array(elements))
+    print("Saved weather data of {} stations to {}".format(len(weather_stations), table_path))
+    return table_path
 
 
+def weather_table_from_arrays(station_ids, dates, values, elements, weather_stations):
+    '''
+    Builds the weather table of load_weather_table from the (station, date, values) arrays
+    of parse_weather_stations, keeping the rows of the given weather stations.
+    '''
+    station_ids = np.asarray(station_ids).astype(str)
+    keep = np.isin(station_ids, np.asarray(weather_stations, dtype=str))
+    weather_table = pd.DataFrame(values[keep], columns=np.asarray(elements).astype(str))
+    weather_table = weather_table.reindex(columns=WEATHER_ELEMENTS)
+    weather_table['Weather Station ID'] = station_ids[keep]
+    weather_table['Date'] = pd.to_datetime(dates[keep]).strftime('%m/%d/%Y')
+    return weather_table.set_index(['Weather Station ID', 'Date'])
 
-def combine_relevant_weather_data(rel_data_dir, epa_dir, save_folder):
 
+def load_weather_table(rel_data_dir, weather_stations):
+    '''
+    Loads the weather data of every given weather station once into a single table of
+    WEATHER_ELEMENTS indexed by (Weather Station ID, Date). Reads the table written by
+    save_relevant_weather_data if present, otherwise the reformatted per-station .csv files.
+    Elements a station does not record are left as NaN.
+    '''
+    table_path = os.path.join(rel_data_dir, WEATHER_TABLE_FILENAME)
+    if os.path.exists(table_path):
+        with np.load(table_path) as table:
+            return weather_table_from_arrays(table['station'], table['date'], table['values'],
+                                             table['elements'], weather_stations)
+
+    weather_dfs = []
+    for weather_station in sorted(weather_stations):
+        weather_file = os.path.join(rel_data_dir, weather_station + ".csv")
+        if not os.path.exists(weather_file):
+            print("Missing weather data file {}".format(weather_file))
+            continue
+        weather_df = pd.read_csv(weather_file)
+        weather_df = weather_df.rename(columns={"Unnamed: 0": "Date"})
+        weather_df = weather_df.reindex(columns=["Date"] + WEATHER_ELEMENTS)
+        weather_df['Weather Station ID'] = weather_station
+        weather_dfs.append(weather_df)
+
+    weather_table = pd.concat(weather_dfs, ignore_index=True)
+    weather_table = weather_table.drop_duplicates(subset=['Weather Station ID', 'Date'])
+    return weather_table.set_index(['Weather Station ID', 'Date'])
+
+
+def read_weather_table(data_dir, weather_stations, min_year=2016, num_processes=None):
+    '''
+    Parses the current .dly files of the given weather stations into the table of
+    load_weather_table, from min_year onwards, e.g. to join readings newer than the
+    saved table. Stations without a .dly file in data_dir are skipped.
+    '''
+    weather_stations = sorted(weather_st_id for weather_st_id in set(weather_stations)
+                              if os.path.exists(os.path.join(data_dir, weather_st_id + ".dly")))
+    station_ids, dates, values = parse_weather_stations(data_dir, weather_stations, WEATHER_ELEMENTS, min_year,
+                                                        num_processes)
+    return weather_table_from_arrays(station_ids, dates, values, WEATHER_ELEMENTS, weather_stations)
 
-    col_names = ['EPA Station ID', 'Date', 'Weather Station ID', 'PRCP','SNOW','SNWD','TMAX','TMIN'] 
-    master_df = pd.DataFrame(columns = col_names)
 
-    count = 0
+def get_station_map():
+    '''
+    Returns the (epa_station_id, year) -> weather_station_id mapping stored in 
+    epa_to_weather_station (see epa_to_closest_weather_station) as a table to merge against.
+    '''
+    return pd.DataFrame([(epa_station, year, weather_station) for (epa_station, year), (weather_station, _)
+                         in epa_to_weather_station.items()],
+                        columns=['EPA Station ID', 'Year', 'Weather Station ID'])
+
+def read_ghcnd_stations(stations_path, data_dir=None):
+    '''
+    Reads the ID, LATITUDE and LONGITUDE of every GHCND station from the fixed-width
+    ghcnd-stations.txt file. If data_dir is given, keeps only the stations with a .dly file in it.
+    '''
+    stations = pd.read_fwf(stations_path, colspecs=[(0, 11), (12, 20), (21, 30)],
+                           names=['ID', 'LATITUDE', 'LONGITUDE'], dtype={'ID': str}, header=None)
+    if data_dir is not None:
+        available = [f[:-4] for f in listdir(data_dir) if f.endswith(".dly")]
+        stations = stations[stations['ID'].isin(available)]
+    return stations.reset_index(drop=True)
 
-    epa_df_2016 = utils.get_epa(epa_dir,'2016')
-    epa_df_2017 = utils.get_epa(epa_dir,'2017')
+
+def build_station_tree(stations):
+    '''
+    Builds a haversine BallTree over the (LATITUDE, LONGITUDE) of the given weather stations.
+    '''
+    return BallTree(np.radians(stations[['LATITUDE', 'LONGITUDE']].values), metric='haversine')
+
+
+def get_nearest_station_map(epa_df, stations, k=NUM_NEAREST_STATIONS, tree=None):
+    '''
+    Finds the k nearest weather stations of every EPA site of epa_df (Site ID, SITE_LATITUDE,
+    SITE_LONGITUDE) with a single query of the BallTree over stations (see build_station_tree).
+
+    Returns a table with one row per (EPA Station ID, Rank), rank 0 being the nearest station,
+    with its Weather Station ID and Distance in km. join_weather_data takes it in place of
+    get_station_map to fall back to the next nearest station on days a station has no data.
+    '''
+    if tree is None:
+        tree = build_station_tree(stations)
+    k = min(k, len(stations))
+    sites = epa_df.drop_duplicates(subset='Site ID')
+    distances, indices = tree.query(np.radians(sites[['SITE_LATITUDE', 'SITE_LONGITUDE']].values), k=k)
+    return pd.DataFrame({'EPA Station ID': np.repeat(sites['Site ID'].astype(str).values, k),
+                         'Rank': np.tile(np.arange(k), len(sites)),
+                         'Weather Station ID': stations['ID'].values[indices.ravel()],
+                         'Distance': distances.ravel() * EARTH_RADIUS_KM})
+
+
+def get_weather_station_map(epa_df, k=NUM_NEAREST_STATIONS):
+    '''
+    Returns the k nearest weather stations of every EPA site (see get_nearest_station_map) if
+    the GHCND station list is available, otherwise the precomputed closest weather station of
+    every site and year (see epa_to_closest_weather_station and get_station_map).
+    '''
+    stations_path = os.path.join(utils.GHCND_BASE_FOLDER, GHCND_STATIONS_FILENAME)
+    if os.path.exists(stations_path):
+        stations = read_ghcnd_stations(stations_path, utils.GHCND_DATA_FOLDER)
+        print("Matching EPA sites to the {} nearest of {} weather stations".format(k, len(stations)))
+        return get_nearest_station_map(epa_df, stations, k)
+    print("Missing {}, using the closest weather station files".format(stations_path))
+    epa_to_closest_weather_station(utils.GHCND_BASE_FOLDER)
+    return get_station_map()
+
+
+def join_nearest_weather_data(epa_df, weather_table, nearest_map, required_elements=REQUIRED_WEATHER_ELEMENTS):
+    '''
+    Joins every (epa station, date) reading of epa_df to the weather data of the nearest of its
+    candidate weather stations (nearest_map, see get_nearest_station_map) that recorded all of
+    required_elements on that date. If no candidate did, all weather variables are set to -1 and
+    the nearest station is kept.
+    '''
+    col_names = ['EPA Station ID', 'Date', 'Weather Station ID'] + WEATHER_ELEMENTS
+    readings = pd.DataFrame({'EPA Station ID': epa_df['Site ID'].astype(str).values,
+                             'Date': epa_df['Date'].values,
+                             'Reading': np.arange(len(epa_df))})
+    candidates = readings.merge(nearest_map[['EPA Station ID', 'Rank', 'Weather Station ID']], on='EPA Station ID')
+    candidates = candidates.merge(weather_table, left_on=['Weather Station ID', 'Date'], right_index=True)
+    candidates = candidates[candidates[required_elements].notna().all(axis=1).values]
+    best = candidates.sort_values(['Reading', 'Rank']).drop_duplicates(subset='Reading').set_index('Reading')
+
+    joined_df = best.reindex(readings['Reading'])
+    joined_df['EPA Station ID'] = epa_df['Site ID'].values
+    joined_df['Date'] = readings['Date'].values
+    missing = joined_df['Rank'].isnull().values
+    nearest = nearest_map[nearest_map['Rank'] == 0].set_index('EPA Station ID')['Weather Station ID']
+    joined_df.loc[missing, 'Weather Station ID'] = nearest.reindex(readings['EPA Station ID'].values[missing]).values
+    joined_df.loc[missing, WEATHER_ELEMENTS] = -1
+    print("Missing weather data for {} of {} readings, {} matched to a further station".format(
+        missing.sum(), len(joined_df), (joined_df['Rank'] > 0).sum()))
+    return joined_df[col_names].reset_index(drop=True)
+
+
+def join_weather_data(epa_df, weather_table, station_map):
+    '''
+    Joins (epa station, date) readings of epa_df to the weather data of the closest
+    weather station for that year with a single merge. If weather data is missing for
+    a reading, all weather variables are set to -1.
+
+    epa_df holds raw EPA readings (Site ID, Date as mm/dd/yyyy), weather_table is
+    given by load_weather_table and station_map by get_station_map. A station_map
+    of several ranked stations per site (see get_nearest_station_map) is joined with
+    join_nearest_weather_data instead.
+    '''
+    if 'Rank' in station_map.columns:
+        return join_nearest_weather_data(epa_df, weather_table, station_map)
+    col_names = ['EPA Station ID', 'Date', 'Weather Station ID'] + WEATHER_ELEMENTS
+    joined_df = pd.DataFrame({'EPA Station ID': epa_df['Site ID'].astype(str).values,
+                              'Date': epa_df['Date'].values})
+    joined_df['Year'] = joined_df['Date'].str[-4:].astype(int)
+    joined_df = joined_df.merge(station_map, on=['EPA Station ID', 'Year'], how='left')
+    joined_df = joined_df.merge(weather_table, left_on=['Weather Station ID', 'Date'], right_index=True,
+                                how='left', indicator=True)
+
+    # if for some reason weather data is missing for that day, set weather variables to '-1'
+    missing = (joined_df['_merge'] == 'left_only').values
+    joined_df.loc[missing, WEATHER_ELEMENTS] = -1
+    print("Missing weather data for {} of {} readings".format(missing.sum(), len(joined_df)))
+
+    # Keep the EPA site ids as they are in the EPA data for the typed table
+    joined_df['EPA Station ID'] = epa_df['Site ID'].values
+    return joined_df[col_names]
+
+
+def combine_relevant_weather_data(rel_data_dir, epa_dir, save_folder, station_map=None):
+    '''
+    Joins every (epa station, date) reading to the weather data of the closest weather
+    station for that year (see epa_to_closest_weather_station and join_weather_data),
+    and saves the result per year and for all years. If given, station_map (e.g. the
+    nearest stations of get_nearest_station_map) is used instead of get_station_map.
+    '''
+    epa_df_2016 = utils.get_epa(epa_dir, '2016', cache_folder=save_folder)
+    epa_df_2017 = utils.get_epa(epa_dir, '2017', cache_folder=save_folder)
     #epa_df_2018 = utils.get_epa(epa_dir,'2018')
     #epa_df_2019 = utils.get_epa(epa_dir,'2019') 
     epa_df_all = [epa_df_2016, epa_df_2017] #, epa_df_2018, epa_df_2019]
 
-    loaded_weather_stations = {}  # dictionary that holds loaded weather dfs to avoid repeated .csv reading
+    if station_map is None:
+        station_map = get_station_map()
+    weather_table = load_weather_table(rel_data_dir, station_map['Weather Station ID'].unique())
 
-    # for every (epa, date) entry across all years, 
+    master_dfs = []
     for i, epa_df_year in enumerate(epa_df_all):
         year = i + 2016
         print("Processing epa data from {}".format(year))
-
-        # go row by row (each successive date at first site, at second site, etc...
-        for date_at_site_idx, row in epa_df_year.iterrows():
-            if date_at_site_idx % 1000 == 0:
-                print("Processing site {} on {}. Reading {}/{}.".format(str(row['Site ID']), row['Date'], date_at_site_idx, len(epa_df_year)))
-
-            # get the .csv file of the closest weather station (containing full month data)
-            epa_station = str(row['Site ID'])
-            date = row['Date']
-            year = int(date[-4:])
-            
-            weather_station, dist = epa_to_weather_station[epa_station, year]
-
-            if weather_station in loaded_weather_stations:
-                weather_df_full = loaded_weather_stations[weather_station]
-
-            else:
-                weather_df_full = pd.read_csv(rel_data_dir + weather_station + ".csv")
-                weather_df_full =  weather_df_full.rename(columns={"Unnamed: 0": "Date"})
-
-            weather_df_date = weather_df_full[weather_df_full["Date"] == date]
-
-            # Finally, write to master file 
-            # if for some reason weather data is missing for that day, set weather variables to '-1'
-            if weather_df_date.empty:
-                master_df.loc[len(master_df)] = [epa_station, date, weather_station, -1, -1, -1, -1, -1]
-            else:
-                master_df.loc[len(master_df)] = [epa_station, date, weather_station, weather_df_date['PRCP'][weather_df_date.index[0]], 
-                                                 weather_df_date['SNOW'][weather_df_date.index[0]],
-                                                 weather_df_date['SNWD'][weather_df_date.index[0]], 
-                                                 weather_df_date['TMAX'][weather_df_date.index[0]],
-                                                 weather_df_date['TMIN'][weather_df_date.index[0]]]
+        year_df = join_weather_data(epa_df_year, weather_table, station_map)
         save_name = "master_epa_new_" + str(year) + ".csv"
-        master_df.to_csv(os.path.join(save_folder, save_name), encoding='utf-8')
+        utils.save_table(year_df, os.path.join(save_folder, save_name))
+        master_dfs.append(year_df)
 
-    master_df.to_csv(os.path.join(save_folder, "master_csv_2016_2017.csv"), encoding='utf-8')
+    master_df = pd.concat(master_dfs, ignore_index=True)
+    utils.save_table(master_df, os.path.join(save_folder, "master_csv_2016_2017.csv"))
     return master_df
 
 if __name__ == "__main__":
     #weather_station_to_years_of_data(utils.GHCND_BASE_FOLDER)
-    epa_to_closest_weather_station(utils.GHCND_BASE_FOLDER)
-    relevant_weather_dir = os.path.join(utils.GHCND_BASE_FOLDER, "relevant_ghc")
-    save_relevant_weather_data(utils.GHCND_DATA_FOLDER, relevant_weather_dir)
     save_folder = utils.PROCESSED_DATA_FOLDER
-    combine_relevant_weather_data(relevant_weather_dir, utils.EPA_FOLDER, save_folder)
+    epa_df = pd.concat([utils.get_epa(utils.EPA_FOLDER, year, cache_folder=save_folder) for year in ['2016', '2017']])
+    station_map = get_weather_station_map(epa_df)
+    relevant_weather_dir = RELEVANT_WEATHER_FOLDER
+    save_relevant_weather_data(utils.GHCND_DATA_FOLDER, relevant_weather_dir,
+                               weather_stations=station_map['Weather Station ID'].unique())
+    combine_relevant_weather_data(relevant_weather_dir, utils.EPA_FOLDER, save_folder, station_map)
     
     
     
@@ -49,7 +49,7 @@ then
     if [ "$sentinel_only" = true ]
     then
         echo "Only processing Sentinel-2 images..."
-        python code/data_processing.py --tif_to_npy --sentinel-only
+        python code/data_processing.py --tif_to_npy --sentinel_only
     else
         echo "Running preprocessing stage, could take a while..."
         if [ ! -d "processed_data" ]
@@ -0,0 +1,220 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+
+# Partial sums kept for every group, from which all the metrics are computed
+SUM_COLUMNS = ["Count", "Sum Label", "Sum Prediction", "Sum Label^2", "Sum Prediction^2",
+               "Sum Label*Prediction", "Sum Squared Error"]
+
+# Absolute errors are counted in fixed bins, so that error quantiles can be merged as well.
+# Errors above the last edge fall in the last bin.
+ERROR_BIN_WIDTH = 0.1
+NUM_ERROR_BINS = 2000
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+DEFAULT_GROUPINGS = ("Site ID", "State", "Month")
+ALL_GROUPS = "All"
+STREAM_CHUNKSIZE = 1000000
+
+def squared_errors(df):
+    """
+    Returns the squared error of every example of a predictions DataFrame
+    (with Prediction and Label columns).
+    """
+    return (df['Label'] - df['Prediction'])**2
+
+
+class GroupedMetrics(object):
+    """
+    Mergeable partial sums of predictions and labels, grouped by the values of
+    a column (e.g. Site ID), from which MSE, R2, Pearson and error quantiles
+    of every group are computed.
+
+    Batches are added with update, and accumulators built from different
+    batches, processes or files are combined with merge, so predictions never
+    need to be in memory all at once.
+    """
+    def __init__(self, group_by=None):
+        """
+        Parameters
+        ----------
+        group_by : str
+            Column of the predictions to group by. If None, all the predictions
+            are in a single group, ALL_GROUPS.
+        """
+        self.group_by = group_by
+        self.sums = pd.DataFrame(columns=SUM_COLUMNS, dtype=np.float64)
+        self.error_counts = pd.DataFrame(columns=np.arange(NUM_ERROR_BINS), dtype=np.int64)
+
+    def update(self, labels, predictions, keys=None):
+        """
+        Adds a batch of predictions with a single bincount pass per partial sum.
+
+        Parameters
+        ----------
+        labels : array-like
+            True values of the batch.
+        predictions : array-like
+            Predicted values of the batch.
+        keys : array-like
+            Group of every prediction. Unused if group_by is None.
+        """
+        labels = np.asarray(labels, dtype=np.float64)
+        predictions = np.asarray(predictions, dtype=np.float64)
+        if self.group_by is None:
+            codes, uniques = np.zeros(len(labels), dtype=np.int64), pd.Index([ALL_GROUPS])
+        else:
+            # Predictions without a group (NaN key) are left out
+            codes, uniques = pd.factorize(np.asarray(keys))
+            valid = codes >= 0
+            codes, labels, predictions = codes[valid], labels[valid], predictions[valid]
+        num_groups = len(uniques)
+        errors = labels - predictions
+        sums = np.stack([np.bincount(codes, weights=weights, minlength=num_groups)
+                         for weights in [None, labels, predictions, labels**2, predictions**2,
+                                         labels * predictions, errors**2]], axis=1)
+        bins = np.minimum((np.abs(errors) / ERROR_BIN_WIDTH).astype(np.int64), NUM_ERROR_BINS - 1)
+        counts = np.bincount(codes * NUM_ERROR_BINS + bins, minlength=num_groups * NUM_ERROR_BINS)
+        batch = GroupedMetrics(self.group_by)
+        batch.sums = pd.DataFrame(sums, index=uniques, columns=SUM_COLUMNS)
+        batch.error_counts = pd.DataFrame(counts.reshape(num_groups, NUM_ERROR_BINS), index=uniques)
+        return self.merge(batch)
+
+    def update_df(self, df):
+        """
+        Adds a batch of predictions from a DataFrame with Prediction, Label
+        and group_by columns. A missing Month column is taken from Date.
+        """
+        keys = None
+        if self.group_by is not None:
+            if self.group_by == "Month" and "Month" not in df.columns:
+                keys = pd.to_datetime(df["Date"]).dt.month.values
+            else:
+                keys = df[self.group_by].values
+        return self.update(df["Label"].values, df["Prediction"].values, keys)
+
+    def merge(self, other):
+        """
+        Adds the partial sums of another GroupedMetrics of the same grouping.
+        """
+        if len(self.sums) == 0:
+            self.sums, self.error_counts = other.sums, other.error_counts
+        elif len(other.sums) > 0:
+            self.sums = self.sums.add(other.sums, fill_value=0)
+            self.error_counts = self.error_counts.add(other.error_counts, fill_value=0).astype(np.int64)
+        return self
+
+    def result(self, quantiles=DEFAULT_QUANTILES):
+        """
+        Computes the metrics of every group from the partial sums.
+
+        Parameters
+        ----------
+        quantiles : list[float]
+            Quantiles of the absolute error to report, approximated to
+            ERROR_BIN_WIDTH.
+
+        Returns
+        -------
+        metrics : pandas.DataFrame
+            Indexed by group (sorted), with columns Count, MSE, R2, Pearson and
+            one "Error q<quantile>" column per quantile. R2 and Pearson are NaN
+            for groups with constant labels or predictions.
+        """
+        sums = self.sums.sort_index()
+        n = sums["Count"]
+        label_var = sums["Sum Label^2"] - sums["Sum Label"]**2 / n
+        pred_var = sums["Sum Prediction^2"] - sums["Sum Prediction"]**2 / n
+        covariance = sums["Sum Label*Prediction"] - sums["Sum Label"] * sums["Sum Prediction"] / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics = pd.DataFrame({"Count": n.astype(np.int64),
+                                    "MSE": sums["Sum Squared Error"] / n,
+                                    "R2": 1 - sums["Sum Squared Error"] / label_var.where(label_var > 0),
+                                    "Pearson": covariance / np.sqrt((label_var * pred_var).where(label_var * pred_var > 0))},
+                                   index=sums.index)
+
+        # Quantile = upper edge of the first bin whose cumulative count reaches it
+        cumulative = np.cumsum(self.error_counts.loc[sums.index].values, axis=1)
+        for q in quantiles:
+            first_bin = (cumulative < (q * n.values)[:, None]).sum(axis=1)
+            metrics["Error q{:g}".format(q * 100)] = (np.minimum(first_bin, NUM_ERROR_BINS - 1) + 1) * ERROR_BIN_WIDTH
+        metrics.index.name = self.group_by
+        return metrics
+
+
+def _parquet_chunks(parquet_path, chunksize):
+    """
+    Yields the rows of a Parquet file in DataFrames of at most chunksize rows.
+    Newer pyarrow versions read the file in batches of chunksize rows. Older ones
+    (before 3.0) can only read a whole row group at a time, so memory is then
+    bounded by the row group size of the file (utils.PredictionWriter writes
+    row groups of STREAM_CHUNKSIZE rows).
+    """
+    parquet_file = pq.ParquetFile(parquet_path)
+    if hasattr(parquet_file, "iter_batches"):
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    for i in range(parquet_file.num_row_groups):
+        df = parquet_file.read_row_group(i).to_pandas()
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+
+
+def _file_metrics(args):
+    predictions_csv, groupings, chunksize = args
+    accumulators = {grouping: GroupedMetrics(None if grouping == ALL_GROUPS else grouping)
+                    for grouping in groupings}
+    # Predictions saved by utils.PredictionWriter are stored as Parquet next to their .csv path
+    parquet_path = os.path.splitext(predictions_csv)[0] + ".parquet"
+    if os.path.exists(parquet_path):
+        chunks = _parquet_chunks(parquet_path, chunksize)
+    else:
+        chunks = pd.read_csv(predictions_csv, chunksize=chunksize)
+    for chunk in chunks:
+        for accumulator in accumulators.values():
+            accumulator.update_df(chunk)
+    return accumulators
+
+
+def compute_metrics(predictions_csvs, groupings=DEFAULT_GROUPINGS, quantiles=DEFAULT_QUANTILES,
+                    chunksize=STREAM_CHUNKSIZE, num_processes=None):
+    """
+    Computes the metrics of predictions files, overall and by each of
+    the groupings. Files are read in chunks of chunksize rows, in parallel
+    across processes, so they can be larger than memory. With pyarrow
+    versions before 3.0, Parquet files are read a row group at a time
+    instead (see _parquet_chunks), which utils.PredictionWriter bounds to
+    STREAM_CHUNKSIZE rows.
+
+    Parameters
+    ----------
+    predictions_csvs : list[str]
+        Paths of the predictions .csv or .parquet files (Prediction, Label and
+        the grouping columns, see utils.PredictionWriter).
+    groupings : list[str]
+        Columns to group the predictions by.
+    quantiles : list[float]
+        Quantiles of the absolute error to report.
+    chunksize : int
+        Number of rows read at once from a file.
+    num_processes : int
+        Number of files read at the same time.
+
+    Returns
+    -------
+    metrics : dict from str -> pandas.DataFrame
+        Metrics (see GroupedMetrics.result) by grouping, plus the overall
+        metrics under ALL_GROUPS.
+    """
+    groupings = [ALL_GROUPS] + list(groupings)
+    accumulators = {grouping: GroupedMetrics(None if grouping == ALL_GROUPS else grouping)
+                    for grouping in groupings}
+    tasks = [(predictions_csv, groupings, chunksize) for predictions_csv in predictions_csvs]
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for file_accumulators in executor.map(_file_metrics, tasks):
+            for grouping in groupings:
+                accumulators[grouping].merge(file_accumulators[grouping])
+    return {grouping: accumulator.result(quantiles) for grouping, accumulator in accumulators.items()}
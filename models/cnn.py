@@ -104,6 +104,9 @@ def train(model, optimizer, loss_fn, dataloader, batch_size, epoch, scheduler=No
    
     print("Training for one epoch on {} batches.".format(num_batches))
           
+    predictions_writer = utils.PredictionWriter("predictions/repaired/cnn_train_preds_epoch_" + str(epoch) + ".csv",
+                                                len(dataloader.dataset))
+    
     with tqdm(total=num_batches) as t:
         
         for i, sample in enumerate(dataloader):
@@ -143,13 +146,14 @@ def train(model, optimizer, loss_fn, dataloader, batch_size, epoch, scheduler=No
             
             if epoch % 20 == 0:
             # Save predictions to compute r2 over full dataset
-                curr_batch_size = outputs.shape[0]  
-                utils.save_predictions(indices, outputs, labels, sites, dates, states, curr_batch_size, 
-                                       "predictions/repaired/cnn_train_preds_epoch_" + str(epoch) + ".csv") 
+                predictions_writer.add(indices, outputs, labels, sites, dates, states)
          
             del inputs, labels, outputs
             torch.cuda.empty_cache()
             
+    # Written in the background while the next epoch runs
+    predictions_writer.flush()
+    
     # Save metrics
     mean_metrics = {metric: np.mean([x[metric] for x in summaries]) for metric in summaries[0]} 
     metrics_string = " ; ".join("{}: {:05.3f}".format(k, v) for k, v in mean_metrics.items())
@@ -171,6 +175,9 @@ def evaluate(model, loss_fn, dataloader, batch_size, epoch):
     
     print("Evaluating on {} batches".format(num_batches))
     
+    predictions_writer = utils.PredictionWriter("predictions/repaired/cnn_val_preds_epoch_" + str(epoch) + ".csv",
+                                                len(dataloader.dataset))
+    
     with tqdm(total=num_batches) as t:
 
         with torch.no_grad():
@@ -194,9 +201,7 @@ def evaluate(model, loss_fn, dataloader, batch_size, epoch):
                 sites, dates = sites.data.cpu().numpy(), dates.data.cpu().numpy()
 
                 # Save predictions to compute r2 over full dataset
-                curr_batch_size = outputs.shape[0]  
-                utils.save_predictions(indices, outputs, labels, sites, dates, states, curr_batch_size, 
-                                       "predictions/repaired/cnn_val_preds_epoch_" + str(epoch) + ".csv") 
+                predictions_writer.add(indices, outputs, labels, sites, dates, states)
  
                 # Save metrics
                 r2 = r2_score(labels, outputs) 
@@ -212,6 +217,9 @@ def evaluate(model, loss_fn, dataloader, batch_size, epoch):
                 del inputs, labels, outputs
                 torch.cuda.empty_cache()
 
+    # Written in the background while the next epoch runs
+    predictions_writer.flush()
+    
     mean_metrics = {metric: np.mean([x[metric] for x in summaries]) for metric in summaries[0]}    
     metrics_string = " ; ".join("{}: {:05.3f}".format(k, v) for k, v in mean_metrics.items())
     print("Evaluation metrics: {}".format(metrics_string))
@@ -280,6 +288,9 @@ def train_and_evaluate(model, optimizer, loss_fn, train_dataloader, val_dataload
     utils.plot_losses(all_train_losses, all_val_losses, num_epochs, num_train, save_as="plots/loss_cnn_"+str(num_train)+".png")
     utils.plot_r2(all_train_r2, all_val_r2, num_epochs, num_train, save_as="plots/r2_cnn_"+str(num_train)+".png")
                 
+    # Make sure the predictions written in the background were saved
+    utils.wait_for_prediction_writes()
+
     # Return train and eval metrics
     return train_mean_metrics, val_mean_metrics
 
@@ -298,6 +309,7 @@ def predict(model, loss_fn, dataloader, batch_size, num_epochs,
     mean_metrics = evaluate(model, loss_fn, dataloader, batch_size, epoch)
     r2 = mean_metrics['average r2']
     print("Mean R2 for {} dataset: {}".format(dataset, r2))
+    utils.wait_for_prediction_writes()
     
 
 def run_train():
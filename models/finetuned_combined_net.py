@@ -1,7 +1,6 @@
 #four epochs total
 import os
 import pandas
-import csv
 import numpy as np
 import torch
 import torch.optim as optim
@@ -133,18 +132,6 @@ def model_eval(model,dataloader):
     
     return r2_score(labels,pred_labels)
 
-def save_predictions(indices,predictions,labels,sites,dates,batch_size,save_to):
-    with open(save_to, 'a') as fd:
-        writer = csv.writer(fd)
-        for i in range (0,batch_size):
-            index = indices[i]
-            y_pred = predictions[i]
-            y_true = labels[i]
-            site = sites[i]
-            date = dates[i]
-            row = [index, y_pred, y_true, site, date]
-            writer.writerow(row)
-
 if __name__ == "__main__":
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
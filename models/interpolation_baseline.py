@@ -0,0 +1,110 @@
+import os
+import sys
+import numpy as np
+from scipy import sparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import utils
+from knn_baseline import NearestNeighborBaseline, save_predictions
+
+EARTH_RADIUS_KM = 6371.0
+# Sites closer than this are weighted as if they were this far, so co-located sites don't dominate
+MIN_DISTANCE_KM = 1.0
+WEIGHTINGS = ("idw", "gaussian")
+
+def station_graph(neighbors, distances, num_sites, k, weighting="idw", power=2, bandwidth_km=50):
+    '''
+    Builds the sparse (len(neighbors) x num_sites) weights of the k nearest train sites of each
+    row, from a neighbor table (see knn_baseline.site_neighbor_table, distances in radians).
+    Weights are inverse distance (d^-power) for "idw" and exp(-d^2 / 2 bandwidth^2) for "gaussian".
+    '''
+    dists_km = np.maximum(distances[:, :k] * EARTH_RADIUS_KM, MIN_DISTANCE_KM)
+    if weighting == "idw":
+        weights = dists_km ** -float(power)
+    else:
+        weights = np.exp(-0.5 * (dists_km / bandwidth_km)**2)
+    rows = np.repeat(np.arange(len(neighbors)), weights.shape[1])
+    return sparse.csr_matrix((weights.ravel(), (rows, neighbors[:, :k].ravel())),
+                             shape=(len(neighbors), num_sites))
+
+def interpolate(values, date_idx, site_idx, graph):
+    '''
+    For each query (date date_idx, row site_idx of graph), averages the readings of values
+    (dates x sites, NaN where a site has no reading) weighted by graph, over the sites that
+    have a reading on that date. All dates are interpolated at once with two sparse products.
+    Returns the predictions, NaN where none of the neighbors of a site has a reading on that date.
+    '''
+    reporting = ~np.isnan(values)
+    weighted_sums = graph @ np.where(reporting, values, 0).T
+    weight_totals = graph @ reporting.T.astype(np.float64)
+    numerators = weighted_sums[site_idx, date_idx]
+    denominators = weight_totals[site_idx, date_idx]
+
+    predictions = np.full(len(date_idx), np.nan)
+    found = denominators > 0
+    predictions[found] = numerators[found] / denominators[found]
+    return predictions
+
+class SpatialInterpolationBaseline(NearestNeighborBaseline):
+    '''
+    Spatial Interpolation Baseline Model
+
+    For each EPA site on a given date, predicts the weighted average of the PM2.5 readings
+    of those of its k closest EPA sites that have a reading on that date (possibly fewer
+    than k), weighted by inverse distance or a Gaussian kernel of the Haversine distance.
+    If none of them has a reading, the reading of the nearest EPA site with one is used,
+    as in NearestNeighborBaseline, so both baselines predict the same readings.
+
+    The k nearest train sites and their weights are computed once for every site, as a
+    sparse station graph, and only masked by the sites that report on each date.
+    '''
+    def __init__(self, train_csv, k=10, weighting="idw", power=2, bandwidth_km=50, threshold=20.5):
+        if weighting not in WEIGHTINGS:
+            raise ValueError("Unknown weighting {}, expected one of {}".format(weighting, WEIGHTINGS))
+        super().__init__(train_csv, threshold)
+        self.k = k
+        self.weighting = weighting
+        self.power = power
+        self.bandwidth_km = bandwidth_km
+
+    def estimate(self, date_idx, site_idx, coords, exclude_self=False):
+        '''
+        Interpolates the PM2.5 of each query (date self.dates[date_idx], site at coords[site_idx])
+        from those of its k nearest train sites that have a reading on that date. Queries where
+        none of them has one get the reading of the nearest train site with one instead (see
+        nearest_available). If exclude_self, coords are the train sites and each site is left
+        out of its own neighbors.
+        Returns (prediction, distance to the nearest site with a reading) arrays, NaN where no
+        train site has a reading on that date.
+        '''
+        neighbors, distances = self.neighbor_table(coords, exclude_self)
+        graph = station_graph(neighbors, distances, len(self.site_ids), self.k, self.weighting,
+                              self.power, self.bandwidth_km)
+        predictions = interpolate(self.values, date_idx, site_idx, graph)
+        nearest, dists = self.nearest_available(date_idx, site_idx, neighbors, distances)
+        fallback = np.isnan(predictions) & ~np.isnan(nearest)
+        predictions[fallback] = nearest[fallback]
+        print("Used the nearest site for {} of {} readings without any of their {} nearest sites reporting".format(
+            fallback.sum(), len(predictions), self.k))
+        return predictions, dists
+
+
+def run_baseline(weighting="idw"):
+    '''
+    Runs the Spatial Interpolation baseline model and saves test set predictions.
+    '''
+
+    train_csv = os.path.join(utils.PROCESSED_DATA_FOLDER, "train_sites_master_csv_2016_2017.csv")
+    test_csv = os.path.join(utils.PROCESSED_DATA_FOLDER, "test_sites_master_csv_2016_2017.csv")
+    predictions_csv = "predictions/{}_interpolation_predictions.csv".format(weighting)
+
+    model = SpatialInterpolationBaseline(train_csv=train_csv, weighting=weighting)
+    model.train()
+
+    all_y_test, all_y_pred, all_dists, all_states, all_months, r2, pearson, MSE = model.predict(test_csv=test_csv)
+    save_predictions(all_y_test, all_y_pred, all_dists, all_months, all_states, predictions_csv)
+
+
+if __name__ == "__main__":
+
+    run_baseline()
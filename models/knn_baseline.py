@@ -2,89 +2,187 @@ import os
 import sys
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from scipy.stats.stats import pearsonr
-from sklearn.neighbors import KNeighborsRegressor
+from sklearn.metrics.pairwise import haversine_distances
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import r2_score
 from sklearn.utils import shuffle
-from pandarallel import pandarallel 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import utils
+import metrics
+
+def site_neighbor_table(coords, site_coords, exclude_self=False):
+    '''
+    Orders the sites at site_coords by haversine distance from each of the given (latitude,
+    longitude) coordinates, in radians. If exclude_self, coords are the sites themselves
+    and each site is left out of its own neighbors.
+    Returns (neighbors, distances), both (len(coords) x number of neighbors).
+    '''
+    distances = haversine_distances(coords, site_coords)
+    if exclude_self:
+        np.fill_diagonal(distances, np.inf)
+    neighbors = np.argsort(distances, axis=1, kind='stable')
+    if exclude_self:
+        neighbors = neighbors[:, :-1]
+    return neighbors, np.take_along_axis(distances, neighbors, axis=1)
+
+def _nearest_available(args):
+    values, date_idx, site_idx, neighbors, distances = args
+    num_queries = len(date_idx)
+    predictions = np.full(num_queries, np.nan)
+    dists = np.full(num_queries, np.nan)
+    unresolved = np.arange(num_queries)
+    for rank in range(neighbors.shape[1]):
+        if len(unresolved) == 0:
+            break
+        candidates = neighbors[site_idx[unresolved], rank]
+        found_values = values[date_idx[unresolved], candidates]
+        found = ~np.isnan(found_values)
+        predictions[unresolved[found]] = found_values[found]
+        dists[unresolved[found]] = distances[site_idx[unresolved[found]], rank]
+        unresolved = unresolved[~found]
+    return predictions, dists
+
+def nearest_available(values, date_idx, site_idx, neighbors, distances, num_processes=1):
+    '''
+    For each query (date date_idx, site site_idx), finds the nearest neighbor in 
+    neighbors[site_idx] with a reading on that date in values (dates x sites, NaN where
+    a site has no reading), one neighbor rank at a time for all the unresolved queries.
+    With num_processes > 1, blocks of dates are resolved in parallel processes.
+    Returns (prediction, distance) arrays, NaN where no neighbor has a reading on that date.
+    '''
+    if num_processes <= 1:
+        return _nearest_available((values, date_idx, site_idx, neighbors, distances))
+
+    predictions = np.full(len(date_idx), np.nan)
+    dists = np.full(len(date_idx), np.nan)
+    tasks, queries = [], []
+    for block in np.array_split(np.arange(values.shape[0]), num_processes):
+        if len(block) == 0:
+            continue
+        query_idx = np.nonzero((date_idx >= block[0]) & (date_idx <= block[-1]))[0]
+        tasks.append((values[block[0]:block[-1] + 1], date_idx[query_idx] - block[0], site_idx[query_idx],
+                      neighbors, distances))
+        queries.append(query_idx)
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for query_idx, (block_predictions, block_dists) in zip(queries, executor.map(_nearest_available, tasks)):
+            predictions[query_idx] = block_predictions
+            dists[query_idx] = block_dists
+    return predictions, dists
 
 class NearestNeighborBaseline():
     '''
     Nearest Neighbor Baseline Model
     
     For each EPA site on a given date, predicts that that site's PM2.5 reading
-    is the same as the PM2.5 reading of the next closest EPA site, 
-    based on Haversine distance.
+    is the same as the PM2.5 reading of the next closest EPA site with a reading
+    on that date, based on Haversine distance.
     
+    The set of train sites is static, so the train sites are ordered by distance
+    once for every site, and the readings are indexed by date once (sorted by date,
+    CSR style). Predictions for all dates are then answered with array operations.
     '''
     def __init__(self, train_csv, threshold=20.5):
-        self.train_df = pd.read_csv(train_csv)
+        self.train_df = utils.read_table(train_csv)
         self.threshold = threshold 
-        self.models = {}  # dict mapping each date to NN model
-        self.dates = set()
-        
-    def train(self):
+        self.dates = None         # sorted unique train dates
+        self.site_ids = None      # unique train sites
+        self.site_coords = None   # (latitude, longitude) of each train site, in radians
+        self.values = None        # (dates x sites) PM2.5 reading of each train site on each date, NaN if missing
+
+    def build_date_index(self, df):
         '''
-        Trains NN for each unique date and saves to list of models.
+        Sorts the readings of df once by date into a CSR-style index: the readings of
+        date self.dates[i] are rows date_ptr[i]:date_ptr[i+1] of the sorted order.
+        Returns (order, date_ptr).
+        '''
+        order = np.argsort(df['Date'].values, kind='stable')
+        sorted_dates = df['Date'].values[order]
+        self.dates, date_ptr = np.unique(sorted_dates, return_index=True)
+        date_ptr = np.append(date_ptr, len(order))
+        return order, date_ptr
+
+    def neighbor_table(self, coords, exclude_self=False):
+        '''
+        Orders the train sites by distance from each of the given coordinates
+        (see site_neighbor_table).
+        '''
+        return site_neighbor_table(coords, self.site_coords, exclude_self)
+
+    def nearest_available(self, date_idx, site_idx, neighbors, distances, num_processes=1):
+        '''
+        Finds the nearest train site with a reading on the date of each query
+        (see nearest_available).
+        '''
+        return nearest_available(self.values, date_idx, site_idx, neighbors, distances, num_processes)
+
+    def estimate(self, date_idx, site_idx, coords, exclude_self=False):
+        '''
+        Predicts the PM2.5 of each query (date self.dates[date_idx], site at coords[site_idx])
+        from its nearest train site with a reading on that date. If exclude_self, coords are
+        the train sites and each site is left out of its own neighbors.
+        Returns (prediction, distance) arrays, NaN where no prediction can be made.
+        '''
+        neighbors, distances = self.neighbor_table(coords, exclude_self)
+        return self.nearest_available(date_idx, site_idx, neighbors, distances)
+
+    def index_train_readings(self):
+        '''
+        Indexes the train readings by date and site: sets dates, site_ids, site_coords and 
+        values. Returns the (date_idx, site_idx, PM2.5) of the train readings, sorted by date.
         '''
-        
         self.train_df = self.train_df[self.train_df['Daily Mean PM2.5 Concentration'] < self.threshold]
-    
-        for date in self.train_df['Date']:
-            self.dates.add(date)
 
-        MSE = 0
-        num_predictions = 0
-        num_dates = len(self.dates)
-        all_y_train, all_y_train_pred = [], []
-        
-        # Goes date by date to get nearest neighbor on that date
-        # Each date has a list of stations that have measuerments from that date
+        order, date_ptr = self.build_date_index(self.train_df)
+        site_idx, self.site_ids = pd.factorize(np.asarray(self.train_df['Site ID']))
+        first_rows = np.unique(site_idx, return_index=True)[1]
+        self.site_coords = np.radians(self.train_df[['SITE_LATITUDE', 'SITE_LONGITUDE']].values[first_rows])
 
-        for idx, date in enumerate(self.dates):
-            if idx % 10 == 0:
-                print("Processing date {}/{}: {} ".format(idx, num_dates, date))
-        
-            tr_date_df = self.train_df[self.train_df['Date']==date]
-       
-            # X info is latitude, longitude; y is PM2.5; epa_set_ids tracks corresponnding site_ids
-            X_train = []
-            y_train = []
-
-            for i in range(len(tr_date_df)):
-                lat = np.radians(tr_date_df['SITE_LATITUDE'][tr_date_df.index[i]])
-                long = np.radians(tr_date_df['SITE_LONGITUDE'][tr_date_df.index[i]])
-                pm = tr_date_df['Daily Mean PM2.5 Concentration'][tr_date_df.index[i]]
-                epa_site_id = tr_date_df['Site ID'][tr_date_df.index[i]]
-                X_train.append([lat,long]) 
-                y_train.append(pm)
-                
-            # Nearest neighbors for each date, as determined by haversine (distance between lat,lon coordinate pairs)
-            knn = KNeighborsRegressor(n_neighbors=1, metric="haversine")
-            knn.fit(X_train,y_train)
-            
-            # Get the nearest neighbors of train data (not including point itself)
-            y_train_nn_indices = knn.kneighbors(X_train)[1]
-            y_train_nn_indices = [y for x in y_train_nn_indices for y in x] # flatten the list
-            y_train_pred = np.asarray(y_train)[y_train_nn_indices]
-
-            all_y_train.append(y_train)
-            all_y_train_pred.append(y_train_pred.tolist())
-            
-            # Save the model to dict of all models
-            self.models[date] = knn
-
-        all_y_train = utils.flatten(all_y_train)
-        all_y_train_pred = utils.flatten(all_y_train_pred)
+        # Reading of each site on each date (the first one if a site has several on a date)
+        date_idx = np.repeat(np.arange(len(self.dates)), np.diff(date_ptr))
+        pms = self.train_df['Daily Mean PM2.5 Concentration'].values[order].astype(np.float64)
+        self.values = np.full((len(self.dates), len(self.site_ids)), np.nan)
+        self.values[date_idx[::-1], site_idx[order][::-1]] = pms[::-1]
+        print("Indexed {} train readings over {} dates and {} sites".format(len(order), len(self.dates), len(self.site_ids)))
+        return date_idx, site_idx[order], pms
+
+    def index_test_readings(self, test_csv):
+        '''
+        Reads the test readings of test_csv on the train dates, sorted by date.
+        Returns (test_df, date_idx, site_idx, coordinates of each test site in radians).
+        '''
+        self.test_df = utils.read_table(test_csv)
+        self.test_df = self.test_df[self.test_df['Daily Mean PM2.5 Concentration'] < self.threshold]
+
+        # Only dates with train readings can be predicted
+        test_dates = self.test_df['Date'].values
+        date_idx = np.minimum(np.searchsorted(self.dates, test_dates), len(self.dates) - 1)
+        has_date = self.dates[date_idx] == test_dates
+        order = np.argsort(date_idx[has_date], kind='stable')
+        test_df = self.test_df[has_date].iloc[order]
+        date_idx = date_idx[has_date][order]
+
+        site_idx = pd.factorize(np.asarray(test_df['Site ID']))[0]
+        first_rows = np.unique(site_idx, return_index=True)[1]
+        test_coords = np.radians(test_df[['SITE_LATITUDE', 'SITE_LONGITUDE']].values[first_rows])
+        return test_df, date_idx, site_idx, test_coords
+
+    def train(self):
+        '''
+        Indexes the train readings by date and site, and reports the leave-self-out
+        predictions on the train sites.
+        '''
+        date_idx, site_idx, pms = self.index_train_readings()
+        y_train_pred, _ = self.estimate(date_idx, site_idx, self.site_coords, exclude_self=True)
+        found = ~np.isnan(y_train_pred)
+        all_y_train, all_y_train_pred = pms[found], y_train_pred[found]
 
         r2_train = r2_score(all_y_train, all_y_train_pred)
         pearson_train = pearsonr(all_y_train, all_y_train_pred)
-        MSE_train = ((np.asarray(all_y_train)-np.asarray(all_y_train_pred))**2).sum()/len(all_y_train)
+        MSE_train = ((all_y_train-all_y_train_pred)**2).sum()/len(all_y_train)
 
         print("Train MSE all dates:  {}".format(MSE_train))
         print("Train r2 all dates:  {}".format(r2_train))
@@ -93,58 +191,20 @@ class NearestNeighborBaseline():
                             
     def predict(self, test_csv):
         '''
-        Uses models trained for each date to predict on the test sites given in test_
+        Predicts the PM2.5 of the test sites given in test_csv on every train date from 
+        the train sites with a reading on that date (see estimate). Distances are haversine 
+        distances in radians.
         '''
-        
-        self.test_df = pd.read_csv(test_csv)
-        self.test_df = self.test_df[self.test_df['Daily Mean PM2.5 Concentration'] < self.threshold]
+        test_df, date_idx, site_idx, test_coords = self.index_test_readings(test_csv)
+        y_pred, dists = self.estimate(date_idx, site_idx, test_coords)
+        found = ~np.isnan(y_pred)
+        test_df, y_pred, dists = test_df[found], y_pred[found], dists[found]
 
-        all_y_test, all_y_pred = [], []
-        all_states, all_months = [], []
-        all_dists = []
-        
-        for idx, date in enumerate(self.dates):
-           
-            test_date_df = self.test_df[self.test_df['Date']==date]
-
-            # X info is latitude, longitude; y is PM2.5; epa_set_ids tracks corresponnding site_ids
-            X_test, y_test = [], []
-            states, months = [], []
-            
-            for i in range(len(test_date_df)):
-                lat = np.radians(test_date_df['SITE_LATITUDE'][test_date_df.index[i]])
-                long = np.radians(test_date_df['SITE_LONGITUDE'][test_date_df.index[i]])
-                pm = test_date_df['Daily Mean PM2.5 Concentration'][test_date_df.index[i]]
-                state = test_date_df['STATE'][test_date_df.index[i]]
-                month = test_date_df['Month'][test_date_df.index[i]]
-                X_test.append([lat,long]) 
-                y_test.append(pm)
-                states.append(state)
-                months.append(month)
-
-            # Get the trained nn model for the current date
-            knn = self.models[date]
-            y_pred = knn.predict(X_test).tolist()
-        
-            # Get the distance of the nearest neighbor
-            neighbor_distances_indices = knn.kneighbors(X_test)
-            y_test_nn_distances = (neighbor_distances_indices[0].flatten()).tolist()
-           
-            # Append this date's predictions/labels to list of all predictions/labels
-            all_y_test.append(y_test)
-            all_y_pred.append(y_pred)
-            
-            # Save states, months, and distances for analysis
-            all_states.append(states)
-            all_months.append(months)
-            all_dists.append(y_test_nn_distances)
-            
-        all_y_test = utils.flatten(all_y_test)
-        all_y_pred = utils.flatten(all_y_pred)
-
-        all_states = utils.flatten(all_states)
-        all_months = utils.flatten(all_months)
-        all_dists = utils.flatten(all_dists)
+        all_y_test = test_df['Daily Mean PM2.5 Concentration'].values.tolist()
+        all_y_pred = y_pred.tolist()
+        all_states = np.asarray(test_df['STATE']).tolist()
+        all_months = test_df['Month'].values.tolist()
+        all_dists = dists.tolist()
         
         r2 = r2_score(all_y_test, all_y_pred)
         pearson = pearsonr(all_y_test, all_y_pred)
@@ -181,10 +241,8 @@ def plot_mse_vs_dist(predictions_csv):
     and returns the correlation coefficient between MSE and distance.
     '''
     
-    pandarallel.initialize()
-
     df = pd.read_csv(predictions_csv)
-    mses = df.parallel_apply(utils.mse_row, axis=1)
+    mses = metrics.squared_errors(df)
     dists = df['Distance from Nearest Site']
     pearson = pearsonr(dists, mses)
     plt.scatter(dists, mses, s=1)
@@ -6,148 +6,101 @@ from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn.utils import shuffle
 import sys
-sys.path.insert(0, '/home/sarahciresi/gcloud/cs325b-airquality/DataVisualization')
-sys.path.insert(0, '/home/sarahciresi/gcloud/cs325b-airquality/data_csv_files')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DataVisualization'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from  modis_vis_with_epa import get_modis_means, get_epa, epa_to_modis_file_name, plot_pm_vs_modis
 #import matplotlib 
 #matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 from read_tiff import flatten
+import utils
+from add_column import epa_to_file_names
+from knn_baseline import site_neighbor_table, nearest_available
 
-def run_baseline_model(master_csv):
-    
-    df = pd.read_csv(master_csv)
-    
-    dates = set()
-    for date in df['Date']:
-        dates.add(date)
-
-    MSE = 0
-    num_predictions = 0
-    
-    all_date_y_train = []
-    all_date_y_test = []
-    all_date_y_pred = []
-    all_date_y_train_preds = []
-    all_date_epa_site_train_order = []
-    all_date_epa_site_test_order = []
-    all_dates_train = []
-    all_dates_test = []
-
-    # Goes date by date to get MSE
-    # Each date has a list of stations that have measuerments from that date
-
-    for idx, date in enumerate(dates):
-        if idx % 10 == 0:
-            print("Processing date {}: {} ".format(idx, date))
-        
-        date_df = df[df['Date']==date]
-
-        # X info is latitude, longitude; y is PM2.5; epa_set_ids tracks corresponnding site_ids
-        X = []
-        y = []
-        epa_site_ids = []
-        cur_date = []
+TEST_SIZE = 0.3
+MODIS_MEAN_COLUMNS = ['Green mean', 'Blue mean']
 
-        for i in range(len(date_df)):
-            lat = np.radians(date_df['SITE_LATITUDE'][date_df.index[i]])
-            long = np.radians(date_df['SITE_LONGITUDE'][date_df.index[i]])
-            pm = date_df['Daily Mean PM2.5 Concentration'][date_df.index[i]]
-            epa_site_id = date_df['Site ID'][date_df.index[i]]
-            X.append([lat,long]) 
-            y.append(pm)
-            epa_site_ids.append(epa_site_id)
-            cur_date.append(date)
-
-        # Shuffle data and split into train/test sets
-        X, y, epa_site_ids = shuffle(X, y, epa_site_ids)
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, shuffle=False) # already shuffled
-        X_train_, X_test_, epa_site_train, epa_site_test =  train_test_split(X, epa_site_ids, test_size=0.3, shuffle=False)
-        _, _, cur_date_train, cur_date_test = train_test_split(X,  cur_date, test_size=0.3, shuffle=False)
-
-        # nearest neighbors, as determined by haversine (distance between latitude,longitude coordinate pairs)
-        knn = KNeighborsRegressor(n_neighbors=1,metric="haversine")
-        knn.fit(X_train,y_train)
-        y_pred = knn.predict(X_test)
-
-        # Combine PM prediction from nearest neighbor with 2x2 aod data in simple linear regression model
-
-        # Get the nearest neighbors of train data (not including point itself)
-        y_train_nn_indices = knn.kneighbors(X_train)[1]
-        y_train_nn_indices = [y for x in y_train_nn_indices for y in x] # flatten the list
-        y_train_preds = np.asarray(y_train)[y_train_nn_indices]
+def split_readings_by_date(dates, test_size=TEST_SIZE, seed=None):
+    '''
+    Randomly splits the readings of every date into train and test sets with a single
+    sort, holding out test_size of the readings of each date (rounded up, as 
+    train_test_split does). Returns a boolean array, True for test readings.
+    '''
+    random_state = np.random.RandomState(seed)
+    date_codes = pd.factorize(dates)[0]
+    order = np.lexsort((random_state.random_sample(len(date_codes)), date_codes))
+    counts = np.bincount(date_codes)
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(date_codes), dtype=np.int64)
+    rank[order] = np.arange(len(date_codes)) - starts[date_codes[order]]
+    return rank < np.ceil(test_size * counts[date_codes])
+
+def nearest_neighbor_pm(df, is_train, num_processes=1):
+    '''
+    Computes the PM2.5 of the nearest other site with a train reading on the same date,
+    for all the (site, date) readings of df at once (see knn_baseline.nearest_available).
+    NaN where no other site has a train reading on that date.
+    '''
+    date_idx = pd.factorize(df['Date'].values, sort=True)[0]
+    site_idx, site_ids = pd.factorize(np.asarray(df['Site ID']))
+    first_rows = np.unique(site_idx, return_index=True)[1]
+    site_coords = np.radians(df[['SITE_LATITUDE', 'SITE_LONGITUDE']].values[first_rows])
+    pms = df['Daily Mean PM2.5 Concentration'].values.astype(np.float64)
 
-        all_date_y_train_preds.append(y_train_preds.tolist())
-        all_date_y_pred.append(y_pred)
-        all_date_y_train.append(y_train)
-        all_date_y_test.append(y_test)
-        all_date_epa_site_train_order.append(epa_site_train)
-        all_date_epa_site_test_order.append(epa_site_test)
-        all_dates_train.append(cur_date_train)
-        all_dates_test.append(cur_date_test)
+    # Train reading of each site on each date (the first one if a site has several on a date)
+    values = np.full((date_idx.max() + 1, len(site_ids)), np.nan)
+    values[date_idx[is_train][::-1], site_idx[is_train][::-1]] = pms[is_train][::-1]
 
-    # Flatten list all lists
-    all_date_y_train_preds = flatten(all_date_y_train_preds)
-    all_date_y_pred = flatten(all_date_y_pred)
-    all_date_y_train = flatten(all_date_y_train)
-    all_date_y_test = flatten(all_date_y_test)
-    all_date_epa_site_train_order = flatten(all_date_epa_site_train_order)
-    all_date_epa_site_test_order = flatten(all_date_epa_site_test_order)
-    all_dates_train = flatten(all_dates_train)
-    all_dates_test = flatten(all_dates_test)
+    neighbors, distances = site_neighbor_table(site_coords, site_coords, exclude_self=True)
+    nn_pms, _ = nearest_available(values, date_idx, site_idx, neighbors, distances, num_processes)
+    return nn_pms
 
-    X_aod_train = np.asarray(all_date_y_train_preds).reshape(-1,1)
-    X_aod_test = np.asarray(all_date_y_pred).reshape(-1,1)
+def add_modis_means(df, modis_path):
+    '''
+    Returns the MODIS Green/Blue means (see read_tiff.scan_modis) of every reading of df,
+    joined once on the MODIS filename. NaN where there is no MODIS image.
+    '''
+    modis = utils.read_table(modis_path).drop_duplicates(subset='Filename').set_index('Filename')
+    modis_files = epa_to_file_names(df['Date'].values, np.asarray(df['Site ID']))
+    return modis[MODIS_MEAN_COLUMNS].reindex(modis_files.values).values.astype(np.float64)
 
-    num_sites_for_all_dates_train = len(all_date_epa_site_train_order)
-    num_sites_for_all_dates_test = len(all_date_epa_site_test_order)
+def run_baseline_model(master_csv, modis_path=None, test_size=TEST_SIZE, seed=None, num_processes=1):
     '''
-    green_means_train = np.zeros((num_sites_for_all_dates_train, 1))
-    blue_means_train = np.zeros((num_sites_for_all_dates_train, 1))
-    green_means_test = np.zeros((num_sites_for_all_dates_test, 1))
-    blue_means_test  = np.zeros((num_sites_for_all_dates_test, 1))
+    Nearest neighbor + AOD baseline. The readings of each date are split into train and test 
+    sets, the PM2.5 of the nearest site with a train reading on the same date is used as feature
+    of every reading (leaving the site itself out), optionally with the MODIS means of modis_path,
+    and a linear regression is fit on the stacked train features.
+    '''
+    df = utils.read_table(master_csv)
+    is_test = split_readings_by_date(df['Date'].values, test_size, seed)
     
-    print("Beginning mean lookup")
-
-    for idx, epa_site in enumerate(all_date_epa_site_train_order):
-        modis_filename = epa_to_modis_file_name(all_dates_train[idx], epa_site)
-        modis_row = modis_means[modis_means['Filename']==modis_filename]
-        green_mean = modis_row['Green mean'][modis_row.index[0]]
-        blue_mean = modis_row['Blue mean'][modis_row.index[0]]
-        green_means_train[idx] = green_mean
-        blue_means_train[idx] = blue_mean
-            
-    for idx, epa_site in enumerate(all_date_epa_site_test_order):
-        modis_filename = epa_to_modis_file_name(all_dates_test[idx], epa_site)
-        modis_row = modis_means[modis_means['Filename']==modis_filename]
-        green_mean = modis_row['Green mean'][modis_row.index[0]]
-        blue_mean = modis_row['Blue mean'][modis_row.index[0]]
-        green_means_test[idx] = green_mean
-        blue_means_test[idx] = blue_mean
-
-    print("Finished mean lookup")
+    print("Computing nearest neighbor PM2.5 of {} readings".format(len(df)))
+    X = nearest_neighbor_pm(df, ~is_test, num_processes).reshape(-1, 1)
+    
+    # Combine PM prediction from nearest neighbor with aod data in simple linear regression model
+    if modis_path is not None:
+        X = np.concatenate((X, add_modis_means(df, modis_path)), axis=1)
+    y = df['Daily Mean PM2.5 Concentration'].values
+    
+    valid = ~np.isnan(X).any(axis=1)
+    print("Dropping {} readings without features".format((~valid).sum()))
+    X_train, y_train = X[valid & ~is_test], y[valid & ~is_test]
+    X_test, y_test = X[valid & is_test], y[valid & is_test]
 
-    X_aod_train = np.concatenate((X_aod_train, green_means_train, blue_means_train), axis=1)
-    X_aod_test = np.concatenate((X_aod_test, green_means_test, blue_means_test), axis=1)
-    '''
     print("Training LR")
-    reg = LinearRegression().fit(X_aod_train, all_date_y_train)
+    reg = LinearRegression().fit(X_train, y_train)
     
-    r2_score_train = reg.score(X_aod_train, all_date_y_train)
-    r2_score_test = reg.score(X_aod_test, all_date_y_test)
+    r2_score_train = reg.score(X_train, y_train)
+    r2_score_test = reg.score(X_test, y_test)
 
     print("R2 train: {}".format(r2_score_train))
     print("R2 test: {}".format(r2_score_test))
 
-    y_pred_lr = reg.predict(X_aod_test)
-    
-    diff = np.square(np.asarray(y_pred_lr) - np.asarray(all_date_y_test))
-    MSE = diff.sum()
-    num_predictions = len(all_date_y_test)
-    #print("Adding squared error of {} for date {}.".format(diff.sum()/len(y_test), date))
-
-    MSE = MSE/num_predictions   
+    y_pred_lr = reg.predict(X_test)
+    MSE = np.square(y_pred_lr - y_test).sum()/len(y_test)
     print("Mean squared error across all dates:  {}".format(MSE))
+    return reg, r2_score_train, r2_score_test, MSE
     
     
 def plot_pm(epa_df, modis_df, mode="<50"):
@@ -194,15 +147,15 @@ if __name__ == "__main__":
     
     #modis_means_2016 = get_modis_means(means_file, modis_dir)
     #epa_2016 = get_epa(epa_dir, year = "2016")
-    run_baseline_model(master_csv)
+    run_baseline_model(master_csv, num_processes=os.cpu_count())
     #plot_pm(epa_2016, modis_means_2016)
 
     
 # Old KNN baseline      
-def run_baseline_model(train_csv, test_csv):
+def run_old_baseline_model(train_csv, test_csv):
 
-    train_df = pd.read_csv(train_csv)
-    test_df = pd.read_csv(test_csv)
+    train_df = utils.read_table(train_csv)
+    test_df = utils.read_table(test_csv)
     
     train_df = train_df[train_df['Daily Mean PM2.5 Concentration'] < 20.5]
     test_df = test_df[test_df['Daily Mean PM2.5 Concentration'] < 20.5]
@@ -1,21 +1,16 @@
 import os
 import pandas
 import numpy as np
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
 import datetime
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_squared_error, r2_score
 from sklearn import datasets, linear_model
-files = os.listdir()
-first_file = True
-#reads in all relevant csvs
-for file in files:
-    if file[-4:]==".csv" and file != "broken_modis_channel_means.csv" and file !="modis_channel_means_revised.csv":
-        new_df = pandas.read_csv(file)
-        if not first_file:
-            df = df.append(new_df,ignore_index=True)
-        else:
-            df = new_df
-            first_file = False
+#reads in all relevant csvs concurrently and concatenates them once
+files = [file for file in sorted(os.listdir()) if file[-4:]==".csv" and file != "broken_modis_channel_means.csv" and file !="modis_channel_means_revised.csv"]
+df = utils.read_csv_files(files, dtype=utils.EPA_CSV_DTYPES)
 print("Filtering for PM < 50")
 df = df[df['Daily Mean PM2.5 Concentration']<50]
 X = []
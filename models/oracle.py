@@ -1,22 +1,15 @@
 import os
 import pandas
 import numpy as np
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
 #assumes it's in the same folder as all the epa csvs
 #predicts that each datapoint's PM2.5 is the same as the reading before it at the same site
 
-files = os.listdir()
-first_file = True
-file_num = 0
-#reads in all relevant csvs
-for file in files:
-    if file[-4:]==".csv" and file != "broken_modis_channel_means.csv" and file !="modis_channel_means_revised.csv":
-        new_df = pandas.read_csv(file)
-        if not first_file:
-            df = df.append(new_df,ignore_index=True)
-        else:
-            df = new_df
-            first_file = False
-        file_num+=1
+#reads in all relevant csvs concurrently and concatenates them once
+files = [file for file in sorted(os.listdir()) if file[-4:]==".csv" and file != "broken_modis_channel_means.csv" and file !="modis_channel_means_revised.csv"]
+df = utils.read_csv_files(files, dtype=utils.EPA_CSV_DTYPES)
 df['Date'] = pandas.to_datetime(df.Date)
 #makes sure dates are in order
 df.sort_values(by = ['Date'],inplace=True,ascending=True)
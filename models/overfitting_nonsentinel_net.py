@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas
 import numpy as np
 import torch
@@ -12,6 +13,8 @@ from sklearn import preprocessing
 from sklearn.metrics import mean_squared_error, r2_score, classification_report
 import scipy.stats
 from sklearn import datasets, linear_model
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
 
 PROCESSED_DATA_FOLDER = "processed_data"
 
@@ -164,7 +167,7 @@ std = np.array([  5.27143519,  17.4077515,    3.35727818,   0.55251727,   0.5530
   99.77715125])      
 
 def get_data(filename,under_fifty=True,filter_empty_temp=True, single_month = False, single_year = False,filter_modis=False):    
-    df = pandas.read_csv(filename)
+    df = utils.read_table(filename)
     df = df[df['TMAX'].notnull()]
     df = df[df['TMIN'].notnull()]
     #print("before filter")
@@ -78,6 +78,9 @@ def train(model, optimizer, loss_fn, dataloader, batch_size, epoch, t_global_ste
    
     print("Training for one epoch on {} batches.".format(num_batches))
           
+    predictions_writer = utils.PredictionWriter("predictions/sent_dnn" + str(epoch) + ".csv",
+                                                len(dataloader.dataset))
+    
     with tqdm(total=num_batches) as t:
         
         for i, sample in enumerate(dataloader):
@@ -119,13 +122,14 @@ def train(model, optimizer, loss_fn, dataloader, batch_size, epoch, t_global_ste
             
             # Save predictions every 10 epochs to compute r2 over full dataset            
             if epoch % 10 == 0:
-                curr_batch_size = outputs.shape[0]  
-                utils.save_predictions(indices, outputs, labels, sites, dates, states, curr_batch_size, 
-                                       "predictions/sent_dnn" + str(epoch) + ".csv") 
+                predictions_writer.add(indices, outputs, labels, sites, dates, states)
           
             del inputs, features, labels, outputs
             torch.cuda.empty_cache()
   
+    # Written in the background while the next epoch runs
+    predictions_writer.flush()
+    
     # Save metrics
     mean_metrics = {metric: np.mean([x[metric] for x in summaries]) for metric in summaries[0]} 
     metrics_string = " ; ".join("{}: {:05.3f}".format(k, v) for k, v in mean_metrics.items())
@@ -148,6 +152,9 @@ def evaluate(model, loss_fn, dataloader, dataset, batch_size, epoch, v_global_st
     
     print("Evaluating on {} batches".format(num_batches))
                      
+    predictions_writer = utils.PredictionWriter("predictions/sent_dnn" + dataset + "_16_mini_epoch_" + str(epoch) + ".csv",
+                                                len(dataloader.dataset))
+    
     with tqdm(total=num_batches) as t:
         with torch.no_grad():
             for i, sample in enumerate(dataloader):
@@ -172,9 +179,7 @@ def evaluate(model, loss_fn, dataloader, dataset, batch_size, epoch, v_global_st
                 sites, dates = sites.data.cpu().numpy(), dates.data.cpu().numpy()
                 
                 # Save predictions to compute r2 over full dataset
-                curr_batch_size = outputs.shape[0]  
-                utils.save_predictions(indices, outputs, labels, sites, dates, states, curr_batch_size, 
-                                       "predictions/sent_dnn" + dataset + "_16_mini_epoch_" + str(epoch) + ".csv") 
+                predictions_writer.add(indices, outputs, labels, sites, dates, states)
           
                 # Compute batch metrics
                 r2 = r2_score(labels, outputs)
@@ -190,6 +195,9 @@ def evaluate(model, loss_fn, dataloader, dataset, batch_size, epoch, v_global_st
                 del inputs, features, labels, outputs
                 torch.cuda.empty_cache()
    
+    # Written in the background while the next epoch runs
+    predictions_writer.flush()
+    
     mean_metrics = {metric: np.mean([x[metric] for x in summaries]) for metric in summaries[0]}    
     metrics_string = " ; ".join("{}: {:05.3f}".format(k, v) for k, v in mean_metrics.items())
     print("Evaluation metrics: {}".format(metrics_string))
@@ -266,6 +274,9 @@ def train_and_evaluate(model, optimizer, loss_fn, train_dataloader,
     utils.plot_r2(all_train_r2, all_val_r2, num_epochs, num_train, 
                   save_as="plots/r2_"+str(num_train)+"ex.png")
                     
+    # Make sure the predictions written in the background were saved
+    utils.wait_for_prediction_writes()
+
     # Return train and eval metrics
     return train_mean_metrics, val_mean_metrics
 
@@ -285,6 +296,7 @@ def predict(model, loss_fn, dataloader, batch_size, num_epochs,
     mean_metrics, v_global_step = evaluate(model, loss_fn, dataloader, dataset, batch_size, epoch, 0)
     r2 = mean_metrics['average r2']
     print("Mean R2 for {} dataset: {}".format(dataset, r2))
+    utils.wait_for_prediction_writes()
     
     
 
@@ -0,0 +1,184 @@
+import os
+import glob
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Files up to this size are fingerprinted by content, larger ones by size and mtime
+CONTENT_HASH_MAX_BYTES = 64 * 1024 * 1024
+
+def fingerprint_file(file_path):
+    """
+    Returns a hash of a single file: its content if it is at most
+    CONTENT_HASH_MAX_BYTES, otherwise its size and modification time.
+    """
+    stat = os.stat(file_path)
+    if stat.st_size > CONTENT_HASH_MAX_BYTES:
+        return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+    sha = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def fingerprint_input(pattern):
+    """
+    Returns a hash of a stage input, given as a file path or a glob pattern.
+
+    A single file is fingerprinted with fingerprint_file. A pattern matching
+    several files (e.g. every Sentinel image of a year) is fingerprinted by
+    the names, sizes and modification times of the matched files, which
+    avoids reading every image on each run.
+
+    Parameters
+    ----------
+    pattern : str
+        Path of a file, or glob pattern (see glob.glob).
+
+    Returns
+    -------
+    fingerprint : str
+        Hash of the input. Missing inputs hash to "missing".
+    """
+    if glob.has_magic(pattern):
+        sha = hashlib.sha1()
+        for file_path in sorted(glob.glob(pattern)):
+            stat = os.stat(file_path)
+            sha.update("{}:{}:{}\n".format(file_path, stat.st_size, stat.st_mtime_ns).encode())
+        return sha.hexdigest()
+    if not os.path.isfile(pattern):
+        return "missing"
+    return fingerprint_file(pattern)
+
+
+class Stage(object):
+    """
+    A named step of a Pipeline, with declared inputs, outputs and parameters.
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, deps=()):
+        """
+        Parameters
+        ----------
+        name : str
+            Unique name of the stage, also used as its key in the saved state.
+        func : callable
+            Called without arguments to run the stage.
+        inputs : list[str]
+            Files or glob patterns read by the stage (see fingerprint_input).
+        outputs : list[str]
+            Files or glob patterns written by the stage. The stage is rerun if
+            any of them is missing.
+        params : dict
+            JSON-serializable parameters that change the outputs of the stage.
+        deps : list[str]
+            Names of the stages that must run before this one.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.deps = list(deps)
+
+    def key(self):
+        """
+        Returns the hash of the stage's parameters and input fingerprints.
+        """
+        description = {"name": self.name, "params": self.params,
+                       "inputs": [(pattern, fingerprint_input(pattern)) for pattern in self.inputs]}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def outputs_exist(self):
+        return all(glob.glob(pattern) if glob.has_magic(pattern) else os.path.exists(pattern)
+                   for pattern in self.outputs)
+
+
+class Pipeline(object):
+    """
+    Runs Stages in dependency order, skipping every stage whose key (hash of
+    its inputs and parameters) matches the key saved after its last
+    successful run. Each stage starts as soon as its dependencies are done,
+    so independent stages run concurrently.
+    """
+    def __init__(self, stages, state_path, num_workers=4):
+        """
+        Parameters
+        ----------
+        stages : list[Stage]
+            Stages of the pipeline.
+        state_path : str
+            Path of the .json file storing the key of every stage.
+        num_workers : int
+            Maximum number of stages run at the same time.
+        """
+        self.stages = stages
+        self.state_path = state_path
+        self.num_workers = num_workers
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def run_stage(self, stage, state, force=False):
+        """
+        Runs a stage unless it is up to date, and records its key. Returns
+        True if the stage was run.
+        """
+        if not force and state.get(stage.name) == stage.key() and stage.outputs_exist():
+            print("Stage {} is up to date, skipping".format(stage.name))
+            return False
+        print("Running stage {}...".format(stage.name))
+        stage.func()
+        # Recompute after running, as some stages modify their inputs in place
+        state[stage.name] = stage.key()
+        return True
+
+    def run(self, force=False):
+        """
+        Runs every stage that is not up to date (or every stage if force is
+        True).
+
+        Returns
+        -------
+        ran : list[str]
+            Names of the stages that were run.
+        """
+        names = set(stage.name for stage in self.stages)
+        for stage in self.stages:
+            unknown = [dep for dep in stage.deps if dep not in names]
+            if unknown:
+                raise ValueError("Stage {} depends on unknown stages {}".format(stage.name, unknown))
+        state = self.load_state()
+        done, ran = set(), []
+        remaining = list(self.stages)
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                while remaining or running:
+                    for stage in [stage for stage in remaining if all(dep in done for dep in stage.deps)]:
+                        running[executor.submit(self.run_stage, stage, state, force)] = stage
+                        remaining.remove(stage)
+                    if not running:
+                        raise ValueError("Cyclic dependencies between stages {}".format(
+                            [stage.name for stage in remaining]))
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        if future.result():
+                            ran.append(stage.name)
+                        done.add(stage.name)
+        finally:
+            # Keep the keys of the stages that completed, even if another one failed
+            self.save_state(state)
+        return ran
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import pandas as pd
+import utils
+
+NUM_SENTINEL_BANDS = 13
+SENTINEL_CROP_SIZE = 200
+PACKED_IMAGE_SHAPE = (NUM_SENTINEL_BANDS, SENTINEL_CROP_SIZE, SENTINEL_CROP_SIZE)
+SENTINEL_YEARS = ["2016", "2017"]
+
+def packed_array_path(packed_dir, year):
+    """
+    Returns the path of the packed (N, 13, 200, 200) uint16 array for a year.
+    """
+    return os.path.join(packed_dir, "s2_{}_packed.npy".format(year))
+
+def packed_index_path(packed_dir, year):
+    """
+    Returns the path of the .csv mapping .npy filenames to rows of the packed
+    array for a year.
+    """
+    return os.path.join(packed_dir, "s2_{}_packed_index.csv".format(year))
+
+def pack_sentinel_year(sentinel_folder_path, packed_dir, year, filenames=None):
+    """
+    Packs every Sentinel .npy image of a given year into one contiguous
+    uint16 array of shape (N, 13, 200, 200), stored as a .npy file so it can
+    be memory-mapped, together with a .csv row index.
+
+    The index is written last, so an interrupted run leaves no index behind
+    and the year is simply treated as unpacked by SentinelStore.
+
+    Parameters
+    ----------
+    sentinel_folder_path : str
+        Absolute path to the Sentinel data folder (containing one folder per
+        year of s2_<year>_<month>_<site>_<idx>.npy files).
+    packed_dir : str
+        Folder in which to save the packed array and its index.
+    year : str
+        Year to pack (e.g. "2016").
+    filenames : list[str], optional
+        Only pack these .npy filenames (e.g. the ones referenced by a master
+        csv). By default every s2*.npy file in the year folder is packed.
+
+    Returns
+    -------
+    num_packed : int
+        Number of images written to the packed array.
+    """
+    year = str(year)
+    year_folder = os.path.join(sentinel_folder_path, year)
+    if filenames is None:
+        filenames = [f for f in os.listdir(year_folder)
+                     if f.startswith("s2") and f.endswith(".npy")]
+    filenames = sorted(set(filenames))
+
+    # Check shapes from the .npy headers first so the packed array is sized exactly
+    valid_filenames = []
+    for filename in filenames:
+        try:
+            shape = np.load(os.path.join(year_folder, filename), mmap_mode="r").shape
+        except (FileNotFoundError, ValueError, OSError):
+            print("Skipping unreadable file {}".format(filename))
+            continue
+        if shape != (SENTINEL_CROP_SIZE, SENTINEL_CROP_SIZE, NUM_SENTINEL_BANDS):
+            print("Skipping file {} with shape {}".format(filename, shape))
+            continue
+        valid_filenames.append(filename)
+
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+    index_path = packed_index_path(packed_dir, year)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    print("Packing {} images from {} into {}".format(len(valid_filenames), year_folder, packed_dir))
+    packed = np.lib.format.open_memmap(packed_array_path(packed_dir, year), mode="w+", dtype=np.uint16,
+                                       shape=(len(valid_filenames),) + PACKED_IMAGE_SHAPE)
+    for row, filename in enumerate(valid_filenames):
+        if row % 10000 == 0:
+            print("Packed {}/{} images".format(row, len(valid_filenames)))
+        image = np.load(os.path.join(year_folder, filename))
+        packed[row] = image.transpose((2, 0, 1))
+    packed.flush()
+    del packed
+
+    index_df = pd.DataFrame({"Filename": valid_filenames, "Row": np.arange(len(valid_filenames))})
+    index_df.to_csv(index_path, index=False)
+    return len(valid_filenames)
+
+def pack_all_sentinel_years(sentinel_folder_path, packed_dir, years=SENTINEL_YEARS):
+    """
+    Packs the Sentinel .npy images of every year in years. See
+    pack_sentinel_year.
+    """
+    for year in years:
+        pack_sentinel_year(sentinel_folder_path, packed_dir, year)
+
+
+class SentinelStore(object):
+    """
+    Read-only access to the packed per-year Sentinel arrays written by
+    pack_sentinel_year. The arrays are memory-mapped lazily on first access,
+    so the store can be pickled into DataLoader workers without copying them.
+    """
+    def __init__(self, packed_dir, years=SENTINEL_YEARS):
+        """
+        Parameters
+        ----------
+        packed_dir : str
+            Folder storing the packed arrays and their indices.
+        years : list[str]
+            Years to load. Years that have not been packed are skipped.
+        """
+        self.packed_dir = packed_dir
+        self.rows = {}  # year -> {npy filename -> row in the packed array}
+        self._arrays = {}
+        for year in years:
+            index_path = packed_index_path(packed_dir, year)
+            if not os.path.exists(index_path):
+                print("No packed Sentinel images for {} in {}".format(year, packed_dir))
+                continue
+            index_df = pd.read_csv(index_path)
+            self.rows[str(year)] = dict(zip(index_df["Filename"], index_df["Row"]))
+
+    def lookup(self, year, npy_filename):
+        """
+        Returns the row of npy_filename in the packed array of the given year,
+        or -1 if the image has not been packed.
+        """
+        return self.rows.get(str(year), {}).get(npy_filename, -1)
+
+    def get_image(self, year, row):
+        """
+        Returns the (13, 200, 200) uint16 image stored at row of the packed
+        array of the given year, as a view into the memory map.
+        """
+        year = str(year)
+        if year not in self._arrays:
+            self._arrays[year] = np.load(packed_array_path(self.packed_dir, year), mmap_mode="r")
+        return self._arrays[year][row]
+
+    def __getstate__(self):
+        # Never pickle the memory maps themselves, each worker reopens them
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
@@ -7,12 +7,14 @@ import torch
 import yaml
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import matplotlib.pyplot as plt
 import seaborn as sns
 import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics import r2_score
-from pandarallel import pandarallel 
 from scipy.stats.stats import pearsonr
+import metrics
 
 HOME_FOLDER = os.path.expanduser("~")
 REPO_NAME = "cs325b-airquality" #"es262-airquality"
@@ -24,34 +26,97 @@ GHCND_DATA_FOLDER = os.path.join(GHCND_BASE_FOLDER, "ghcnd_hcn")
 MODIS_FOLDER = os.path.join(DATA_FOLDER, "modis")
 SENTINEL_FOLDER = os.path.join(DATA_FOLDER, "sentinel")
 SENTINEL_METADATA_FOLDER = os.path.join(DATA_FOLDER, "Metadata")
+SENTINEL_PACKED_FOLDER = os.path.join(DATA_FOLDER, "sentinel_packed")
 PROCESSED_DATA_FOLDER = os.path.join(DATA_FOLDER, "processed_data")
 
+# Per-band Sentinel statistics stored as numeric columns, in model input order
+NUM_SENTINEL_BANDS = 13
+SENTINEL_STATS_NAMES = ['mean', 'min', 'max', 'stdv']
+SENTINEL_STATS_COLUMNS = ["{} B{}".format(stat, band + 1) for stat in SENTINEL_STATS_NAMES
+                          for band in range(NUM_SENTINEL_BANDS)]
+# Older stats csvs store each statistic as a stringified array in one column
+SENTINEL_STATS_STR_COLUMNS = ['means', 'mins', 'maxes', 'stdv']
+
+# Shared schema of the per-state EPA daily PM2.5 csvs, so every file parses alike
+EPA_CSV_DTYPES = {'Date': str, 'Source': str, 'Site ID': np.int64, 'Daily Mean PM2.5 Concentration': np.float64,
+                  'UNITS': str, 'DAILY_AQI_VALUE': np.float64, 'Site Name': str, 'DAILY_OBS_COUNT': np.float64,
+                  'PERCENT_COMPLETE': np.float64, 'AQS_PARAMETER_DESC': str, 'CBSA_CODE': np.float64,
+                  'CBSA_NAME': str, 'STATE': str, 'COUNTY': str, 'SITE_LATITUDE': np.float64,
+                  'SITE_LONGITUDE': np.float64}
+NUM_READ_THREADS = 8
+
+# Columns of the predictions tables written by PredictionWriter
+PREDICTION_COLUMNS = ['Index', 'Prediction', 'Label', 'Site ID', 'Month', 'State']
+_prediction_flush_executor = None
+_pending_prediction_writes = []
+
+WEATHER_COLUMNS = ['PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN']
+MODIS_COLUMNS = ["Blue [0,0]", "Blue [0,1]", "Blue [1,0]", "Blue [1,1]",
+                 "Green [0,0]", "Green [0,1]", "Green [1,0]", "Green [1,1]"]
+
+# Typed schema of the processed tables, stored as Parquet (see read_table/save_table)
+TABLE_CATEGORICAL_COLUMNS = ['Site ID', 'STATE', 'SENTINEL_FILENAME']
+TABLE_DATE_COLUMNS = ['Date']
+TABLE_FLOAT32_COLUMNS = WEATHER_COLUMNS + MODIS_COLUMNS + SENTINEL_STATS_COLUMNS + ['Cloud Fraction']
+
+
+def read_csv_files(file_paths, dtype=None, num_threads=NUM_READ_THREADS):
+    """
+    Reads the given .csv files concurrently and concatenates them once into 
+    one dataframe, in the order of file_paths.
+
+    Parameters
+    ----------
+    file_paths : list[str]
+        Paths of the .csv files to read.
+    dtype : dict, optional
+        Column dtypes shared by every file (e.g. EPA_CSV_DTYPES), passed to
+        pd.read_csv.
+    num_threads : int
+        Number of files read at the same time.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        DataFrame for all of the .csv files, with a fresh index.
+    """
+    if len(file_paths) == 0:
+        return pd.DataFrame()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        dfs = list(executor.map(lambda file_path: pd.read_csv(file_path, dtype=dtype), file_paths))
+    return pd.concat(dfs, ignore_index=True)
 
-def get_epa(epa_directory, year = '2016'):
+def get_epa(epa_directory, year = '2016', cache_folder = None):
     """
-    Gathers all the EPA csv files for a given year
-    located in the directory referenced by epa_directory.
+    Gathers all the EPA csv files for a given year (or every year if year is
+    "any") located in the directory referenced by epa_directory.
     
-    Loads into one dataframe and returns this aggregated dataframe. 
+    Loads into one dataframe and returns this aggregated dataframe. If 
+    cache_folder is given, the dataframe is also saved there as 
+    epa_<year>.parquet and reused as long as it is newer than the EPA csvs.
     """
-    files = os.listdir(epa_directory)
-    first_file = True
-    for file in files:
-        if file[-8:]== year + ".csv" or year == "any":
-            file_path = os.path.join(epa_directory, file)
-            new_df = pd.read_csv(file_path)
-            if not first_file:
-                df = df.append(new_df,ignore_index=True)
-            else:
-                df = new_df
-                first_file = False
+    file_paths = [os.path.join(epa_directory, file) for file in sorted(os.listdir(epa_directory))
+                  if file[-8:] == year + ".csv" or (year == "any" and file.endswith(".csv"))]
+    
+    cache_path = None
+    if cache_folder is not None:
+        cache_path = os.path.join(cache_folder, "epa_{}.parquet".format(year))
+        # The folder's mtime changes when files are added or removed
+        newest_mtime = max([os.path.getmtime(epa_directory)] + [os.path.getmtime(path) for path in file_paths])
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= newest_mtime:
+            return pd.read_parquet(cache_path)
+    
+    df = read_csv_files(file_paths, dtype=EPA_CSV_DTYPES)
+    if cache_path is not None:
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        df.to_parquet(cache_path, index=False)
     return df
 
 def load_csv_dfs(folder_path, blacklist = [], excluded_years = []):
     """
-    Loads all .csv files from the specified folder and concatenates into one
-    giant Pandas dataframe. Potential extension to different file types if we
-    need it.
+    Loads all .csv and .parquet tables from the specified folder (see
+    read_table) and concatenates into one giant Pandas dataframe.
     
     Parameters
     ----------
@@ -66,18 +131,160 @@ def load_csv_dfs(folder_path, blacklist = [], excluded_years = []):
         DataFrame for all of the .csv files in the specified folder.
     """
     df_list = []
-    for filename in os.listdir(folder_path):
+    seen_files = set()
+    for filename in sorted(os.listdir(folder_path)):
         file, ext = os.path.splitext(filename)
-        if ext != ".csv" or filename in blacklist:
+        if ext not in (".csv", ".parquet") or filename in blacklist:
+            continue
+        # A table may be stored both as .csv and as its typed .parquet version
+        if file in seen_files:
             continue
         if int(file[-4:]) in excluded_years:
             continue
+        seen_files.add(file)
         file_path = os.path.join(folder_path, filename)
-        df = pd.read_csv(file_path)
+        df = read_table(file_path)
         if "Weather Station ID" in df.columns:
             df = df.drop("Weather Station ID", axis=1)
         df_list.append(df)
-    return pd.concat(df_list)
+    return apply_table_schema(pd.concat(df_list))
+
+def apply_table_schema(df):
+    '''
+    Casts the columns of a processed table to the typed storage schema: 
+    TABLE_CATEGORICAL_COLUMNS to categoricals, TABLE_DATE_COLUMNS to datetime64 
+    and TABLE_FLOAT32_COLUMNS to float32. Other columns are left as they are.
+    '''
+    for column in TABLE_DATE_COLUMNS:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column])
+    for column in TABLE_FLOAT32_COLUMNS:
+        if column in df.columns and pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype(np.float32)
+    for column in TABLE_CATEGORICAL_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+def table_path(path):
+    '''
+    Returns the path of the Parquet version of a processed table (.csv or .parquet path).
+    '''
+    return os.path.splitext(path)[0] + ".parquet"
+
+def table_parts_folder(path):
+    '''
+    Returns the folder of the Parquet part files appended to a processed table 
+    (see append_to_table).
+    '''
+    return os.path.splitext(path)[0] + "_parts"
+
+def table_part_paths(path):
+    '''
+    Returns the paths of the part files appended to a processed table, in append order.
+    '''
+    parts_folder = table_parts_folder(path)
+    if not os.path.isdir(parts_folder):
+        return []
+    return [os.path.join(parts_folder, filename) for filename in sorted(os.listdir(parts_folder))
+            if filename.endswith(".parquet")]
+
+def read_table(path, index_col=None, columns=None):
+    '''
+    Reads a processed table with the typed schema (see apply_table_schema). Accepts
+    either the .csv or the .parquet path of the table. A .csv is only parsed if it is
+    newer than its Parquet version, which is then (re)written as a cache next to it.
+    Rows appended with append_to_table are read from their part files after the table.
+    
+    index_col=0 sets the first column as the index, as with pd.read_csv. If columns
+    is given, only those columns are read from Parquet.
+    '''
+    parquet_path = table_path(path)
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    if os.path.exists(csv_path) and (not os.path.exists(parquet_path) or 
+                                     os.path.getmtime(parquet_path) < os.path.getmtime(csv_path)):
+        df = apply_table_schema(pd.read_csv(csv_path))
+        try:
+            df.to_parquet(parquet_path, index=False)
+        except (OSError, TypeError, ValueError) as e:
+            print("Could not cache {} as Parquet: {}".format(csv_path, e))
+        if columns is not None:
+            df = df[columns]
+    else:
+        df = pd.read_parquet(parquet_path, columns=columns)
+    
+    part_paths = table_part_paths(path)
+    if part_paths:
+        parts = [pd.read_parquet(part_path, columns=columns) for part_path in part_paths]
+        df = pd.concat([df] + parts, ignore_index=True, sort=False)
+    # Integer categoricals may come back from Parquet as plain integers
+    df = apply_table_schema(df)
+    
+    if index_col is not None:
+        df = df.set_index(df.columns[index_col])
+        if str(df.index.name).startswith("Unnamed: "):
+            df.index.name = None
+    return df
+
+def save_table(df, path, index=True):
+    '''
+    Saves a processed table with the typed schema (see apply_table_schema) as Parquet,
+    at table_path(path), replacing any rows appended to it. If index is True, the index
+    is kept as the first column, named as pd.read_csv would name it for a .csv written
+    with df.to_csv(path). Returns the path of the saved table.
+    '''
+    if index:
+        index_name = df.index.name
+        df = df.reset_index()
+        if index_name is None:
+            # Mangle duplicated names with .1, .2, ... suffixes like pd.read_csv does
+            columns, seen = [], set()
+            for column in ["Unnamed: 0"] + list(df.columns[1:]):
+                name, k = column, 1
+                while name in seen:
+                    name = "{}.{}".format(column, k)
+                    k += 1
+                seen.add(name)
+                columns.append(name)
+            df.columns = columns
+    else:
+        df = df.copy()
+    df = apply_table_schema(df)
+    parquet_path = table_path(path)
+    df.to_parquet(parquet_path, index=False)
+    if os.path.isdir(table_parts_folder(path)):
+        shutil.rmtree(table_parts_folder(path))
+    return parquet_path
+
+def append_to_table(path, new_rows):
+    '''
+    Appends new_rows to the processed table at path (see read_table), or creates it.
+    The rows are written as a new Parquet part file in table_parts_folder(path), so an
+    append never reads or rewrites the rows already saved. If the table has the 
+    "Unnamed: 0" index column written by save_table, it is continued for the new rows.
+    Returns the appended rows as saved.
+    '''
+    new_rows = apply_table_schema(new_rows.reset_index(drop=True))
+    if not os.path.exists(path) and not os.path.exists(table_path(path)):
+        save_table(new_rows, path)
+        return new_rows
+    
+    part_paths = table_part_paths(path)
+    if not part_paths and not os.path.exists(table_path(path)):
+        # Table only saved as .csv so far: cache it as Parquet first (see read_table)
+        read_table(path)
+    # The index only grows, so its last value is in the last file written
+    last_path = part_paths[-1] if part_paths else table_path(path)
+    if "Unnamed: 0" in pq.read_schema(last_path).names and "Unnamed: 0" not in new_rows.columns:
+        last_index = pd.read_parquet(last_path, columns=["Unnamed: 0"])["Unnamed: 0"]
+        start = last_index.max() + 1 if len(last_index) > 0 else 0
+        new_rows.insert(0, "Unnamed: 0", np.arange(start, start + len(new_rows)))
+    
+    parts_folder = table_parts_folder(path)
+    if not os.path.isdir(parts_folder):
+        os.makedirs(parts_folder)
+    new_rows.to_parquet(os.path.join(parts_folder, "part-{:05d}.parquet".format(len(part_paths))), index=False)
+    return new_rows
 
 def read_yaml(yaml_file):
     yaml_data = None
@@ -146,6 +353,23 @@ def get_epa_features(row, filter_empty_temp=True):
     y = np.array(row['Daily Mean PM2.5 Concentration'])
     return X, y
 
+EPA_FEATURE_COLUMNS = ['SITE_LATITUDE', 'SITE_LONGITUDE', 'Month',
+                       'Blue [0,0]', 'Blue [0,1]', 'Blue [1,0]', 'Blue [1,1]',
+                       'Green [0,0]', 'Green [0,1]', 'Green [1,0]', 'Green [1,1]',
+                       'PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN']
+
+def get_epa_features_matrix(df):
+    '''
+    Vectorized version of get_epa_features over a whole master df. Returns the 
+    (N, 16) float64 matrix of Non-Sentinel features, in EPA_FEATURE_COLUMNS order,
+    and the (N,) PM2.5 labels.
+    '''
+    months = pd.to_datetime(df['Date']).dt.month
+    X = np.stack([months.values if column == 'Month' else df[column].values 
+                  for column in EPA_FEATURE_COLUMNS], axis=1).astype(np.float64)
+    y = df['Daily Mean PM2.5 Concentration'].values.astype(np.float64)
+    return X, y
+
 def get_epa_features_no_weather(row, filter_empty_temp=True):
     '''
     Method that gets Non-Sentinel features from the given row from the master df, excluding all weather 
@@ -235,11 +459,11 @@ def remove_sent_and_save_df_to_csv(load_from_csv_filename, save_to_csv_filename)
     ''' 
     Given a .csv of the df of current datapoints, loads the df, then
     removes the missing sentinel from the updated bad-file list, and
-    resaves to a .csv for later use.
+    resaves it as a typed table (see save_table) for later use.
     '''
-    df = pd.read_csv(load_from_csv_filename)
+    df = read_table(load_from_csv_filename)
     df = remove_missing_sent(df)
-    df.to_csv(save_to_csv_filename)
+    save_table(df, save_to_csv_filename)
     
     
     
@@ -354,23 +578,96 @@ def plot_r2(train_r2, val_r2, num_epochs, num_ex, save_as):
     plt.savefig(save_as)
     
         
-def save_predictions(indices, predictions, labels, sites, dates, states, batch_size, save_to):
-    '''
-    Method to save indices, labels, and predictions of a given batch. 
-    All batches over entire epoch will be saved to the same file,
-    so that each .csv file has the predictions over all samples.
-    '''
-    with open(save_to, 'a') as fd:
-        writer = csv.writer(fd)
-        for i in range(0, batch_size):
-            index = indices[i]
-            y_pred = predictions[i]
-            y_true = labels[i]
-            site = sites[i]
-            date = dates[i]
-            state = states[i]
-            row = [index, y_pred, y_true, site, date, state]
-            writer.writerow(row)
+def _write_predictions(df, parquet_path):
+    directory = os.path.dirname(parquet_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    # Bounded row groups, so that metrics.compute_metrics can stream the table
+    df.to_parquet(parquet_path, index=False, row_group_size=metrics.STREAM_CHUNKSIZE)
+
+def _report_failed_write(future):
+    if future.exception() is not None:
+        print("Failed to write predictions: {}".format(future.exception()))
+
+def wait_for_prediction_writes():
+    '''
+    Waits for every background write of PredictionWriter.flush, and raises the
+    error of the first one that failed. Called at the end of training.
+    '''
+    global _pending_prediction_writes
+    pending, _pending_prediction_writes = _pending_prediction_writes, []
+    for future in pending:
+        future.result()
+
+class PredictionWriter(object):
+    '''
+    Buffers the indices, labels, and predictions of an epoch in preallocated arrays.
+    All batches over the entire epoch are written at once by flush, from a background
+    thread, to a Parquet table at table_path(save_to) with PREDICTION_COLUMNS, so that
+    the training loop does not wait on disk.
+    '''
+    def __init__(self, save_to, capacity):
+        self.save_to = save_to
+        self.capacity = capacity
+        self.size = 0
+        # Allocated on the first add, as most epochs do not save their predictions
+        self.columns = None
+
+    def add(self, indices, predictions, labels, sites, months, states):
+        '''
+        Copies a batch (numpy arrays or lists) into the buffers, growing them if needed.
+        '''
+        batch = dict(zip(PREDICTION_COLUMNS, [indices, predictions, labels, sites, months, states]))
+        batch_size = len(indices)
+        end = self.size + batch_size
+        if self.columns is None:
+            capacity = max(end, self.capacity)
+            self.columns = {'Index': np.empty(capacity, dtype=np.int64),
+                            'Prediction': np.empty(capacity, dtype=np.float32),
+                            'Label': np.empty(capacity, dtype=np.float32),
+                            'Site ID': np.empty(capacity, dtype=np.int64),
+                            'Month': np.empty(capacity, dtype=np.int64),
+                            'State': np.empty(capacity, dtype=object)}
+        if end > len(self.columns['Index']):
+            new_capacity = max(end, 2 * len(self.columns['Index']))
+            for column, values in self.columns.items():
+                grown = np.empty(new_capacity, dtype=values.dtype)
+                grown[:self.size] = values[:self.size]
+                self.columns[column] = grown
+        for column, values in batch.items():
+            self.columns[column][self.size:end] = np.asarray(values).reshape(batch_size)
+        self.size = end
+
+    def flush(self):
+        '''
+        Writes the buffered predictions in the background and empties the buffers.
+        The previous writes are waited for first, so a failed write raises at the next
+        flush (or at wait_for_prediction_writes), and is also printed as soon as it fails.
+        Returns the concurrent.futures.Future of the write, or None if there was nothing to write.
+        '''
+        global _prediction_flush_executor
+        wait_for_prediction_writes()
+        if self.size == 0:
+            return None
+        df = pd.DataFrame({column: values[:self.size].copy() for column, values in self.columns.items()})
+        self.size = 0
+        if _prediction_flush_executor is None:
+            # A single thread keeps the writes in order, and is joined at exit
+            _prediction_flush_executor = ThreadPoolExecutor(max_workers=1)
+        future = _prediction_flush_executor.submit(_write_predictions, df, table_path(self.save_to))
+        future.add_done_callback(_report_failed_write)
+        _pending_prediction_writes.append(future)
+        return future
+
+def read_predictions(predictions_path):
+    '''
+    Reads the predictions saved by a PredictionWriter, given the .csv or .parquet path,
+    or an older predictions .csv if there is no Parquet table.
+    '''
+    parquet_path = table_path(predictions_path)
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+    return pd.read_csv(predictions_path)
             
 def strip_and_freeze(model):
     """
@@ -429,24 +726,12 @@ def compute_dataloader_mean_std(dataloader):
     """
     pass
 
-def mse_row(row):
-    '''
-    Given a row of a df which is an example of the
-    form (index, prediction, label),
-    computes the MSE of the example.
-    '''
-    pred = row['Prediction']
-    label = row['Label']
-    mse = (label-pred)**2
-    return mse
-
-
 def compute_r2(predictions_csv):
     '''                                                 
-    Takes in .csv created from save_predictions of (indices, predictions, labels)
+    Takes in predictions saved by a PredictionWriter of (indices, predictions, labels)
     for each example, and calculates total R2 over the dataset.
     '''
-    df = pd.read_csv(predictions_csv)
+    df = read_predictions(predictions_csv)
     
     indices = df['Index']
     predictions = df['Prediction']
@@ -459,26 +744,20 @@ def compute_r2(predictions_csv):
 
 def compute_mse(predictions_csv):
     '''
-    Computes the mean MSE over all predictions in predictions_csv.
+    Computes the mean MSE over all predictions in predictions_csv, streaming
+    over the file (see metrics.compute_metrics).
     '''
-    pandarallel.initialize()
-
-    df = pd.read_csv(predictions_csv)
-    mses = df.parallel_apply(mse_row, axis=1)
-    mse = mses.sum()/len(mses)
-
-    return mse
+    results = metrics.compute_metrics([predictions_csv], groupings=[], num_processes=1)
+    return results[metrics.ALL_GROUPS]['MSE'].iloc[0]
 
 def plot_loss_histogram(predictions_csv):
     '''                                                 
-    Takes in .csv created from save_predictions of (indices, predictions, labels)
+    Takes in predictions saved by a PredictionWriter of (indices, predictions, labels)
     for each example, and calculates MSE of each example.     
     Then plots the histogram of the losses.  
     '''
-    pandarallel.initialize()
-
-    df = pd.read_csv(predictions_csv)
-    mses = df.parallel_apply(mse_row, axis=1)
+    df = read_predictions(predictions_csv)
+    mses = metrics.squared_errors(df)
     df['MSE'] = mses
 
     # Compute mean and stdev of MSEs                                                                    
@@ -516,7 +795,7 @@ def month_average_analysis(averages_csv):
     '''
     Method that computes the mean monthly PM2.5 average over all sites. 
     '''
-    average_df = pd.read_csv(averages_csv)
+    average_df = read_table(averages_csv)
     for month in range(1, 13):
         month_df = average_df[average_df['Month']== month]
         pms = month_df['Month Average']
@@ -529,7 +808,7 @@ def plot_predictions(predictions_csv, model_name):
     Method to plot true PM2.5 values vs. model predicted values based on predictions in
     the predictions_csv file.
     '''
-    df = pd.read_csv(predictions_csv)
+    df = read_predictions(predictions_csv)
     
     indices = df['Index']
     predictions = df['Prediction']
@@ -546,11 +825,11 @@ def plot_predictions(predictions_csv, model_name):
     
 def plot_predictions_histogram(predictions_csv, model_name, dataset='val'):
     '''                                                 
-    Takes in .csv created from save_predictions of (indices, predictions, labels)
+    Takes in predictions saved by a PredictionWriter of (indices, predictions, labels)
     for each example. Then plots the histogram of the predictions vs. the labels.  
     '''
     plt.clf()
-    df = pd.read_csv(predictions_csv)
+    df = read_predictions(predictions_csv)
     predictions = df['Prediction']
     labels = df['Label']
     bins = 50
@@ -571,10 +850,8 @@ def highest_loss_analysis_via_outliers(predictions_csv):
     for each example, and calculates MSE of each example.     
     Then determines examples with highest losses, based on month/site ID, to investigate trends. 
     '''
-    pandarallel.initialize()
-
-    df = pd.read_csv(predictions_csv)
-    mses = df.parallel_apply(mse_row, axis=1)
+    df = read_predictions(predictions_csv)
+    mses = metrics.squared_errors(df)
     df['MSE'] = mses
 
     # Compute mean and stdev of MSEs
@@ -613,14 +890,14 @@ def get_outlier_info(master_csv):
     '''
     
     site_id = 60371201 
-    df = pd.read_csv(master_csv)
+    df = read_table(master_csv)
 
     site_points = df[df['Site ID'] == site_id]
     twenty = site_points.head(20)                                                             
     most_fq_months = site_points['Month'].value_counts()[:12].index.tolist()
 
     preds_csv = "predictions/newest_combined_val_epoch_14.csv"
-    preds_df = pd.read_csv(preds_csv)
+    preds_df = read_predictions(preds_csv)
     preds_at_site = preds_df[preds_df['Site ID'] == site_id]
     return preds_at_site
 
@@ -631,12 +908,9 @@ def highest_loss_analysis(predictions_csv, model_name):
     for each example, and calculates MSE of each example.     
     Plots losses vs. month/state to investigate trends. 
     '''
-    pandarallel.initialize()
     plt.clf()
-    df = pd.read_csv(predictions_csv)
-    mses = df.parallel_apply(mse_row, axis=1)
-    df['MSE'] = mses
-    df = df.groupby('State', as_index=False)['MSE'].mean()  # Or 'Month'
+    df = read_predictions(predictions_csv)
+    df = metrics.GroupedMetrics('State').update_df(df).result()  # Or 'Month'
  
     # 44 states; Does not include ak, nd, dc, ri , hi, md
     states = ['AL','AZ','AR','CA','CO','CT','DE','FL','GA','ID','IL','IN','IA','KS','KY','LA','ME',
@@ -669,23 +943,16 @@ def highest_loss_analysis(predictions_csv, model_name):
 def compute_per_site_r2(preds_csv):
     '''
     Reads in predictions df given in preds_csv and 
-    computes the per-site r2 and Pearson for the predictions.
-    '''
-    df = pd.read_csv(preds_csv)
-    epa_stations = df['Site ID'].unique()
-
-    for idx, station in enumerate(epa_stations):
-        station_df = df[df['Site ID'] == station]
-        predictions = station_df['Prediction']
-        labels = station_df['Label']
-        r2 = r2_score(labels, predictions)
-        pearson = pearsonr(labels, predictions)
-        print("Site {}/{}: {} r2 score: {}".format(idx, len(epa_stations), station, r2))
-            
-    #labels = df['Month Average']
-    #predictions = df['Predicted Month Average']
+    computes the per-site r2 and Pearson for the predictions,
+    in one pass over the file (see metrics.compute_metrics).
+    Returns the per-site metrics df.
+    '''
+    site_metrics = metrics.compute_metrics([preds_csv], groupings=['Site ID'], num_processes=1)['Site ID']
+
+    for idx, (station, row) in enumerate(site_metrics.iterrows()):
+        print("Site {}/{}: {} r2 score: {}".format(idx, len(site_metrics), station, row['R2']))
             
-    return r2, pearson
+    return site_metrics
 
 
 